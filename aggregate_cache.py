@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sys
+
+import pandas as pd
+
+
+# Nome do arquivo de índice dentro do diretório do cache
+CACHE_INDEX_FILENAME = 'index.json'
+
+
+def mappings_version(*objects):
+    """
+    Calcula uma "versão" (hash SHA-256) para os dicionários de mapeamento e quaisquer
+    outros objetos serializáveis em JSON que influenciem o resultado agregado.
+    Qualquer alteração em um deles gera uma versão diferente e invalida o cache.
+    """
+    payload = json.dumps(objects, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def file_content_hash(filepath, block_size=1024 * 1024):
+    """
+    Calcula o SHA-256 do conteúdo de um arquivo, lendo em blocos.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AggregateCache:
+    """
+    Cache persistente dos DataFrames agregados retornados por process_single_dbc_file.
+
+    Cada entrada é identificada pelo caminho absoluto do .dbc e validada pelo tamanho e
+    mtime do arquivo (e, opcionalmente, pelo hash do conteúdo). O índice guarda também a
+    versão dos mapeamentos: se ela mudar, o cache inteiro é descartado.
+    """
+
+    def __init__(self, cache_dir, version, use_content_hash=False, rebuild=False):
+        self.cache_dir = cache_dir
+        self.version = version
+        self.use_content_hash = use_content_hash
+        self.index_path = os.path.join(cache_dir, CACHE_INDEX_FILENAME)
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries = {}
+
+        if rebuild:
+            print(f"Reconstrução do cache solicitada. Descartando o cache em: {cache_dir}")
+            self.clear()
+            return
+
+        index = self._load_index()
+        if index is None:
+            return
+        if index.get('version') != version:
+            print("INFO: Os mapeamentos mudaram desde a última execução. O cache de agregados será reconstruído.")
+            self.clear()
+            return
+        self.entries = index.get('entries', {})
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"AVISO: Índice do cache ilegível ({e}). O cache será reconstruído.", file=sys.stderr)
+            return None
+
+    def _entry_filename(self, filepath):
+        return hashlib.sha1(filepath.encode('utf-8')).hexdigest() + '.pkl'
+
+    def _stat_key(self, filepath):
+        stat = os.stat(filepath)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def get(self, filepath):
+        """
+        Retorna o DataFrame agregado em cache para o arquivo, ou None se não houver
+        entrada válida (arquivo novo, alterado ou entrada corrompida).
+        """
+        filepath = os.path.abspath(filepath)
+        entry = self.entries.get(filepath)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        try:
+            key = self._stat_key(filepath)
+        except OSError:
+            self.misses += 1
+            return None
+
+        if key['size'] != entry['size']:
+            self.misses += 1
+            return None
+        if key['mtime_ns'] != entry['mtime_ns']:
+            # Mesmo tamanho, mtime diferente (ex: arquivo baixado novamente). Com o hash de
+            # conteúdo habilitado, um arquivo idêntico continua válido.
+            if not (self.use_content_hash and entry.get('sha256')
+                    and file_content_hash(filepath) == entry['sha256']):
+                self.misses += 1
+                return None
+            entry['mtime_ns'] = key['mtime_ns']
+
+        try:
+            df = pd.read_pickle(os.path.join(self.cache_dir, entry['file']))
+        except Exception as e:
+            print(f"AVISO: Entrada de cache corrompida para {filepath} ({e}). Reprocessando.", file=sys.stderr)
+            self.entries.pop(filepath, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return df
+
+    def put(self, filepath, df):
+        """
+        Armazena o DataFrame agregado de um arquivo processado com sucesso.
+        """
+        filepath = os.path.abspath(filepath)
+        entry = self._stat_key(filepath)
+        if self.use_content_hash:
+            entry['sha256'] = file_content_hash(filepath)
+        entry['file'] = self._entry_filename(filepath)
+
+        entry_path = os.path.join(self.cache_dir, entry['file'])
+        tmp_path = entry_path + '.tmp'
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, entry_path)
+        self.entries[filepath] = entry
+
+    def prune(self):
+        """
+        Remove entradas de arquivos que não existem mais.
+        """
+        for filepath in [path for path in self.entries if not os.path.exists(path)]:
+            entry = self.entries.pop(filepath)
+            try:
+                os.remove(os.path.join(self.cache_dir, entry['file']))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Descarta todas as entradas do cache.
+        """
+        self.entries = {}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl') or name == CACHE_INDEX_FILENAME:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def save(self):
+        """
+        Grava o índice do cache de forma atômica.
+        """
+        self.prune()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'entries': self.entries}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,76 @@
+"""
+Mede o tempo dos motores pandas e polars (ver engines.py) no arquivo de referência
+data/CIHAMG1605.dbc (ou nos arquivos indicados), nos modos normal e streaming. A
+paridade dos totais é conferida em tests/test_engine_parity.py, que usa compare();
+aqui as divergências só são listadas, junto com os tempos.
+
+    python benchmarks/engine_parity.py
+    python benchmarks/engine_parity.py data/CIHASP1605.dbc --chunk-size 200000
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import pandas as pd
+
+import process_ciha_data
+
+GOLDEN_DBC = os.path.join(REPO_DIR, 'data', 'CIHAMG1605.dbc')
+
+
+def run_engine(filepath, engine, chunk_size=None):
+    """
+    Processa filepath com o motor indicado. Retorna (tempo em segundos, Series de
+    TOTAL_PROCEDIMENTOS indexada pelas dimensões, com os rótulos como texto).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        df = process_ciha_data.process_single_dbc_file(filepath, chunk_size=chunk_size, engine=engine)
+        elapsed = time.perf_counter() - start
+    if df is None:
+        raise RuntimeError(f"O motor {engine} falhou ao processar {filepath}.")
+    dims = [col for col in df.columns if col != 'TOTAL_PROCEDIMENTOS']
+    totals = df.astype({col: str for col in dims}).set_index(dims)['TOTAL_PROCEDIMENTOS'].sort_index()
+    return elapsed, totals
+
+
+def compare(filepath, chunk_size=None):
+    """
+    Compara os dois motores num arquivo. Retorna a lista de divergências (vazia se iguais).
+    """
+    pandas_time, pandas_totals = run_engine(filepath, 'pandas', chunk_size)
+    polars_time, polars_totals = run_engine(filepath, 'polars', chunk_size)
+    mode = f"blocos de {chunk_size}" if chunk_size else "normal"
+    print(f"  {os.path.basename(filepath):<18} {mode:<20} pandas {pandas_time:8.4f}s  polars {polars_time:8.4f}s  "
+          f"({len(pandas_totals)} grupos)")
+
+    joined = pd.concat([pandas_totals.rename('pandas'), polars_totals.rename('polars')], axis=1)
+    diverging = joined[joined['pandas'].ne(joined['polars'])]
+    return [f"{os.path.basename(filepath)} ({mode}) {key}: pandas={row['pandas']} polars={row['polars']}"
+            for key, row in diverging.iterrows()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tempos dos motores pandas e polars.")
+    parser.add_argument('files', nargs='*', default=[GOLDEN_DBC], help="Arquivos .dbc (padrão: data/CIHAMG1605.dbc).")
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help="Tamanho do bloco na medição do modo streaming (padrão: 100000).")
+    args = parser.parse_args()
+
+    mismatches = []
+    for filepath in args.files:
+        mismatches += compare(filepath)
+        mismatches += compare(filepath, args.chunk_size)
+
+    if mismatches:
+        print(f"\nDIVERGÊNCIAS entre os motores ({len(mismatches)}):")
+        for mismatch in mismatches[:50]:
+            print(f"  - {mismatch}")
+        print("Confira com: python -m pytest tests/test_engine_parity.py")
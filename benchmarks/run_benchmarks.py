@@ -0,0 +1,219 @@
+"""
+Benchmarks do pipeline do CIHA.
+
+Mede separadamente:
+  * process_single_dbc_file, no arquivo real data/CIHAMG1605.dbc (fixture de referência,
+    cujos totais são conferidos com benchmarks/golden/CIHAMG1605.json) e em arquivos
+    sintéticos de vários tamanhos (ver synthetic_ciha.py);
+  * combine_aggregates (concat + groupby de main_processing_script), sobre os agregados
+    de um arquivo replicados para várias UFs e meses;
+  * excelll, sobre o resultado combinado.
+
+Os resultados são gravados em JSON para comparação entre commits:
+    python benchmarks/run_benchmarks.py --output resultados.json
+    python benchmarks/run_benchmarks.py --sizes tiny small --compare resultados.json
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pandas as pd
+
+import process_ciha_data
+from synthetic_ciha import SIZES, known_proc_rea_codes, synthetic_filename, write_synthetic_file
+
+
+GOLDEN_DBC = os.path.join(REPO_DIR, 'data', 'CIHAMG1605.dbc')
+GOLDEN_EXPECTED = os.path.join(BENCHMARKS_DIR, 'golden', 'CIHAMG1605.json')
+RESULTS_SCHEMA_VERSION = 1
+
+# UFs usadas para replicar os agregados no benchmark de combine_aggregates
+UFS = ['AC', 'AL', 'AM', 'AP', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MG', 'MS', 'MT', 'PA',
+       'PB', 'PE', 'PI', 'PR', 'RJ', 'RN', 'RO', 'RR', 'RS', 'SC', 'SE', 'SP', 'TO']
+
+
+def golden_summary(df_long):
+    """
+    Resumo do resultado de um arquivo usado como referência: número de linhas, total,
+    totais por PROC_GRU_NOME e hash do CSV mestre que ele geraria.
+    """
+    final_df_long = process_ciha_data.combine_aggregates([df_long])
+    by_group = final_df_long.groupby('PROC_GRU_NOME', observed=True)['TOTAL_PROCEDIMENTOS'].sum()
+    return {
+        'rows': int(len(final_df_long)),
+        'total_procedimentos': int(final_df_long['TOTAL_PROCEDIMENTOS'].sum()),
+        'total_por_proc_gru_nome': {str(key): int(value) for key, value in by_group.items()},
+        'csv_sha256': hashlib.sha256(final_df_long.to_csv(index=False).encode('utf-8')).hexdigest(),
+    }
+
+
+def time_call(func, repeat):
+    """
+    Executa func repeat vezes, sem a saída de texto do pipeline.
+    Retorna (lista de tempos em segundos, resultado da última execução).
+    """
+    timings, result = [], None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def _record(name, case, timings, **extra):
+    record = {'name': name, 'case': case, 'seconds': [round(t, 6) for t in timings],
+              'min': round(min(timings), 6), 'median': round(statistics.median(timings), 6)}
+    record.update(extra)
+    print(f"  {name:<28} {case:<14} mediana {record['median']:9.4f}s  (mín {record['min']:.4f}s)")
+    return record
+
+
+def synthetic_file(work_dir, size, seed=0):
+    """
+    Arquivo sintético de um tamanho pré-definido, gerado uma vez e reaproveitado.
+    """
+    filepath = os.path.join(work_dir, size, synthetic_filename('SP', 16, 5))
+    if not os.path.exists(filepath):
+        print(f"Gerando arquivo sintético '{size}' ({SIZES[size]} registros) em {filepath}...")
+        write_synthetic_file(filepath, SIZES[size], seed=seed, known_codes=known_proc_rea_codes())
+    return filepath
+
+
+def replicate_aggregates(df_long, ufs, months):
+    """
+    Replica o agregado de um arquivo para len(ufs) * months arquivos "virtuais",
+    como se cada UF tivesse um arquivo por mês, para alimentar combine_aggregates.
+    """
+    frames = []
+    for uf in ufs:
+        for month in range(months):
+            df = df_long.copy()
+            df['UF_ATENDIMENTO'] = uf
+            df['ANO_ATENDIMENTO'] = 16 + month % 2
+            frames.append(df)
+    return frames
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compara as medianas com as de um JSON anterior. Retorna a lista de regressões
+    (benchmarks mais lentos que a referência por mais que threshold).
+    """
+    previous = {(b['name'], b['case']): b for b in baseline.get('benchmarks', [])}
+    regressions = []
+    print(f"\nComparação com {baseline.get('git_commit') or 'referência'} (limite: +{threshold:.0%}):")
+    for bench in results['benchmarks']:
+        ref = previous.get((bench['name'], bench['case']))
+        if ref is None:
+            continue
+        ratio = bench['median'] / ref['median'] if ref['median'] else float('inf')
+        flag = 'REGRESSÃO' if ratio > 1 + threshold else ''
+        print(f"  {bench['name']:<28} {bench['case']:<14} {ref['median']:9.4f}s -> {bench['median']:9.4f}s  x{ratio:5.2f} {flag}")
+        if flag:
+            regressions.append({'name': bench['name'], 'case': bench['case'], 'ratio': round(ratio, 4)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do pipeline do CIHA com saída em JSON.")
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['tiny', 'small', 'mg'],
+                        help="Tamanhos dos arquivos sintéticos (padrão: tiny small mg).")
+    parser.add_argument('--repeat', type=int, default=3, help="Repetições de cada medida (padrão: 3).")
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'ciha_benchmarks'),
+                        help="Diretório dos arquivos sintéticos gerados (reaproveitados entre execuções).")
+    parser.add_argument('--months', type=int, default=12,
+                        help="Meses por UF replicados no benchmark de combine_aggregates (padrão: 12).")
+    parser.add_argument('--output', help="Arquivo JSON de saída com os resultados.")
+    parser.add_argument('--compare', help="JSON de uma execução anterior para comparação.")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Aumento relativo da mediana considerado regressão (padrão: 0.10).")
+    parser.add_argument('--update-golden', action='store_true',
+                        help="Regrava os totais esperados da fixture (após uma mudança intencional no resultado).")
+    args = parser.parse_args()
+
+    results = {
+        'schema': RESULTS_SCHEMA_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'repeat': args.repeat,
+        'benchmarks': [],
+    }
+    benchmarks = results['benchmarks']
+
+    print("Fixture de referência:")
+    timings, df_golden = time_call(lambda: process_ciha_data.process_single_dbc_file(GOLDEN_DBC), args.repeat)
+    benchmarks.append(_record('process_single_dbc_file', 'CIHAMG1605', timings))
+    summary = golden_summary(df_golden)
+    if args.update_golden:
+        os.makedirs(os.path.dirname(GOLDEN_EXPECTED), exist_ok=True)
+        with open(GOLDEN_EXPECTED, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=1)
+        print(f"  Totais esperados regravados em {GOLDEN_EXPECTED}")
+    with open(GOLDEN_EXPECTED, 'r', encoding='utf-8') as f:
+        expected = json.load(f)
+    mismatches = [key for key in expected if summary.get(key) != expected[key]]
+    results['golden'] = {'file': os.path.relpath(GOLDEN_DBC, REPO_DIR), 'ok': not mismatches, 'mismatches': mismatches}
+    print(f"  Totais da fixture: {'OK' if not mismatches else 'DIFERENTES em ' + ', '.join(mismatches)}")
+
+    print("\nArquivos sintéticos:")
+    os.makedirs(args.work_dir, exist_ok=True)
+    for size in args.sizes:
+        filepath = synthetic_file(args.work_dir, size)
+        timings, _ = time_call(lambda: process_ciha_data.process_single_dbc_file(filepath), args.repeat)
+        benchmarks.append(_record('process_single_dbc_file', size, timings, rows=SIZES[size]))
+
+    print("\nEtapas de consolidação:")
+    frames = replicate_aggregates(df_golden, UFS, args.months)
+    timings, final_df_long = time_call(lambda: process_ciha_data.combine_aggregates(frames), args.repeat)
+    benchmarks.append(_record('combine_aggregates', f'{len(frames)}_arquivos', timings,
+                              rows=int(sum(len(df) for df in frames))))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        excel_path = os.path.join(tmp_dir, 'resumo_consolidado_por_uf.xlsx')
+        timings, _ = time_call(lambda: process_ciha_data.excelll(final_df_long, excel_path), args.repeat)
+    benchmarks.append(_record('excelll', f'{len(UFS)}_ufs', timings, rows=int(len(final_df_long))))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            results['regressions'] = compare_results(results, json.load(f), args.threshold)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+        print(f"\nResultados salvos em: {args.output}")
+
+    # Código de saída diferente de zero se a fixture divergir ou houver regressão
+    if mismatches or results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
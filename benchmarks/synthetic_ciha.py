@@ -0,0 +1,264 @@
+"""
+Gerador de arquivos CIHA sintéticos (.dbf e .dbc) para os benchmarks.
+
+Os arquivos têm o mesmo layout de campos dos arquivos CIHA do DATASUS (ver
+data/CIHAMG1605.dbc) e distribuições de PROC_REA, SEXO e IDADE próximas das reais.
+Os demais campos são preenchidos com valores plausíveis, mas sem significado.
+
+Uso:
+    python benchmarks/synthetic_ciha.py SAIDA_DIR --size mg --uf SP --year 16 --month 5
+    python benchmarks/synthetic_ciha.py SAIDA_DIR --rows 2500 --format dbf
+"""
+import argparse
+import os
+import struct
+import sys
+from datetime import date
+
+import numpy as np
+
+
+# Layout dos campos do CIHA (todos do tipo 'C'), na ordem do arquivo original
+CIHA_FIELDS = [
+    ('ANO_CMPT', 4), ('MES_CMPT', 2), ('ESPEC', 2), ('CGC_HOSP', 14), ('MUNIC_RES', 6),
+    ('NASC', 8), ('SEXO', 1), ('UTI_MES_TO', 3), ('UTI_INT_TO', 3), ('PROC_REA', 10),
+    ('QT_PROC', 6), ('DT_ATEND', 8), ('DT_SAIDA', 8), ('DIAG_PRINC', 4), ('DIAG_SECUN', 4),
+    ('COBRANCA', 2), ('NATUREZA', 2), ('GESTAO', 1), ('MUNIC_MOV', 6), ('COD_IDADE', 1),
+    ('IDADE', 2), ('DIAS_PERM', 5), ('MORTE', 1), ('NACIONAL', 3), ('CAR_INT', 2),
+    ('HOMONIMO', 1), ('CNES', 7), ('FONTE', 2), ('CGC_CONSOR', 14), ('MODALIDADE', 2),
+]
+
+# Tamanhos pré-definidos (número de registros)
+SIZES = {
+    'tiny': 1000,
+    'small': 20000,
+    'mg': 175000, # Um mês de MG (data/CIHAMG1605.dbc tem 172.766 registros)
+    'sp': 500000, # Ordem de grandeza de um mês de SP
+}
+
+# Distribuição dos 4 primeiros dígitos do PROC_REA (contagens de data/CIHAMG1605.dbc)
+PROC_REA_PREFIX_WEIGHTS = {
+    '0301': 45818, '0202': 36951, '0204': 16489, '0205': 16182, '0206': 6914, '0303': 6328,
+    '0211': 5865, '0203': 4945, '0209': 4408, '0407': 3185, '0207': 3055, '0408': 2991,
+    '0411': 2982, '0409': 2390, '0401': 2040, '0405': 1266, '0406': 1259, '0304': 1134,
+    '0302': 932, '0305': 843, '0208': 799, '0201': 779, '0404': 713, '0415': 557,
+    '0410': 466, '0417': 416, '0310': 414, '0416': 372, '0403': 371, '0213': 342,
+    '0413': 301, '0308': 297, '0309': 167, '0402': 111, '0210': 108, '0701': 101,
+    '0306': 101, '0418': 56, '0412': 55, '0214': 46,
+}
+# Distribuição do SEXO ('' = não informado)
+SEXO_WEIGHTS = {'3': 83465, '1': 49589, '': 39696, '0': 16}
+# Fração de registros com IDADE em branco
+IDADE_MISSING_FRACTION = 0.23
+# Códigos distintos por prefixo de 4 dígitos do PROC_REA
+CODES_PER_PREFIX = 60
+
+DBF_HEADER_STRUCT = struct.Struct('<BBBBIHH20x')
+DBF_FIELD_STRUCT = struct.Struct('<11sc4xBB14x')
+
+
+def _weighted_choice(rng, weights, size):
+    labels = list(weights)
+    p = np.array([weights[label] for label in labels], dtype=np.float64)
+    return np.array(labels, dtype=object), rng.choice(len(labels), size=size, p=p / p.sum())
+
+
+def _encode_pool(values, length, encoding='cp850'):
+    """
+    Converte uma lista de textos numa matriz uint8 (len(values), length) completada com espaços.
+    """
+    pool = np.full((len(values), length), ord(' '), dtype=np.uint8)
+    for i, value in enumerate(values):
+        raw = str(value).encode(encoding)[:length]
+        pool[i, :len(raw)] = np.frombuffer(raw, dtype=np.uint8)
+    return pool
+
+
+def _digit_pool(rng, length, size):
+    return [''.join(map(str, rng.integers(0, 10, length))) for _ in range(size)]
+
+
+def _proc_rea_pool(rng, known_codes=()):
+    """
+    Códigos PROC_REA por prefixo: os códigos conhecidos (ex: as chaves de
+    PROC_REA_TO_REGIAO_MAP) daquele prefixo mais sufixos aleatórios até CODES_PER_PREFIX.
+    Retorna (lista de códigos, índice inicial e quantidade de códigos de cada prefixo).
+    """
+    codes, spans = [], []
+    for prefix in PROC_REA_PREFIX_WEIGHTS:
+        prefix_codes = sorted({code for code in known_codes if code.startswith(prefix)})
+        while len(prefix_codes) < CODES_PER_PREFIX:
+            prefix_codes.append(prefix + ''.join(map(str, rng.integers(0, 10, 6))))
+        spans.append((len(codes), len(prefix_codes)))
+        codes.extend(prefix_codes)
+    return codes, np.array(spans)
+
+
+def _age_weights():
+    # Pesos por idade (0 a 99): estável até os 60 anos, caindo até os 99
+    ages = np.arange(100)
+    return np.where(ages < 60, 1.0, np.maximum(0.05, 1.0 - (ages - 60) / 40.0))
+
+
+def generate_records(rows, seed=0, chunk_index=0, year=16, month=5, known_codes=(), encoding='cp850'):
+    """
+    Gera os registros de um arquivo CIHA sintético como uma matriz uint8 (rows, recordlen),
+    já no formato de registro do DBF (byte de exclusão + campos completados com espaços).
+    Os conjuntos de valores de cada campo dependem só de seed; os sorteios de cada bloco
+    dependem de (seed, chunk_index).
+    """
+    pool_rng = np.random.default_rng(seed)
+    rng = np.random.default_rng((seed, chunk_index))
+    recordlen = 1 + sum(length for _, length in CIHA_FIELDS)
+    records = np.full((rows, recordlen), ord(' '), dtype=np.uint8)
+
+    offset = 1
+    for name, length in CIHA_FIELDS:
+        if name == 'ANO_CMPT':
+            pool, idx = _encode_pool([f'{2000 + year:04d}'], length, encoding), np.zeros(rows, dtype=np.int64)
+        elif name == 'MES_CMPT':
+            pool, idx = _encode_pool([f'{month:02d}'], length, encoding), np.zeros(rows, dtype=np.int64)
+        elif name == 'SEXO':
+            labels, idx = _weighted_choice(rng, SEXO_WEIGHTS, rows)
+            pool = _encode_pool(labels, length, encoding)
+        elif name == 'IDADE':
+            labels = [''] + [f'{age:02d}' for age in range(100)]
+            weights = _age_weights()
+            p = np.concatenate([[IDADE_MISSING_FRACTION], (1 - IDADE_MISSING_FRACTION) * weights / weights.sum()])
+            pool, idx = _encode_pool(labels, length, encoding), rng.choice(len(labels), size=rows, p=p)
+        elif name == 'PROC_REA':
+            codes, spans = _proc_rea_pool(pool_rng, known_codes)
+            _, prefix_idx = _weighted_choice(rng, PROC_REA_PREFIX_WEIGHTS, rows)
+            starts, counts = spans[prefix_idx, 0], spans[prefix_idx, 1]
+            # Dentro de cada prefixo, poucos códigos concentram a maior parte dos registros
+            within = np.minimum((rng.pareto(1.5, rows) * 3).astype(np.int64), counts - 1)
+            pool, idx = _encode_pool(codes, length, encoding), starts + within
+        elif name == 'COD_IDADE':
+            pool, idx = _encode_pool(['4'], length, encoding), np.zeros(rows, dtype=np.int64)
+        elif name in ('CGC_CONSOR', 'HOMONIMO'):
+            pool, idx = _encode_pool([''], length, encoding), np.zeros(rows, dtype=np.int64)
+        else:
+            pool = _encode_pool(_digit_pool(pool_rng, length, 200), length, encoding)
+            idx = rng.integers(0, len(pool), rows)
+        records[:, offset:offset + length] = pool[idx]
+        offset += length
+
+    return records
+
+
+def dbf_header(numrecords, encoding_byte=0x57):
+    """
+    Cabeçalho DBF (dBase III) com os descritores de CIHA_FIELDS.
+    """
+    today = date.today()
+    headerlen = DBF_HEADER_STRUCT.size + DBF_FIELD_STRUCT.size * len(CIHA_FIELDS) + 1
+    recordlen = 1 + sum(length for _, length in CIHA_FIELDS)
+    header = bytearray(DBF_HEADER_STRUCT.pack(3, today.year - 1900, today.month, today.day,
+                                              numrecords, headerlen, recordlen))
+    header[29] = encoding_byte # Language driver (o mesmo dos arquivos do DATASUS)
+    for name, length in CIHA_FIELDS:
+        header += DBF_FIELD_STRUCT.pack(name.encode('ascii'), b'C', length, 0)
+    header += b'\r'
+    return bytes(header)
+
+
+class LiteralImploder:
+    """
+    Compressor mínimo no formato PKWare DCL "implode" (o mesmo lido pelo blast.c usado
+    na descompactação dos .dbc). Emite apenas literais não codificados, sem buscar
+    repetições: a saída fica ~12% maior que a entrada, mas é um fluxo válido e a
+    compressão é trivialmente rápida.
+    """
+
+    # Código de comprimento 519 (fim do fluxo): bit de "match", código do símbolo 15
+    # (7 bits, invertidos) e 8 bits extras com o valor 255
+    END_BITS = np.array([1] + [0] * 7 + [1] * 8, dtype=np.uint8)
+
+    def __init__(self, dictionary_bits=6):
+        self._pending = np.zeros(0, dtype=np.uint8)
+        self.header = bytes([0, dictionary_bits]) # Literais não codificados, dicionário de 2^bits * 64 bytes
+
+    def _pack(self, bits, final=False):
+        bits = np.concatenate([self._pending, bits])
+        usable = len(bits) if final else len(bits) // 8 * 8
+        self._pending = bits[usable:]
+        return np.packbits(bits[:usable], bitorder='little').tobytes()
+
+    def compress(self, data):
+        # Cada literal vira 9 bits: 0 (literal) seguido dos 8 bits do byte, do menos significativo
+        values = np.frombuffer(data, dtype=np.uint8)
+        bits = np.zeros((len(values), 9), dtype=np.uint8)
+        bits[:, 1:] = (values[:, None] >> np.arange(8, dtype=np.uint8)) & 1
+        return self._pack(bits.reshape(-1))
+
+    def flush(self):
+        return self._pack(self.END_BITS, final=True)
+
+
+def write_synthetic_file(filepath, rows, seed=0, year=16, month=5, known_codes=(),
+                         chunk_rows=100000):
+    """
+    Grava um arquivo CIHA sintético. A extensão define o formato: '.dbf' (sem compressão)
+    ou '.dbc' (cabeçalho DBF + CRC de 4 bytes + registros comprimidos em "implode").
+    Os registros são gerados e gravados em blocos de chunk_rows.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    compressed = filepath.lower().endswith('.dbc')
+    imploder = LiteralImploder() if compressed else None
+
+    with open(filepath, 'wb') as f:
+        f.write(dbf_header(rows))
+        if compressed:
+            f.write(b'\0\0\0\0') # CRC (não verificado na descompactação)
+            f.write(imploder.header)
+        for chunk_index, start in enumerate(range(0, rows, chunk_rows)):
+            records = generate_records(min(chunk_rows, rows - start), seed=seed, chunk_index=chunk_index,
+                                       year=year, month=month, known_codes=known_codes)
+            data = records.tobytes()
+            f.write(imploder.compress(data) if compressed else data)
+        if compressed:
+            f.write(imploder.compress(b'\x1a'))
+            f.write(imploder.flush())
+        else:
+            f.write(b'\x1a')
+    return filepath
+
+
+def synthetic_filename(uf='SP', year=16, month=5, extension='dbc'):
+    # Mesmo padrão de nome dos arquivos do DATASUS (a UF e o ano são lidos do nome)
+    return f'CIHA{uf}{year:02d}{month:02d}.{extension}'
+
+
+def known_proc_rea_codes():
+    """
+    Códigos PROC_REA com região corporal mapeada em process_ciha_data, para que os
+    arquivos sintéticos exercitem também o mapeamento de regiões.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from process_ciha_data import PROC_REA_TO_REGIAO_MAP
+    return tuple(PROC_REA_TO_REGIAO_MAP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera arquivos CIHA sintéticos (.dbc/.dbf) para benchmarks.")
+    parser.add_argument('output_dir', help="Diretório de saída.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--rows', type=int, help="Número de registros.")
+    group.add_argument('--size', choices=sorted(SIZES), default='small',
+                       help="Tamanho pré-definido (padrão: small).")
+    parser.add_argument('--uf', default='SP')
+    parser.add_argument('--year', type=int, default=16, help="Ano com 2 dígitos (padrão: 16).")
+    parser.add_argument('--month', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['dbc', 'dbf'], default='dbc')
+    args = parser.parse_args()
+
+    rows = args.rows if args.rows is not None else SIZES[args.size]
+    filepath = os.path.join(args.output_dir, synthetic_filename(args.uf, args.year, args.month, args.format))
+    write_synthetic_file(filepath, rows, seed=args.seed, year=args.year, month=args.month,
+                         known_codes=known_proc_rea_codes())
+    print(f"Arquivo sintético gravado: {filepath} ({rows} registros, {os.path.getsize(filepath) / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
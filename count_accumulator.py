@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+
+
+VALUE_COLUMN = 'TOTAL_PROCEDIMENTOS'
+
+# Bits iniciais do código de cada dimensão na chave empacotada (até 256 valores distintos;
+# a largura cresce sozinha se uma dimensão passar disso)
+DEFAULT_BITS = 8
+MAX_KEY_BITS = 62
+
+
+class CountAccumulator:
+    """
+    Soma de contagens por combinação de dimensões, com códigos inteiros no lugar dos
+    rótulos.
+
+    Cada dimensão tem um domínio que cresce conforme aparecem valores novos (rótulo ->
+    código inteiro). A combinação dos códigos de uma linha é empacotada numa chave int64,
+    e as contagens ficam em dois arrays (chaves únicas ordenadas + totais): uma
+    representação esparsa do array N-dimensional de contagens. Os DataFrames adicionados
+    entram num buffer de chaves, que é compactado (chaves iguais somadas) sempre que
+    passa de compact_rows linhas. Assim a memória depende do número de combinações
+    distintas, e não do número de arquivos somados. O DataFrame "long" só é montado em
+    to_frame(), com as dimensões de texto como categóricas.
+    """
+
+    def __init__(self, dimensions, compact_rows=1_000_000):
+        self.dimensions = list(dimensions)
+        self.compact_rows = compact_rows
+        self.labels = [[] for _ in self.dimensions]
+        self._codes = [{} for _ in self.dimensions]
+        self.bits = [DEFAULT_BITS] * len(self.dimensions)
+        if sum(self.bits) > MAX_KEY_BITS:
+            raise ValueError(f"Dimensões demais para uma chave de {MAX_KEY_BITS} bits: {self.dimensions}")
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending_keys = []
+        self._pending_counts = []
+        self._pending_rows = 0
+        self.frames_added = 0
+
+    def _encode(self, axis, series):
+        """
+        Códigos inteiros (no domínio da dimensão axis) dos valores de series; valores
+        novos ampliam o domínio. Valores ausentes (NaN) recebem -1.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Colunas categóricas (as derivadas no enriquecimento) já trazem os códigos
+            local_codes = series.cat.codes.to_numpy()
+            uniques = series.cat.categories.tolist()
+        else:
+            local_codes, uniques = pd.factorize(series.to_numpy(), sort=False)
+            uniques = uniques.tolist()
+        codes = self._codes[axis]
+        mapping = np.empty(len(uniques), dtype=np.int64)
+        for i, label in enumerate(uniques):
+            code = codes.get(label)
+            if code is None:
+                code = codes[label] = len(self.labels[axis])
+                self.labels[axis].append(label)
+            mapping[i] = code
+        if len(self.labels[axis]) > (1 << self.bits[axis]):
+            self._widen(axis, max(len(self.labels[axis]) - 1, 1).bit_length())
+        return np.where(local_codes >= 0, mapping[local_codes] if len(mapping) else -1, -1)
+
+    def _widen(self, axis, new_bits):
+        # Reempacota as chaves já acumuladas com mais bits para a dimensão axis
+        self.compact()
+        new_layout = list(self.bits)
+        new_layout[axis] = new_bits
+        if sum(new_layout) > MAX_KEY_BITS:
+            raise ValueError(f"Domínio da dimensão {self.dimensions[axis]} grande demais para a chave empacotada.")
+        codes = self._unpack(self.keys)
+        self.bits = new_layout
+        self.keys = self._pack(codes)
+
+    def _pack(self, codes):
+        key = np.zeros(len(codes[0]) if codes else 0, dtype=np.int64)
+        for axis_codes, bits in zip(codes, self.bits):
+            key = (key << bits) | axis_codes
+        return key
+
+    def _unpack(self, keys):
+        codes = []
+        for bits in reversed(self.bits):
+            codes.append(keys & ((1 << bits) - 1))
+            keys = keys >> bits
+        return codes[::-1]
+
+    def add(self, df, value_column=VALUE_COLUMN):
+        """
+        Soma as contagens de um DataFrame agregado (colunas das dimensões + value_column).
+        Linhas com dimensões ausentes (NaN) são ignoradas, como no groupby.
+        """
+        self._append(df, value_column, 1)
+        self.frames_added += 1
+
+    def subtract(self, df, value_column=VALUE_COLUMN):
+        """
+        Desfaz um add() anterior do mesmo DataFrame (ex: um arquivo que mudou ou foi
+        removido). Combinações cujo total chega a zero deixam de existir.
+        """
+        self._append(df, value_column, -1)
+        self.frames_added -= 1
+
+    def _append(self, df, value_column, sign):
+        if len(df) == 0:
+            return
+        codes = [self._encode(axis, df[dim]) for axis, dim in enumerate(self.dimensions)]
+        valid = np.logical_and.reduce([axis_codes >= 0 for axis_codes in codes])
+        keys = self._pack([axis_codes[valid] for axis_codes in codes])
+        self._pending_keys.append(keys)
+        self._pending_counts.append(sign * df[value_column].to_numpy(dtype=np.int64)[valid])
+        self._pending_rows += len(keys)
+        if self._pending_rows >= self.compact_rows:
+            self.compact()
+
+    def compact(self):
+        """
+        Incorpora o buffer às contagens acumuladas, somando as chaves repetidas. Chaves
+        com total zero (só acontece depois de subtract) são descartadas.
+        """
+        if not self._pending_keys:
+            return
+        keys = np.concatenate([self.keys] + self._pending_keys)
+        counts = np.concatenate([self.counts] + self._pending_counts)
+        self._pending_keys, self._pending_counts, self._pending_rows = [], [], 0
+        order = np.argsort(keys, kind='stable')
+        keys, counts = keys[order], counts[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+        self.keys = keys[starts]
+        self.counts = np.add.reduceat(counts, starts) if len(keys) else counts
+        nonzero = self.counts != 0
+        if not nonzero.all():
+            self.keys, self.counts = self.keys[nonzero], self.counts[nonzero]
+
+    def __len__(self):
+        self.compact()
+        return len(self.keys)
+
+    def to_frame(self, value_column=VALUE_COLUMN):
+        """
+        Decodifica as contagens no DataFrame "long" (dimensões + value_column), com as
+        linhas na ordem dos rótulos, como groupby(dimensions).sum().reset_index().
+        """
+        self.compact()
+
+        # Posição do rótulo de cada código na lista ordenada de rótulos da dimensão
+        sorted_labels, rank_of_code = [], []
+        for labels in self.labels:
+            order = sorted(range(len(labels)), key=lambda i: labels[i])
+            ranks = np.empty(len(labels), dtype=np.int64)
+            ranks[order] = np.arange(len(labels))
+            sorted_labels.append([labels[i] for i in order])
+            rank_of_code.append(ranks)
+
+        # Reempacotadas, as posições dão uma chave cuja ordem é a dos rótulos. As dimensões
+        # são extraídas uma de cada vez, para não ter todas desempacotadas ao mesmo tempo.
+        shifts = np.cumsum([0] + self.bits[::-1])[:-1][::-1]
+        sort_key = np.zeros(len(self.keys), dtype=np.int64)
+        for axis, bits in enumerate(self.bits):
+            axis_codes = (self.keys >> shifts[axis]) & ((1 << bits) - 1)
+            sort_key = (sort_key << bits) | rank_of_code[axis][axis_codes]
+        row_order = np.argsort(sort_key, kind='stable')
+        del sort_key
+        keys = self.keys[row_order]
+
+        data = {}
+        for axis, dim in enumerate(self.dimensions):
+            labels = sorted_labels[axis]
+            codes = rank_of_code[axis][(keys >> shifts[axis]) & ((1 << self.bits[axis]) - 1)]
+            if not labels:
+                data[dim] = pd.Series(dtype=object)
+            elif all(isinstance(label, (int, np.integer)) for label in labels):
+                data[dim] = np.array(labels, dtype=np.int64)[codes] # Ano e mês continuam inteiros
+            else:
+                data[dim] = pd.Categorical.from_codes(codes.astype(np.min_scalar_type(len(labels))), categories=labels)
+        data[value_column] = self.counts[row_order]
+        return pd.DataFrame(data, copy=False) # As colunas já são cópias novas
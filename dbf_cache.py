@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from aggregate_cache import file_content_hash
+
+
+# Limite padrão do espaço ocupado pelos DBFs descompactados
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+
+class DbfCache:
+    """
+    Cache em disco dos DBFs descompactados de cada arquivo .dbc, para não pagar a
+    descompactação (PKWare implode) de novo a cada execução.
+
+    Cada entrada é um par <chave>.dbf + <chave>.json, com a chave derivada do caminho
+    absoluto do .dbc. O .json guarda o tamanho e o mtime do .dbc de origem (e, com
+    use_content_hash, o hash do conteúdo), usados para validar a entrada. Não há índice
+    central: processos diferentes (ex: o pool de main_processing_script) podem ler e
+    gravar no mesmo cache. O espaço total dos DBFs fica limitado a max_bytes: ao gravar
+    uma entrada, as usadas há mais tempo (mtime do .dbf, renovado a cada leitura) são
+    removidas primeiro.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, use_content_hash=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.use_content_hash = use_content_hash
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, filepath):
+        key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.dbf', base + '.json'
+
+    def get(self, filepath):
+        """
+        Caminho do DBF descompactado em cache para filepath, ou None se não houver
+        entrada válida (arquivo novo, alterado ou entrada incompleta).
+        """
+        dbf_path, meta_path = self._paths(filepath)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stat = os.stat(filepath)
+            dbf_size = os.path.getsize(dbf_path)
+        except (OSError, ValueError):
+            return None
+
+        if stat.st_size != entry.get('size') or dbf_size != entry.get('dbf_size'):
+            return None
+        if stat.st_mtime_ns != entry.get('mtime_ns'):
+            # Mesmo tamanho, mtime diferente (ex: baixado de novo): com o hash, um arquivo
+            # idêntico continua válido
+            if not (self.use_content_hash and entry.get('sha256')
+                    and file_content_hash(filepath) == entry['sha256']):
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self._write_entry(meta_path, entry)
+
+        try:
+            os.utime(dbf_path) # Marca o uso, para a remoção das entradas mais antigas
+        except OSError:
+            return None
+        return dbf_path
+
+    def _write_entry(self, meta_path, entry):
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def put(self, filepath, decompressed_path):
+        """
+        Copia o DBF descompactado de filepath para o cache e remove as entradas mais
+        antigas se o limite for ultrapassado. Retorna o caminho do DBF em cache, ou None
+        se o DBF sozinho for maior que o limite.
+        """
+        dbf_size = os.path.getsize(decompressed_path)
+        if dbf_size > self.max_bytes:
+            return None
+        self.evict(self.max_bytes - dbf_size)
+
+        dbf_path, meta_path = self._paths(filepath)
+        stat = os.stat(filepath)
+        entry = {'source': os.path.abspath(filepath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'dbf_size': dbf_size}
+        if self.use_content_hash:
+            entry['sha256'] = file_content_hash(filepath)
+        shutil.copyfile(decompressed_path, dbf_path + '.tmp')
+        os.replace(dbf_path + '.tmp', dbf_path)
+        self._write_entry(meta_path, entry)
+        return dbf_path
+
+    def entries(self):
+        """
+        Lista (mtime, tamanho, caminho do .dbf) das entradas do cache.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.dbf'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, target_bytes):
+        """
+        Remove as entradas usadas há mais tempo até o cache ocupar no máximo target_bytes.
+        Num sistema POSIX, um DBF removido continua legível por quem já o abriu ou mapeou.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target_bytes:
+                break
+            for victim in (os.path.splitext(path)[0] + '.json', path):
+                try:
+                    os.remove(victim)
+                except OSError as e:
+                    print(f"AVISO: Não foi possível remover {victim} do cache de DBFs ({e}).", file=sys.stderr)
+            total -= size
@@ -0,0 +1,225 @@
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+# Cabeçalho do DBF (32 bytes): versão, data da última atualização (AA MM DD),
+# número de registros, tamanho do cabeçalho e tamanho de cada registro.
+DBF_HEADER_STRUCT = struct.Struct('<BBBBIHH20x')
+# Descritor de campo (32 bytes): nome, tipo, endereço, tamanho e casas decimais.
+DBF_FIELD_STRUCT = struct.Struct('<11sc4xBB14x')
+
+# Marcadores do primeiro byte de cada registro
+RECORD_ACTIVE = b' '
+
+DbfField = namedtuple('DbfField', ['name', 'type', 'offset', 'length', 'decimal_count'])
+DbfLayout = namedtuple('DbfLayout', ['numrecords', 'headerlen', 'recordlen', 'fields'])
+
+
+class RecordSample:
+    """
+    Amostra aleatória dos registros de um arquivo: cada registro entra com probabilidade
+    fraction (amostragem de Bernoulli), sorteado antes de qualquer decodificação. O
+    gerador é criado uma vez por arquivo, então a leitura em blocos sorteia a mesma
+    amostra que a leitura inteira.
+    """
+
+    def __init__(self, fraction, seed=0):
+        if not 0 < fraction <= 1:
+            raise ValueError(f"Fração de amostragem inválida: {fraction}")
+        self.fraction = fraction
+        self._rng = np.random.default_rng(seed)
+
+    def mask(self, count):
+        if self.fraction >= 1:
+            return np.ones(count, dtype=bool)
+        return self._rng.random(count) < self.fraction
+
+
+class UnsupportedFieldError(ValueError):
+    """
+    Campo de um tipo que o leitor colunar não sabe decodificar.
+    """
+
+
+def read_dbf_layout(f):
+    """
+    Lê o cabeçalho e os descritores de campo de um arquivo DBF aberto em modo binário.
+    Retorna um DbfLayout com os campos indexados pelo nome e o deslocamento de cada um
+    dentro do registro (o byte 0 é a marca de exclusão).
+    """
+    f.seek(0)
+    header = f.read(DBF_HEADER_STRUCT.size)
+    if len(header) < DBF_HEADER_STRUCT.size:
+        raise ValueError("Cabeçalho DBF incompleto.")
+    _, _, _, _, numrecords, headerlen, recordlen = DBF_HEADER_STRUCT.unpack(header)
+
+    fields = {}
+    offset = 1
+    while True:
+        descriptor = f.read(DBF_FIELD_STRUCT.size)
+        if not descriptor or descriptor[:1] in (b'\r', b'\n'):
+            break
+        if len(descriptor) < DBF_FIELD_STRUCT.size:
+            raise ValueError("Descritor de campo DBF incompleto.")
+        name, field_type, length, decimal_count = DBF_FIELD_STRUCT.unpack(descriptor)
+        name = name.split(b'\0')[0].decode('ascii', errors='replace')
+        fields[name] = DbfField(name, field_type.decode('ascii'), offset, length, decimal_count)
+        offset += length
+
+    return DbfLayout(numrecords, headerlen, recordlen, fields)
+
+
+def record_dtype(layout, columns):
+    """
+    Monta um dtype estruturado do NumPy que enxerga apenas as colunas pedidas
+    (mais a marca de exclusão) dentro de cada registro de tamanho fixo.
+    """
+    missing = [col for col in columns if col not in layout.fields]
+    if missing:
+        raise KeyError(f"Colunas ausentes no DBF: {missing}")
+
+    names = ['_DELETED']
+    formats = ['S1']
+    offsets = [0]
+    for col in columns:
+        field = layout.fields[col]
+        if field.type not in ('C', 'N', 'F'):
+            raise UnsupportedFieldError(f"Tipo de campo '{field.type}' não suportado na coluna {col}.")
+        names.append(col)
+        formats.append(f'S{field.length}')
+        offsets.append(field.offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': layout.recordlen})
+
+
+def _parse_text(raw_value, encoding):
+    # Mesmo tratamento do dbfread para campos 'C'
+    return raw_value.rstrip(b'\0 ').decode(encoding)
+
+
+def _parse_number(raw_value):
+    # Mesmo tratamento do dbfread para campos 'N'/'F': int, float ou None se vazio
+    data = raw_value.strip().strip(b'*')
+    try:
+        return int(data)
+    except ValueError:
+        if not data.strip():
+            return None
+        return float(data.replace(b',', b'.'))
+
+
+def decode_column(raw, field, encoding):
+    """
+    Converte um array de bytes de largura fixa em uma coluna tipada.
+    Campos texto viram pd.Categorical e campos numéricos viram arrays numéricos.
+    Cada valor distinto é decodificado uma única vez.
+    """
+    uniques, codes = np.unique(raw, return_inverse=True)
+    codes = codes.reshape(-1)
+
+    if field.type == 'C':
+        labels = np.array([_parse_text(value, encoding) for value in uniques], dtype=object)
+        # Valores brutos diferentes podem virar o mesmo texto (ex: espaços vs. NUL à direita)
+        categories, remap = np.unique(labels, return_inverse=True)
+        return pd.Categorical.from_codes(remap.reshape(-1)[codes], categories=categories)
+
+    values = [_parse_number(value) for value in uniques]
+    if all(isinstance(value, int) for value in values):
+        return np.array(values, dtype=np.int64)[codes]
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)[codes]
+
+
+def _record_count(f, layout):
+    # Não confia cegamente no número de registros do cabeçalho (arquivos truncados)
+    available = (os.fstat(f.fileno()).st_size - layout.headerlen) // layout.recordlen
+    return max(0, min(layout.numrecords, available))
+
+
+def _filter_columns(columns, row_filter):
+    # Colunas que o dtype precisa enxergar: as pedidas mais as usadas no filtro
+    return list(columns) + [col for col in (row_filter or {}) if col not in columns]
+
+
+def _encode_prefixes(prefixes, encoding):
+    return tuple(prefix.encode(encoding) if isinstance(prefix, str) else prefix for prefix in prefixes)
+
+
+def _records_to_frame(records, layout, columns, encoding, row_filter=None, row_sample=None):
+    mask = records['_DELETED'] == RECORD_ACTIVE
+    if row_sample is not None:
+        mask &= row_sample.mask(len(records))
+    # Filtro de linhas aplicado sobre os bytes brutos, antes de qualquer decodificação
+    for col, prefixes in (row_filter or {}).items():
+        col_mask = np.zeros(len(records), dtype=bool)
+        for prefix in _encode_prefixes(prefixes, encoding):
+            col_mask |= np.char.startswith(records[col], prefix)
+        mask &= col_mask
+    records = records[mask]
+    return pd.DataFrame({col: decode_column(records[col], layout.fields[col], encoding) for col in columns})
+
+
+def map_dbf_records(dbf_path, dtype, layout, count):
+    """
+    Mapeia em memória (mmap, somente leitura) os count registros de um DBF como um array
+    estruturado com o dtype de record_dtype. Nada é copiado: os campos são lidos direto
+    das páginas do arquivo, conforme são acessados.
+    """
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(dbf_path, dtype=dtype, mode='r', offset=layout.headerlen, shape=(count,))
+
+
+def read_dbf_columns(dbf_path, columns, encoding='cp850', row_filter=None, use_mmap=False, row_sample=None):
+    """
+    Lê apenas as colunas pedidas de um arquivo DBF, direto do buffer de registros de
+    tamanho fixo para arrays tipados, sem montar um dicionário por registro.
+    Registros marcados como excluídos são ignorados, como no dbfread.
+    row_filter é um dicionário {coluna: prefixos} (str ou bytes): só são mantidos os
+    registros cujo valor bruto da coluna começa com algum dos prefixos. O filtro roda
+    sobre os bytes do registro, antes de criar qualquer objeto Python.
+    Com use_mmap, os registros são lidos de um mapeamento do arquivo (map_dbf_records)
+    em vez de copiados para a memória; só os registros que passam no filtro são copiados.
+    Com row_sample (um RecordSample), só os registros sorteados são decodificados.
+    Retorna um DataFrame com as colunas na ordem pedida.
+    """
+    with open(dbf_path, 'rb') as f:
+        layout = read_dbf_layout(f)
+        dtype = record_dtype(layout, _filter_columns(columns, row_filter))
+        count = _record_count(f, layout)
+        if use_mmap:
+            records = map_dbf_records(dbf_path, dtype, layout, count)
+        else:
+            f.seek(layout.headerlen)
+            records = np.fromfile(f, dtype=dtype, count=count)
+
+    return _records_to_frame(records, layout, columns, encoding, row_filter, row_sample)
+
+
+def iter_dbf_column_chunks(dbf_path, columns, encoding='cp850', chunk_size=200000, row_filter=None, use_mmap=False,
+                           row_sample=None):
+    """
+    Versão em blocos de read_dbf_columns: lê no máximo chunk_size registros por vez e
+    gera um DataFrame por bloco, de modo que o arquivo nunca fica inteiro em memória.
+    Com use_mmap, cada bloco é uma fatia do mapeamento do arquivo.
+    """
+    with open(dbf_path, 'rb') as f:
+        layout = read_dbf_layout(f)
+        dtype = record_dtype(layout, _filter_columns(columns, row_filter))
+        remaining = _record_count(f, layout)
+        if use_mmap:
+            records = map_dbf_records(dbf_path, dtype, layout, remaining)
+            for start in range(0, remaining, chunk_size):
+                yield _records_to_frame(records[start:start + chunk_size], layout, columns, encoding, row_filter,
+                                        row_sample)
+            return
+        f.seek(layout.headerlen)
+
+        while remaining > 0:
+            records = np.fromfile(f, dtype=dtype, count=min(chunk_size, remaining))
+            if len(records) == 0:
+                break
+            remaining -= len(records)
+            yield _records_to_frame(records, layout, columns, encoding, row_filter, row_sample)
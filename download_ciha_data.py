@@ -1,56 +1,582 @@
 import requests
 import os
+import json
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from urllib.parse import urlparse
-from ftplib import FTP, all_errors
+from ftplib import FTP, all_errors, error_perm
 import time
 
-def download_file_from_http(file_url, local_filepath):
+from instrumentation import Instrumentation, get_instrumentation, set_instrumentation, stage
+
+
+class HostRateLimiter:
     """
-    Baixa um arquivo de uma URL HTTP/HTTPS usando a biblioteca requests.
-    Retorna True em caso de sucesso, False caso contrário.
+    Limitador de requisições por host, compartilhado entre as threads de download.
+    Os hosts são identificados por host:porta (o netloc da URL).
+    - No máximo max_in_flight downloads simultâneos por host.
+    - Intervalo mínimo de 1/requests_per_second entre o início de duas requisições ao mesmo host.
+    - Quando o servidor responde com erro (5xx, timeout, conexão recusada, FTP 4xx), o
+      intervalo dobra, até max_backoff_seconds; a cada resposta normal ele cai pela metade até
+      voltar ao valor configurado. Arquivos inexistentes (HTTP 404 / FTP 550) contam como
+      resposta normal do servidor.
     """
-    try:
-        print(f"Baixando via HTTP/HTTPS: {file_url}")
-        with requests.get(file_url, stream=True, timeout=60) as r:
-            r.raise_for_status() # Levanta um erro para códigos de status HTTP ruins (4xx ou 5xx)
-            with open(local_filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk: # Filtra chunks vazios para manter a conexão ativa
+
+    def __init__(self, requests_per_second=1.0, max_in_flight=4, max_backoff_seconds=30.0):
+        self.base_interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.max_in_flight = max_in_flight
+        self.max_backoff_seconds = max_backoff_seconds
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = {
+                    'semaphore': threading.BoundedSemaphore(self.max_in_flight),
+                    'interval': self.base_interval,
+                    'next_slot': 0.0,
+                }
+            return self._hosts[host]
+
+    def acquire(self, host):
+        state = self._state(host)
+        state['semaphore'].acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, state['next_slot'])
+            state['next_slot'] = start + state['interval']
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, host):
+        self._state(host)['semaphore'].release()
+
+    @contextmanager
+    def slot(self, host):
+        """
+        Reserva uma vaga para uma requisição ao host, respeitando os limites.
+        """
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def report_error(self, host):
+        state = self._state(host)
+        with self._lock:
+            state['interval'] = min(self.max_backoff_seconds, max(state['interval'] * 2, self.base_interval, 1.0))
+            state['next_slot'] = max(state['next_slot'], time.monotonic() + state['interval'])
+        print(f"AVISO: Erro do servidor {host}. Intervalo entre requisições aumentado para {state['interval']:.1f}s.")
+
+    def report_success(self, host):
+        state = self._state(host)
+        with self._lock:
+            state['interval'] = max(self.base_interval, state['interval'] / 2)
+
+
+def _report_server_error(limiter, hostname):
+    if limiter is not None and hostname:
+        limiter.report_error(hostname)
+
+
+def _report_success(limiter, hostname):
+    if limiter is not None and hostname:
+        limiter.report_success(hostname)
+
+
+# Sufixo do arquivo temporário usado durante o download; o arquivo final só aparece
+# (por renomeação atômica) quando a transferência termina completa.
+PART_SUFFIX = '.part'
+
+
+def _same_remote(a, b):
+    # Dois conjuntos de metadados remotos são compatíveis se nenhum campo presente nos dois diverge
+    return all(a.get(key) is None or b.get(key) is None or a[key] == b[key]
+               for key in ('size', 'mdtm', 'etag', 'last_modified'))
+
+
+def _has_validator(meta):
+    return any(meta.get(key) for key in ('mdtm', 'etag', 'last_modified'))
+
+
+class DownloadManifest:
+    """
+    Manifesto local (JSON no diretório de destino) com o tamanho e os validadores remotos
+    de cada arquivo baixado: SIZE/MDTM no FTP, Content-Length/ETag/Last-Modified no HTTP.
+    Permite pular arquivos que não mudaram no servidor e retomar um download interrompido
+    apenas se o arquivo remoto ainda for o mesmo.
+    As alterações são gravadas em lote: a cada flush_every entradas alteradas, a cada
+    flush_interval segundos e em flush() (chamado ao fim de cada modo de download). Se a
+    execução for interrompida, as últimas entradas podem se perder; na próxima execução,
+    esses arquivos só são baixados de novo (ou do início).
+    """
+
+    FILENAME = '.download_manifest.json'
+
+    def __init__(self, directory, flush_every=50, flush_interval=5.0):
+        self.path = os.path.join(directory, self.FILENAME)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"AVISO: Manifesto de downloads ilegível ({e}). Ignorando.")
+
+    def is_current(self, local_filepath, remote_meta):
+        """
+        True se o arquivo local está completo e corresponde ao arquivo remoto descrito
+        por remote_meta (mesmo tamanho e mesmos validadores registrados no manifesto).
+        """
+        entry = self.entries.get(os.path.basename(local_filepath))
+        if not entry or not entry.get('complete') or not os.path.exists(local_filepath):
+            return False
+        if remote_meta.get('size') is None and not _has_validator(remote_meta):
+            return False # Sem informação do servidor não há como confirmar
+        if entry.get('size') is not None and os.path.getsize(local_filepath) != entry['size']:
+            return False
+        return _same_remote(entry, remote_meta)
+
+    def resume_offset(self, part_path, remote_meta):
+        """
+        Posição a partir da qual o download pode ser retomado: o tamanho do arquivo parcial,
+        se ele foi iniciado para esta mesma versão do arquivo remoto; 0 caso contrário.
+        """
+        entry = self.entries.get(os.path.basename(part_path)[:-len(PART_SUFFIX)])
+        if not entry or entry.get('complete') or not os.path.exists(part_path):
+            return 0
+        if not (_has_validator(entry) and _has_validator(remote_meta) and _same_remote(entry, remote_meta)):
+            return 0
+        offset = os.path.getsize(part_path)
+        if remote_meta.get('size') is not None and offset > remote_meta['size']:
+            return 0
+        return offset
+
+    def start(self, name, remote_meta):
+        self._update(name, dict(remote_meta, complete=False))
+
+    def complete(self, name, remote_meta):
+        self._update(name, dict(remote_meta, complete=True))
+
+    def discard(self, name):
+        """
+        Remove a entrada de um download que não chegou a ser concluído.
+        """
+        entry = self.entries.get(name)
+        if entry is not None and not entry.get('complete'):
+            self._update(name, None)
+
+    def _update(self, name, entry):
+        with self._lock:
+            if entry is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = entry
+            self._pending += 1
+            if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._write()
+
+    def flush(self):
+        """
+        Grava as alterações ainda não gravadas.
+        """
+        with self._lock:
+            if self._pending:
+                self._write()
+
+    def _write(self):
+        # Chamado com o lock: regrava o manifesto inteiro de forma atômica
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+
+def _finalize_download(part_path, local_filepath, expected_size=None):
+    """
+    Confere o tamanho do arquivo parcial e o renomeia atomicamente para o nome final.
+    Se estiver incompleto, mantém o arquivo parcial para uma retomada futura.
+    """
+    actual_size = os.path.getsize(part_path)
+    if expected_size is not None and actual_size != expected_size:
+        raise IOError(f"Download incompleto de {local_filepath}: {actual_size} de {expected_size} bytes. "
+                      f"O arquivo parcial foi mantido para retomada.")
+    os.replace(part_path, local_filepath)
+
+
+def _http_meta(response):
+    """
+    Extrai tamanho, ETag e Last-Modified de uma resposta HTTP (HEAD, 200 ou 206).
+    """
+    headers = response.headers
+    meta = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'), 'size': None}
+    content_range = headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        meta['size'] = int(total) if total.isdigit() else None
+    elif headers.get('Content-Length', '').isdigit() and not headers.get('Content-Encoding'):
+        meta['size'] = int(headers['Content-Length'])
+    return meta
+
+
+class RangeNotHonored(IOError):
+    """
+    O servidor não devolveu a faixa de bytes pedida (ex: respondeu 200 com o arquivo inteiro).
+    """
+
+
+class HttpSession:
+    """
+    Sessão HTTP persistente (requests.Session) compartilhada pelos downloads HTTP/HTTPS:
+    as conexões ficam num pool (até pool_size por host) e são reaproveitadas entre os
+    arquivos, sem um novo handshake TCP/TLS a cada download.
+    O conteúdo é gravado em blocos de chunk_size bytes. Arquivos com pelo menos
+    range_threshold bytes, num servidor que aceita Range, são baixados em range_parts
+    faixas de bytes em paralelo (cada uma numa conexão do pool) e montados no arquivo
+    parcial; com range_parts=1, sempre num único fluxo.
+    """
+
+    def __init__(self, pool_size=8, chunk_size=1024 * 1024, range_parts=4, range_threshold=16 * 1024 * 1024,
+                 timeout=60):
+        self.chunk_size = chunk_size
+        self.range_parts = max(1, range_parts)
+        self.range_threshold = range_threshold
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def head(self, url):
+        return self.session.head(url, timeout=self.timeout, allow_redirects=True)
+
+    def get(self, url, headers=None):
+        return self.session.get(url, stream=True, timeout=self.timeout, headers=headers)
+
+    def wants_ranges(self, head):
+        """
+        True se o arquivo descrito pela resposta HEAD deve ser baixado em faixas paralelas.
+        """
+        size = _http_meta(head).get('size')
+        return (self.range_parts > 1 and size is not None and size >= self.range_threshold
+                and head.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+    def fetch_ranges(self, url, part_path, remote_meta):
+        """
+        Baixa o arquivo em range_parts faixas paralelas, gravadas cada uma na sua posição
+        do arquivo parcial (pré-alocado com o tamanho total). If-Range garante que todas
+        as faixas são da mesma versão do arquivo remoto. Retorna o total de bytes recebidos.
+        Se o servidor não devolver uma faixa (206), levanta RangeNotHonored.
+        """
+        size = remote_meta['size']
+        part_size = -(-size // self.range_parts)
+        bounds = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        validator = remote_meta.get('etag') or remote_meta.get('last_modified')
+
+        def fetch(bound):
+            start, end = bound
+            headers = {'Range': f"bytes={start}-{end}"}
+            if validator:
+                headers['If-Range'] = validator
+            received = 0
+            with self.get(url, headers=headers) as r:
+                r.raise_for_status()
+                if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f"bytes {start}-{end}/"):
+                    raise RangeNotHonored(f"O servidor não devolveu a faixa {start}-{end} de {url} "
+                                  f"(status {r.status_code}); o arquivo mudou ou não aceita Range.")
+                with open(part_path, 'r+b', buffering=0) as f:
+                    f.seek(start)
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
                         f.write(chunk)
-        print(f"Download concluído: {local_filepath}")
-        return True
+                        received += len(chunk)
+            if received != end - start + 1:
+                raise IOError(f"Faixa {start}-{end} de {url} incompleta: {received} bytes.")
+            return received
+
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        try:
+            with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+                return sum(executor.map(fetch, bounds))
+        except BaseException:
+            # O parcial pré-alocado não serve para uma retomada
+            os.remove(part_path)
+            raise
+
+    def close(self):
+        self.session.close()
+
+
+_default_http = None
+_default_http_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Sessão HTTP padrão do processo, criada no primeiro uso e compartilhada pelas threads.
+    """
+    global _default_http
+    with _default_http_lock:
+        if _default_http is None:
+            _default_http = HttpSession()
+        return _default_http
+
+
+def download_file_from_http(file_url, local_filepath, limiter=None, manifest=None, http=None):
+    """
+    Baixa um arquivo de uma URL HTTP/HTTPS usando a biblioteca requests, pela sessão
+    persistente http (um HttpSession; padrão: get_http_session()).
+    Com um HostRateLimiter, informa a ele os erros do servidor (para o backoff).
+    Com um DownloadManifest, pula o arquivo se Content-Length/ETag/Last-Modified não mudaram
+    e retoma um download interrompido com Range/If-Range.
+    Arquivos grandes são baixados em faixas de bytes paralelas (ver HttpSession).
+    O conteúdo é gravado em '<arquivo>.part' e renomeado só quando completo.
+    Retorna True em caso de sucesso (ou arquivo já atualizado), False caso contrário.
+    """
+    http = http or get_http_session()
+    hostname = urlparse(file_url).netloc # Host e porta, como chave do limitador
+    name = os.path.basename(local_filepath)
+    part_path = local_filepath + PART_SUFFIX
+    try:
+        with stage('download', file=name, protocol='http') as st:
+            headers = {}
+            offset = 0
+            head_meta = None
+            use_ranges = False
+            has_local = manifest is not None and (os.path.exists(local_filepath) or os.path.exists(part_path))
+            if has_local or http.range_parts > 1:
+                head = http.head(file_url)
+                if head.ok:
+                    head_meta = _http_meta(head)
+                    if has_local and manifest.is_current(local_filepath, head_meta):
+                        print(f"INFO: {local_filepath} já está atualizado. Download ignorado.")
+                        st.set(skipped=True)
+                        _report_success(limiter, hostname)
+                        return True
+                    if has_local:
+                        offset = manifest.resume_offset(part_path, head_meta)
+                    if offset:
+                        headers['Range'] = f"bytes={offset}-"
+                        headers['If-Range'] = head_meta.get('etag') or head_meta.get('last_modified')
+                    else:
+                        use_ranges = http.wants_ranges(head)
+
+            if use_ranges:
+                print(f"Baixando via HTTP/HTTPS em {http.range_parts} faixas paralelas: {file_url}")
+                remote_meta = head_meta
+                try:
+                    st.add(bytes_in=http.fetch_ranges(file_url, part_path, remote_meta))
+                    st.set(ranges=http.range_parts)
+                except RangeNotHonored as e:
+                    print(f"INFO: {e} Baixando num único fluxo.")
+                    use_ranges = False
+            if not use_ranges:
+                print(f"Baixando via HTTP/HTTPS: {file_url}")
+                with http.get(file_url, headers=headers) as r:
+                    if offset and r.status_code == 416:
+                        # Faixa inválida para o arquivo atual: descarta o parcial e baixa do zero
+                        os.remove(part_path)
+                        return download_file_from_http(file_url, local_filepath, limiter=limiter, manifest=manifest,
+                                                       http=http)
+                    r.raise_for_status() # Levanta um erro para códigos de status HTTP ruins (4xx ou 5xx)
+                    resumed = bool(offset) and r.status_code == 206
+                    if resumed:
+                        print(f"INFO: Retomando {name} a partir do byte {offset}.")
+                        st.set(resumed_from=offset)
+                    remote_meta = _http_meta(r)
+                    if manifest is not None:
+                        manifest.start(name, remote_meta)
+                    with open(part_path, 'ab' if resumed else 'wb', buffering=http.chunk_size) as f:
+                        for chunk in r.iter_content(chunk_size=http.chunk_size):
+                            if chunk: # Filtra chunks vazios para manter a conexão ativa
+                                f.write(chunk)
+                                st.add(bytes_in=len(chunk))
+            _finalize_download(part_path, local_filepath, remote_meta.get('size'))
+            if manifest is not None:
+                manifest.complete(name, remote_meta)
+            print(f"Download concluído: {local_filepath}")
+            _report_success(limiter, hostname)
+            return True
     except requests.exceptions.HTTPError as e:
         print(f"ERRO: HTTP ao tentar baixar {file_url}: {e}")
-        if hasattr(e, 'response') and e.response.status_code == 404:
+        status_code = e.response.status_code if getattr(e, 'response', None) is not None else None
+        if status_code == 404:
             print("INFO: (HTTP) O arquivo provavelmente não existe no servidor.")
+            _report_success(limiter, hostname) # O servidor respondeu normalmente
+        elif status_code is None or status_code >= 500 or status_code == 429:
+            _report_server_error(limiter, hostname)
     except requests.exceptions.ConnectionError as e:
         print(f"ERRO: Conexão ao tentar baixar {file_url}: {e}")
+        _report_server_error(limiter, hostname)
     except requests.exceptions.Timeout as e:
         print(f"ERRO: Tempo limite excedido ao tentar baixar {file_url}: {e}")
+        _report_server_error(limiter, hostname)
     except requests.exceptions.RequestException as e:
         print(f"ERRO: Inesperado durante a requisição HTTP: {e}")
     except IOError as e:
         print(f"ERRO: Ao escrever o arquivo '{local_filepath}': {e}")
     return False
 
-def download_file_from_ftp(file_url, local_filepath):
+FTP_DEFAULT_PORT = 21
+
+
+def open_ftp(hostname, port=None, timeout=60):
+    """
+    Abre uma sessão FTP com login anônimo em hostname:port (a porta da URL; padrão 21).
+    """
+    ftp = FTP()
+    try:
+        ftp.connect(hostname, port or FTP_DEFAULT_PORT, timeout=timeout)
+        ftp.login() # Login anônimo
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
+
+
+def _normalize_mdtm(value):
+    # MDTM e o fato 'modify' do MLSD usam AAAAMMDDHHMMSS, às vezes com fração de segundo
+    return value.strip()[:14] if value else None
+
+
+def _ftp_remote_meta(ftp, remote_path):
+    """
+    Consulta SIZE e MDTM de um arquivo remoto na sessão FTP aberta.
+    Um 550 no SIZE (arquivo inexistente) é propagado como error_perm, antes de qualquer
+    arquivo local ser criado; outras recusas só deixam o campo vazio.
+    """
+    meta = {'size': None, 'mdtm': None}
+    try:
+        ftp.voidcmd('TYPE I')
+        meta['size'] = ftp.size(remote_path)
+    except error_perm as e:
+        if str(e).startswith('550'):
+            raise
+    try:
+        meta['mdtm'] = _normalize_mdtm(ftp.sendcmd(f"MDTM {remote_path}")[4:])
+    except error_perm:
+        pass
+    return meta
+
+
+def _ftp_fetch(ftp, remote_path, local_filepath, manifest=None, remote_meta=None):
+    """
+    Baixa remote_path pela sessão FTP aberta para local_filepath.
+    Com um DownloadManifest, pula o arquivo se SIZE/MDTM não mudaram e retoma um download
+    interrompido com REST. O conteúdo é gravado em '<arquivo>.part' e renomeado só quando
+    completo. O arquivo parcial e a entrada do manifesto só são criados quando chega o
+    primeiro bloco de dados; se o servidor recusar o RETR (ex: 550), um parcial vazio e a
+    sua entrada são removidos. Erros da ftplib são propagados para quem chamou.
+    """
+    name = os.path.basename(local_filepath)
+    part_path = local_filepath + PART_SUFFIX
+    with stage('download', file=name, protocol='ftp') as st:
+        if remote_meta is None or remote_meta.get('size') is None or remote_meta.get('mdtm') is None:
+            try:
+                remote_meta = _ftp_remote_meta(ftp, remote_path)
+            except error_perm:
+                _discard_empty_part(part_path, manifest) # Resto de uma tentativa anterior
+                raise
+
+        offset = 0
+        if manifest is not None:
+            if manifest.is_current(local_filepath, remote_meta):
+                print(f"INFO: {local_filepath} já está atualizado. Download ignorado.")
+                st.set(skipped=True)
+                return True
+            offset = manifest.resume_offset(part_path, remote_meta)
+
+        if offset and offset == remote_meta.get('size'):
+            # Transferência anterior chegou ao fim, mas não foi renomeada
+            _finalize_download(part_path, local_filepath, remote_meta.get('size'))
+        else:
+            def retrieve(rest):
+                part = None
+
+                def write(block):
+                    nonlocal part
+                    if part is None:
+                        # Primeiro bloco: o arquivo existe no servidor e a transferência começou
+                        if manifest is not None:
+                            manifest.start(name, remote_meta)
+                        part = open(part_path, 'ab' if rest else 'wb')
+                    part.write(block)
+                    st.add(bytes_in=len(block))
+
+                try:
+                    ftp.retrbinary(f"RETR {remote_path}", write, rest=rest or None)
+                finally:
+                    if part is not None:
+                        part.close()
+                if part is None and not rest:
+                    open(part_path, 'wb').close() # Arquivo remoto vazio
+
+            try:
+                if offset:
+                    print(f"INFO: Retomando {name} a partir do byte {offset}.")
+                    st.set(resumed_from=offset)
+                    try:
+                        retrieve(offset)
+                    except error_perm as e:
+                        print(f"AVISO: O servidor recusou a retomada ({e}). Baixando do início.")
+                        retrieve(0)
+                else:
+                    retrieve(0)
+            except error_perm:
+                _discard_empty_part(part_path, manifest)
+                raise
+            _finalize_download(part_path, local_filepath, remote_meta.get('size'))
+
+        if manifest is not None:
+            manifest.complete(name, remote_meta)
+        return True
+
+
+def _discard_empty_part(part_path, manifest=None):
+    """
+    Remove um arquivo parcial vazio (download recusado antes do primeiro bloco) e a sua
+    entrada incompleta no manifesto. Parciais com dados ficam para uma retomada futura.
+    """
+    if os.path.exists(part_path):
+        if os.path.getsize(part_path) > 0:
+            return
+        os.remove(part_path)
+    if manifest is not None:
+        manifest.discard(os.path.basename(part_path)[:-len(PART_SUFFIX)])
+
+
+def download_file_from_ftp(file_url, local_filepath, limiter=None, manifest=None):
     """
     Baixa um arquivo de uma URL FTP usando a biblioteca ftplib.
     Assume FTP anônimo, que é comum para o DATASUS.
-    Retorna True em caso de sucesso, False caso contrário.
+    Com um HostRateLimiter, informa a ele os erros do servidor (para o backoff).
+    Com um DownloadManifest, pula arquivos inalterados e retoma downloads interrompidos
+    (ver _ftp_fetch). O arquivo final só aparece quando a transferência termina completa.
+    Retorna True em caso de sucesso (ou arquivo já atualizado), False caso contrário.
     """
     parsed_url = urlparse(file_url)
-    hostname = parsed_url.hostname
+    hostname = parsed_url.netloc # Host e porta: o limitador trata cada servidor separadamente
     path = parsed_url.path.lstrip('/') # Remove a barra inicial do path
 
-    if not hostname:
+    if not parsed_url.hostname:
         print(f"ERRO: Não foi possível extrair o hostname da URL FTP: {file_url}")
         return False
 
     try:
         print(f"Baixando via FTP de {hostname}:/{path}")
-        with FTP(hostname, timeout=60) as ftp:
-            ftp.login() # Login anônimo
+        with open_ftp(parsed_url.hostname, parsed_url.port) as ftp:
 
             remote_dir, remote_filename = os.path.split(path)
             
@@ -59,36 +585,41 @@ def download_file_from_ftp(file_url, local_filepath):
                 try:
                     ftp.cwd(remote_dir)
                     print(f"INFO: Mudou para o diretório remoto: {remote_dir}")
-                    with open(local_filepath, 'wb') as f:
-                        ftp.retrbinary(f"RETR {remote_filename}", f.write)
+                    _ftp_fetch(ftp, remote_filename, local_filepath, manifest)
                 except all_errors as e:
                     # Se falhar ao mudar de diretório, tenta baixar usando o caminho completo a partir da raiz
                     print(f"AVISO: Erro ao mudar para o diretório remoto '{remote_dir}': {e}. Tentando baixar com o caminho completo do arquivo.")
                     ftp.cwd('/') # Volta para o diretório raiz para tentar o caminho absoluto
-                    with open(local_filepath, 'wb') as f:
-                        ftp.retrbinary(f"RETR {path}", f.write)
+                    _ftp_fetch(ftp, path, local_filepath, manifest)
             else:
                 # Se não há subdiretórios no URL, baixa o arquivo diretamente
-                with open(local_filepath, 'wb') as f:
-                    ftp.retrbinary(f"RETR {remote_filename}", f.write)
+                _ftp_fetch(ftp, remote_filename, local_filepath, manifest)
 
         print(f"Download concluído: {local_filepath}")
+        _report_success(limiter, hostname)
         return True
     except all_errors as e: # Captura todos os erros da ftplib
         print(f"ERRO: FTP ao tentar baixar {file_url}: {e}")
         # Tenta identificar erro de "arquivo não encontrado"
         if "No such file" in str(e) or "550" in str(e):
             print(f"INFO: (FTP) O arquivo não existe ou não está acessível no servidor: {file_url}.")
+            _report_success(limiter, hostname) # O servidor respondeu normalmente
+        else:
+            _report_server_error(limiter, hostname)
     except IOError as e:
         print(f"ERRO: Ao escrever o arquivo '{local_filepath}': {e}")
     except Exception as e:
         print(f"ERRO: Geral no download FTP: {e}")
     return False
 
-def download_single_file(file_url, download_directory="Data"):
+def download_single_file(file_url, download_directory="Data", limiter=None, manifest=None, http=None):
     """
     Baixa um único arquivo de uma URL específica para um diretório local,
     lidando com protocolos HTTP/HTTPS e FTP.
+    limiter (opcional) é um HostRateLimiter que recebe o resultado do download.
+    manifest (opcional) é um DownloadManifest do diretório: arquivos que não mudaram no
+    servidor não são baixados de novo e downloads interrompidos são retomados.
+    http (opcional) é o HttpSession usado nas URLs HTTP/HTTPS (padrão: get_http_session()).
     Retorna True em caso de sucesso, False caso contrário.
     """
     if not file_url:
@@ -110,59 +641,359 @@ def download_single_file(file_url, download_directory="Data"):
     print(f"Salvando como: {local_filepath}")
 
     if parsed_url.scheme.lower() in ['http', 'https']:
-        return download_file_from_http(file_url, local_filepath)
+        return download_file_from_http(file_url, local_filepath, limiter=limiter, manifest=manifest, http=http)
     elif parsed_url.scheme.lower() == 'ftp':
-        return download_file_from_ftp(file_url, local_filepath)
+        return download_file_from_ftp(file_url, local_filepath, limiter=limiter, manifest=manifest)
     else:
         print(f"ERRO: Protocolo não suportado: {parsed_url.scheme} para URL: {file_url}")
         return False
 
-# --- Geração dos URLs e Loop de Download ---
-if __name__ == "__main__":
-    brazilian_states = [
-        "AC", "AL", "AP", "AM", "BA", "CE", "DF", "ES", "GO", "MA", "MT", "MS",
-        "MG", "PA", "PB", "PR", "PE", "PI", "RJ", "RN", "RS", "RO", "RR", "SC",
-        "SP", "SE", "TO"
-    ]
-    
-    # IMPORTANTE: Confirme este caminho no servidor FTP do DATASUS.
-    ftp_base_url = "ftp://ftp.datasus.gov.br/dissemin/publicos/CIHA/201101_/Dados/"
-    
-    start_year = 2011
-    end_year = 2025 
-    
-    target_folder = "D:\CODE\DATASUS\data"
+class FtpSessionPool:
+    """
+    Pool de sessões FTP persistentes (login anônimo) para um host e porta (padrão 21).
+    Cada sessão é aberta uma única vez e reutilizada para vários arquivos; no máximo
+    `size` sessões ficam abertas ao mesmo tempo.
+    """
 
-    generated_file_urls = []
-    failed_downloads = [] # Lista para armazenar URLs que falharam
+    def __init__(self, hostname, port=None, size=1, timeout=60):
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
 
-    print("Gerando URLs dos arquivos CIHA...")
+    def _connect(self):
+        print(f"INFO: Abrindo sessão FTP com {self.hostname}")
+        return open_ftp(self.hostname, self.port, timeout=self.timeout)
+
+    def _discard(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def session(self):
+        """
+        Empresta uma sessão do pool (abrindo uma nova se necessário).
+        Sessões com erro de conexão são descartadas; erros de permissão ou de arquivo
+        inexistente (5xx) não invalidam a sessão.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                ftp = self._connect()
+            try:
+                yield ftp
+            except error_perm:
+                self._idle.put(ftp)
+                raise
+            except BaseException:
+                self._discard(ftp)
+                raise
+            else:
+                self._idle.put(ftp)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                self._discard(ftp)
+
+
+def list_remote_ftp_files(ftp, remote_dir):
+    """
+    Lista os arquivos de um diretório remoto numa única requisição.
+    Usa MLSD (nomes, tamanhos e datas) e, se o servidor não o suportar, NLST (só nomes).
+    Retorna um dicionário {nome_do_arquivo: {'size': bytes ou None, 'mdtm': data ou None}}.
+    """
+    try:
+        return {
+            name: {'size': int(facts['size']) if 'size' in facts else None,
+                   'mdtm': _normalize_mdtm(facts.get('modify'))}
+            for name, facts in ftp.mlsd(remote_dir, facts=['type', 'size', 'modify'])
+            if facts.get('type', 'file') == 'file'
+        }
+    except error_perm as e:
+        print(f"INFO: MLSD indisponível ({e}). Listando com NLST.")
+        return {os.path.basename(name): {'size': None, 'mdtm': None} for name in ftp.nlst(remote_dir)}
+
+
+def download_listed_ftp(base_url, target_folder, wanted_names=None, sessions=2, limiter=None, manifest=None):
+    """
+    Baixa os arquivos de um diretório FTP usando sessões persistentes:
+    1. Lista o diretório remoto uma única vez.
+    2. Cruza a listagem com os nomes desejados (ou todos os .dbc, se wanted_names for None),
+       de modo que só arquivos existentes sejam pedidos ao servidor.
+    3. Baixa os arquivos pelas sessões do pool, sem novo login/cwd por arquivo.
+    Retorna a lista de URLs que existiam no servidor mas falharam no download. Se a
+    listagem falhar (servidor inacessível, diretório inexistente), retorna todas as URLs
+    pedidas (ou base_url, se wanted_names for None).
+    """
+    parsed_url = urlparse(base_url)
+    hostname = parsed_url.netloc # Host e porta, como chave do limitador
+    remote_dir = parsed_url.path.rstrip('/') or '/'
+    base = base_url if base_url.endswith('/') else base_url + '/'
+    if not parsed_url.hostname:
+        print(f"ERRO: Não foi possível extrair o hostname da URL FTP: {base_url}")
+        return []
+
+    os.makedirs(target_folder, exist_ok=True)
+    pool = FtpSessionPool(parsed_url.hostname, parsed_url.port, size=sessions)
+    try:
+        try:
+            with pool.session() as ftp:
+                listing = list_remote_ftp_files(ftp, remote_dir)
+                if wanted_names is None:
+                    names = sorted(name for name in listing if name.lower().endswith('.dbc'))
+                    not_found = []
+                else:
+                    names = [name for name in wanted_names if name in listing]
+                    not_found = [name for name in wanted_names if name not in listing]
+
+                # Sem MLSD, completa SIZE/MDTM apenas dos arquivos que serão baixados
+                for name in list(names):
+                    if listing[name]['size'] is None or listing[name]['mdtm'] is None:
+                        try:
+                            listing[name] = _ftp_remote_meta(ftp, f"{remote_dir}/{name}")
+                        except error_perm:
+                            # Listado, mas sem acesso (ou removido depois da listagem)
+                            names.remove(name)
+                            not_found.append(name)
+        except all_errors as e:
+            print(f"ERRO: FTP ao listar o diretório remoto {hostname}:{remote_dir}: {e}")
+            if not isinstance(e, error_perm):
+                _report_server_error(limiter, hostname)
+            # Sem a listagem, nenhum dos arquivos pedidos foi baixado
+            return [f"{base}{name}" for name in wanted_names] if wanted_names is not None else [base_url]
+
+        print(f"Listagem remota de {remote_dir}: {len(listing)} arquivos. {len(names)} serão baixados.")
+        if not_found:
+            print(f"INFO: {len(not_found)} arquivos pedidos não existem no servidor e foram ignorados.")
+        total_bytes = sum(listing[name]['size'] or 0 for name in names)
+        print(f"Total a transferir: {total_bytes / 1024 / 1024:.1f} MB")
+        print("-" * 50)
+
+        def worker(indexed_name):
+            i, name = indexed_name
+            local_filepath = os.path.join(target_folder, name)
+            remote_path = f"{remote_dir}/{name}"
+            print(f"--- Processando arquivo {i+1}/{len(names)}: {name} ---")
+            try:
+                with limiter.slot(hostname) if limiter is not None else nullcontext():
+                    with pool.session() as ftp:
+                        _ftp_fetch(ftp, remote_path, local_filepath, manifest, remote_meta=listing[name])
+                print(f"Download concluído: {local_filepath}")
+                _report_success(limiter, hostname)
+                return True
+            except all_errors as e:
+                print(f"ERRO: FTP ao tentar baixar {remote_path}: {e}")
+                if not isinstance(e, error_perm):
+                    _report_server_error(limiter, hostname)
+            except Exception as e:
+                print(f"ERRO: Geral no download FTP de {remote_path}: {e}")
+            return False
+
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            results = list(executor.map(worker, enumerate(names)))
+    finally:
+        pool.close()
+        if manifest is not None:
+            manifest.flush()
+
+    return [f"{base}{name}" for name, success in zip(names, results) if not success]
+
+
+def generate_ciha_urls(base_url, start_year, end_year, states):
+    """
+    Gera as URLs dos arquivos CIHA (CIHA<UF><AA><MM>.dbc) para o intervalo de anos e UFs.
+    """
+    generated_file_urls = []
     for year in range(start_year, end_year + 1):
         year_yy = str(year)[2:] 
         for month in range(1, 13):
             month_mm = f"{month:02d}" 
-            for state_code in brazilian_states:
+            for state_code in states:
                 file_name = f"CIHA{state_code}{year_yy}{month_mm}.dbc"
-                full_url = f"{ftp_base_url}{file_name}"
+                full_url = f"{base_url}{file_name}"
                 generated_file_urls.append(full_url)
-    print(f"Total de {len(generated_file_urls)} URLs geradas para tentar baixar.")
-    print("-" * 50)
+    return generated_file_urls
 
-    download_delay_seconds = 4
 
-    for i, file_url in enumerate(generated_file_urls):
-        print(f"--- Processando arquivo {i+1}/{len(generated_file_urls)} ---")
-        success = download_single_file(file_url, download_directory=target_folder)
+def download_serial(file_urls, target_folder, delay_seconds, manifest=None, http=None):
+    """
+    Baixa as URLs uma a uma, com um atraso fixo entre os downloads.
+    Retorna a lista de URLs que falharam.
+    """
+    failed_downloads = [] # Lista para armazenar URLs que falharam
+
+    try:
+        for i, file_url in enumerate(file_urls):
+            print(f"--- Processando arquivo {i+1}/{len(file_urls)} ---")
+            success = download_single_file(file_url, download_directory=target_folder, manifest=manifest, http=http)
         
+            if not success:
+                failed_downloads.append(file_url) # Adiciona à lista de falhas
+                print(f"AVISO: Download de {file_url} falhou. Prosseguindo para o próximo arquivo.")
+            else:
+                print(f"Download de {file_url} concluído com sucesso.")
+
+            # Adiciona um atraso entre os downloads
+            time.sleep(delay_seconds)
+            print("-" * 50)
+    finally:
+        if manifest is not None:
+            manifest.flush()
+
+    return failed_downloads
+
+
+def download_concurrent(file_urls, target_folder, workers=4, requests_per_second=1.0, max_in_flight=4,
+                        manifest=None, http=None):
+    """
+    Baixa as URLs com um pool de threads. Em vez do atraso fixo, as requisições passam
+    por um HostRateLimiter (limite de requisições por segundo e de downloads simultâneos
+    por host, com backoff quando o servidor devolve erros).
+    Retorna a lista de URLs que falharam, na ordem original.
+    """
+    limiter = HostRateLimiter(requests_per_second=requests_per_second, max_in_flight=max_in_flight)
+    total = len(file_urls)
+
+    def worker(indexed_url):
+        i, file_url = indexed_url
+        with limiter.slot(urlparse(file_url).netloc):
+            print(f"--- Processando arquivo {i+1}/{total} ---")
+            success = download_single_file(file_url, download_directory=target_folder, limiter=limiter,
+                                           manifest=manifest, http=http)
         if not success:
-            failed_downloads.append(file_url) # Adiciona à lista de falhas
             print(f"AVISO: Download de {file_url} falhou. Prosseguindo para o próximo arquivo.")
         else:
             print(f"Download de {file_url} concluído com sucesso.")
+        return success
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(worker, enumerate(file_urls)))
+    finally:
+        if manifest is not None:
+            manifest.flush()
+
+    return [file_url for file_url, success in zip(file_urls, results) if not success]
+
+
+def add_http_arguments(parser):
+    """
+    Opções da sessão HTTP (HttpSession), compartilhadas com pipeline_ciha.py.
+    """
+    parser.add_argument('--http-pool-size', type=int, default=8,
+                        help="Conexões HTTP/HTTPS persistentes por host no pool (padrão: 8).")
+    parser.add_argument('--http-chunk-kb', type=int, default=1024,
+                        help="Tamanho dos blocos lidos e gravados nos downloads HTTP, em KB (padrão: 1024).")
+    parser.add_argument('--range-parts', type=int, default=4,
+                        help="Faixas de bytes baixadas em paralelo nos arquivos grandes (padrão: 4; 1 desliga).")
+    parser.add_argument('--range-threshold-mb', type=float, default=16,
+                        help="Tamanho mínimo, em MB, para baixar um arquivo em faixas paralelas (padrão: 16).")
 
-        # Adiciona um atraso entre os downloads
-        time.sleep(download_delay_seconds)
-        print("-" * 50)
+
+def http_session_from_args(args):
+    return HttpSession(pool_size=args.http_pool_size, chunk_size=args.http_chunk_kb * 1024,
+                       range_parts=args.range_parts, range_threshold=int(args.range_threshold_mb * 1024 * 1024))
+
+
+# --- Geração dos URLs e Loop de Download ---
+BRAZILIAN_STATES = [
+    "AC", "AL", "AP", "AM", "BA", "CE", "DF", "ES", "GO", "MA", "MT", "MS",
+    "MG", "PA", "PB", "PR", "PE", "PI", "RJ", "RN", "RS", "RO", "RR", "SC",
+    "SP", "SE", "TO"
+]
+
+# IMPORTANTE: Confirme este caminho no servidor FTP do DATASUS.
+FTP_BASE_URL = "ftp://ftp.datasus.gov.br/dissemin/publicos/CIHA/201101_/Dados/"
+
+
+if __name__ == "__main__":
+    brazilian_states = BRAZILIAN_STATES
+
+    ftp_base_url = FTP_BASE_URL
+
+    start_year = 2011
+    end_year = 2025 
+    
+    target_folder = "D:\CODE\DATASUS\data"
+
+    download_delay_seconds = 4
+
+    parser = argparse.ArgumentParser(description="Baixa os arquivos .dbc do CIHA do DATASUS.")
+    parser.add_argument('--base-url', default=ftp_base_url,
+                        help="URL base (FTP ou HTTP) do diretório com os arquivos .dbc.")
+    parser.add_argument('--target-folder', default=target_folder, help="Diretório local de destino.")
+    parser.add_argument('--start-year', type=int, default=start_year)
+    parser.add_argument('--end-year', type=int, default=end_year)
+    parser.add_argument('--states', nargs='+', default=brazilian_states, help="UFs a baixar (padrão: todas).")
+    parser.add_argument('--delay', type=float, default=download_delay_seconds,
+                        help="Atraso fixo entre downloads no modo serial, em segundos.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de downloads concorrentes. Com mais de 1, usa o limitador por host no lugar do atraso fixo.")
+    parser.add_argument('--rps', type=float, default=1.0,
+                        help="Modo concorrente: máximo de requisições por segundo por host.")
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help="Modo concorrente: máximo de downloads simultâneos por host.")
+    parser.add_argument('--ftp-list', action='store_true',
+                        help="Lista o diretório FTP remoto uma vez e baixa só os arquivos existentes, "
+                             "reutilizando sessões FTP persistentes.")
+    parser.add_argument('--ftp-sessions', type=int, default=2,
+                        help="Com --ftp-list: número de sessões FTP persistentes (downloads simultâneos).")
+    parser.add_argument('--force', action='store_true',
+                        help="Baixa todos os arquivos de novo, ignorando o manifesto de downloads.")
+    add_http_arguments(parser)
+    parser.add_argument('--report', default=None, nargs='?', const='',
+                        help="Liga a instrumentação e grava o relatório JSON da execução "
+                             "(padrão do arquivo: relatorio_download.json na pasta de destino).")
+    parser.add_argument('--no-report', action='store_true', help=argparse.SUPPRESS) # Já é o padrão
+    args = parser.parse_args()
+
+    # Instrumentação dos downloads (tempo, bytes e memória por arquivo) e relatório JSON (opcional)
+    report_path = None
+    if args.report is not None and not args.no_report:
+        report_path = args.report or os.path.join(args.target_folder, 'relatorio_download.json')
+        set_instrumentation(Instrumentation(enabled=True))
+
+    # Manifesto dos arquivos já baixados: arquivos inalterados no servidor não são baixados
+    # de novo e downloads interrompidos são retomados
+    manifest = None
+    if not args.force:
+        os.makedirs(args.target_folder, exist_ok=True)
+        manifest = DownloadManifest(args.target_folder)
+
+    http = http_session_from_args(args)
+
+    print("Gerando URLs dos arquivos CIHA...")
+    generated_file_urls = generate_ciha_urls(args.base_url, args.start_year, args.end_year, args.states)
+    print(f"Total de {len(generated_file_urls)} URLs geradas para tentar baixar.")
+    print("-" * 50)
+
+    if args.ftp_list:
+        wanted_names = [os.path.basename(urlparse(file_url).path) for file_url in generated_file_urls]
+        limiter = HostRateLimiter(requests_per_second=args.rps, max_in_flight=args.ftp_sessions)
+        failed_downloads = download_listed_ftp(args.base_url, args.target_folder, wanted_names=wanted_names,
+                                               sessions=args.ftp_sessions, limiter=limiter, manifest=manifest)
+    elif args.workers > 1:
+        failed_downloads = download_concurrent(generated_file_urls, args.target_folder, workers=args.workers,
+                                               requests_per_second=args.rps, max_in_flight=args.max_in_flight,
+                                               manifest=manifest, http=http)
+    else:
+        failed_downloads = download_serial(generated_file_urls, args.target_folder, args.delay, manifest=manifest,
+                                           http=http)
+    http.close()
 
     print("Processo de download concluído.")
     if failed_downloads:
@@ -170,4 +1001,9 @@ if __name__ == "__main__":
         for failed_url in failed_downloads:
             print(f"- {failed_url}")
     else:
-        print("\nTodos os downloads foram concluídos com sucesso!")
\ No newline at end of file
+        print("\nTodos os downloads foram concluídos com sucesso!")
+
+    if report_path:
+        get_instrumentation().write_report(report_path, script='download_ciha_data', urls=len(generated_file_urls),
+                                           failed_downloads=failed_downloads)
+        print(f"Relatório da execução salvo em: {report_path}")
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+
+# Motores disponíveis para o enriquecimento e a agregação (--engine)
+ENGINE_NAMES = ('pandas', 'polars')
+
+ENRICHED_COLUMNS = ['SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA']
+
+SEXO_LABELS = {'1': 'Masculino', '3': 'Feminino', '0': 'Indefinido'}
+
+
+class DataFrameEngine:
+    """
+    Motor do caminho enriquecimento -> filtro -> agregação de process_single_dbc_file.
+    enrich() recebe os registros lidos do DBF (DataFrame pandas com SEXO, IDADE e
+    PROC_REA) e devolve os registros de diagnóstico enriquecidos, no formato do motor;
+    count() conta esses registros por ENRICHED_COLUMNS e devolve sempre um DataFrame
+    pandas com colunas categóricas + TOTAL_PROCEDIMENTOS, como count_diagnostic_frame.
+    """
+
+    name = None
+
+    def enrich(self, df, proc_rea_prefixes, classifier):
+        raise NotImplementedError
+
+    def count(self, enriched):
+        raise NotImplementedError
+
+    def num_rows(self, enriched):
+        return len(enriched)
+
+
+class PolarsEngine(DataFrameEngine):
+    """
+    Motor em Polars (colunar, sobre Arrow e com várias threads). O enriquecimento é um
+    plano lazy (filtro dos prefixos, normalização do SEXO, faixas etárias e junção com a
+    classificação dos códigos distintos do PROC_REA), executado só na contagem.
+    age_groups são as faixas (idade mínima, idade máxima, rótulo) de FAIXAS_ETARIAS.
+    """
+
+    name = 'polars'
+
+    def __init__(self, age_groups, unknown_age_label, age_categories):
+        try:
+            import polars
+        except ImportError:
+            raise ImportError("O motor 'polars' requer o pacote 'polars' (pip install polars).")
+        self.pl = polars
+        self.age_groups = age_groups
+        self.unknown_age_label = unknown_age_label
+        self.age_categories = age_categories
+
+    def _sexo_expr(self, expr):
+        # Mesma normalização do motor pandas: strip, códigos 1/3/0 e ausentes como 'Indefinido'
+        return expr.cast(self.pl.Utf8).str.strip_chars().replace(SEXO_LABELS).fill_null('Indefinido')
+
+    def _age_group_expr(self, dtype):
+        pl = self.pl
+        if dtype.is_numeric():
+            # IDADE numérica: truncada como no int() do motor pandas (45.7 -> 45); vazios ficam nulos
+            age = pl.col('IDADE').cast(pl.Int64, strict=False)
+        else:
+            # IDADE texto, como no int() do motor pandas: espaços em volta são ignorados, e
+            # '45.0' ou vazio não são idades válidas
+            age = pl.col('IDADE').cast(pl.Utf8).str.strip_chars().cast(pl.Int64, strict=False)
+        expr = pl.when(age.is_between(*self.age_groups[0][:2])).then(pl.lit(self.age_groups[0][2]))
+        for min_age, max_age, label in self.age_groups[1:]:
+            expr = expr.when(age.is_between(min_age, max_age)).then(pl.lit(label))
+        return expr.otherwise(pl.lit(self.unknown_age_label))
+
+    def enrich(self, df, proc_rea_prefixes, classifier):
+        pl = self.pl
+        frame = pl.from_pandas(df[['SEXO', 'IDADE', 'PROC_REA']], nan_to_null=True)
+        frame = frame.with_columns(pl.col('PROC_REA').cast(pl.Utf8))
+        is_diagnostic = pl.any_horizontal([pl.col('PROC_REA').str.starts_with(prefix)
+                                           for prefix in proc_rea_prefixes])
+
+        # Classificação calculada uma única vez por código distinto de diagnóstico
+        proc_codes = frame.lazy().filter(is_diagnostic).select(pl.col('PROC_REA').unique()).collect()
+        proc_codes = proc_codes.get_column('PROC_REA').to_list()
+        classified = classifier.classify(proc_codes)
+        lookup = pl.DataFrame({
+            'PROC_REA': pl.Series(proc_codes, dtype=pl.Utf8),
+            'PROC_GRU_NOME': np.array(classifier.proc_gru_nome_labels, dtype=object)[classified['proc_gru_nome']],
+            'REGIAO_CORPORAL_DETALHADA': np.array(classifier.regiao_labels, dtype=object)[classified['regiao']],
+        })
+
+        # Categorias do SEXO a partir de todos os valores do arquivo, como no motor pandas
+        sexo_categories = sorted(frame.select(self._sexo_expr(pl.col('SEXO').unique()))
+                                 .get_column('SEXO').to_list())
+
+        enriched = (frame.lazy()
+                    .filter(is_diagnostic)
+                    .join(lookup.lazy(), on='PROC_REA', how='left')
+                    .select(self._sexo_expr(pl.col('SEXO')).alias('SEXO'),
+                            self._age_group_expr(frame.schema['IDADE']).alias('FAIXA_ETARIA'),
+                            'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA'))
+        return enriched, {'SEXO': sexo_categories, 'FAIXA_ETARIA': self.age_categories,
+                          'PROC_GRU_NOME': classifier.proc_gru_nome_labels,
+                          'REGIAO_CORPORAL_DETALHADA': classifier.regiao_labels}
+
+    def count(self, enriched):
+        pl = self.pl
+        plan, categories = enriched
+        counts = (plan.group_by(ENRICHED_COLUMNS)
+                  .agg(pl.len().cast(pl.Int64).alias('TOTAL_PROCEDIMENTOS'))
+                  .collect())
+        # De volta ao formato do motor pandas: colunas categóricas e linhas na ordem dos códigos
+        data = {col: pd.Categorical(counts.get_column(col).to_list(), categories=categories[col])
+                for col in ENRICHED_COLUMNS}
+        order = np.lexsort([data[col].codes for col in reversed(ENRICHED_COLUMNS)])
+        data = {col: values[order] for col, values in data.items()}
+        data['TOTAL_PROCEDIMENTOS'] = counts.get_column('TOTAL_PROCEDIMENTOS').to_numpy()[order]
+        return pd.DataFrame(data)
+
+    def num_rows(self, enriched):
+        # O plano só é executado na contagem
+        return None
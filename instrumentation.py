@@ -0,0 +1,322 @@
+import cProfile
+import ctypes
+import ctypes.util
+import gc
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Pico de memória residente do processo atual, em MB (None se indisponível).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss é em KB no Linux e em bytes no macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def current_rss_bytes():
+    """
+    Memória residente atual do processo, em bytes (None fora do Linux).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def release_free_memory():
+    """
+    Coleta o lixo e devolve ao sistema a memória livre do heap (malloc_trim da glibc),
+    para o RSS refletir só a memória em uso.
+    """
+    gc.collect()
+    if _libc is not None:
+        _libc.malloc_trim(0)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        libc.malloc_trim # Ausente fora da glibc (ex: musl)
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+class MemorySampler:
+    """
+    Pico de memória residente durante um trecho de código, acima da memória do início
+    do trecho. Uma thread lê o RSS a cada interval segundos (picos mais curtos que isso
+    podem escapar). A memória livre que sobrou de trechos anteriores é devolvida ao
+    sistema antes da medição (release_free_memory), senão ela seria reaproveitada sem
+    aparecer no RSS. Onde o RSS atual não está disponível, usa o crescimento do
+    ru_maxrss, que só enxerga picos acima do maior pico anterior do processo.
+    peak_mb fica com o resultado ao final do bloco with.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_mb = None
+
+    def __enter__(self):
+        release_free_memory()
+        self._baseline = current_rss_bytes()
+        if self._baseline is None:
+            self._baseline_peak = peak_rss_mb()
+            return self
+        self._peak = self._baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss_bytes()
+            if rss is not None and rss > self._peak:
+                self._peak = rss
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._baseline is None:
+            if self._baseline_peak is not None:
+                self.peak_mb = round(peak_rss_mb() - self._baseline_peak, 1)
+            return False
+        self._stop.set()
+        self._thread.join()
+        self._peak = max(self._peak, current_rss_bytes() or 0)
+        self.peak_mb = round((self._peak - self._baseline) / (1024 * 1024), 1)
+        return False
+
+
+class Stage:
+    """
+    Medição de uma etapa: tempo de parede, pico de memória ao final e contadores
+    livres (rows_in, rows_out, bytes, ...). Usada como gerenciador de contexto.
+    """
+    __slots__ = ('fields', '_owner', '_start')
+
+    def __init__(self, owner, name, fields):
+        self._owner = owner
+        self.fields = dict(fields, stage=name)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fields['seconds'] = round(time.perf_counter() - self._start, 6)
+        self.fields['peak_rss_mb'] = peak_rss_mb()
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self._owner.add_record(self.fields)
+        return False
+
+    def set(self, **counters):
+        self.fields.update(counters)
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.fields[key] = self.fields.get(key, 0) + value
+
+
+class _NullStage:
+    """
+    Etapa que não mede nada: usada quando a instrumentação está desligada.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **counters):
+        pass
+
+    def add(self, **counters):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+class Instrumentation:
+    """
+    Coletor das medições de uma execução. Desligado, stage() devolve sempre o mesmo
+    objeto vazio e o custo é de uma chamada de função por etapa.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.profiles = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name, **fields):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, fields)
+
+    def timed_iter(self, iterable, name, **fields):
+        """
+        Percorre iterable medindo, como uma etapa, o tempo de produção de cada item.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, **fields) as st:
+                item = next(iterator, _END)
+                if item is not _END and hasattr(item, '__len__'):
+                    st.set(rows_out=len(item))
+            if item is _END:
+                return
+            yield item
+
+    def add_record(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records, profiles=()):
+        """
+        Incorpora as medições feitas em outro processo (ver process_ciha_data._process_files).
+        """
+        with self._lock:
+            self.records.extend(records)
+            self.profiles.extend(profiles)
+
+    def summary(self):
+        """
+        Totais por etapa: número de medições, tempo somado e soma dos contadores numéricos.
+        """
+        summary = {}
+        for record in self.records:
+            totals = summary.setdefault(record['stage'], {'count': 0, 'seconds': 0.0})
+            totals['count'] += 1
+            for key, value in record.items():
+                if key in ('stage', 'peak_rss_mb') or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                totals[key] = totals.get(key, 0) + value
+            if record.get('peak_rss_mb') is not None:
+                totals['peak_rss_mb'] = max(totals.get('peak_rss_mb', 0), record['peak_rss_mb'])
+        for totals in summary.values():
+            totals['seconds'] = round(totals['seconds'], 6)
+        return summary
+
+    def write_report(self, report_path, **extra):
+        """
+        Grava o relatório da execução em JSON (de forma atômica).
+        """
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'argv': sys.argv,
+            'total_seconds': round(time.perf_counter() - self.started, 6),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        report.update(extra)
+        report['summary'] = self.summary()
+        report['stages'] = self.records
+        if self.profiles:
+            report['profiles'] = self.profiles
+
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        tmp_path = report_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+        os.replace(tmp_path, report_path)
+        return report_path
+
+
+_END = object()
+
+# Coletor ativo no processo. Começa desligado: quem não configura nada não paga nada.
+_current = Instrumentation(enabled=False)
+
+
+def get_instrumentation():
+    return _current
+
+
+def set_instrumentation(instrumentation):
+    global _current
+    _current = instrumentation
+    return instrumentation
+
+
+def stage(name, **fields):
+    """
+    Abre uma etapa no coletor ativo. Uso:
+        with stage('leitura', file=filepath) as st:
+            ...
+            st.set(rows_out=len(df))
+    """
+    return _current.stage(name, **fields)
+
+
+def timed_iter(iterable, name, **fields):
+    return _current.timed_iter(iterable, name, **fields)
+
+
+class FileProfiler:
+    """
+    Perfil detalhado (cProfile + tracemalloc) de um trecho de código, ligado só para um
+    arquivo escolhido. Grava o .prof (legível com pstats/snakeviz) em output_path e
+    devolve um resumo serializável em JSON.
+    """
+
+    def __init__(self, name, output_path=None, top=25):
+        self.name = name
+        self.output_path = output_path
+        self.top = top
+        self.result = None
+
+    def __enter__(self):
+        tracemalloc.start()
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if self.output_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+            self._profiler.dump_stats(self.output_path)
+
+        text = io.StringIO()
+        pstats.Stats(self._profiler, stream=text).sort_stats('cumulative').print_stats(self.top)
+        self.result = {
+            'file': self.name,
+            'profile_path': self.output_path,
+            'tracemalloc_peak_mb': round(traced_peak / (1024 * 1024), 1),
+            'tracemalloc_top': [str(stat) for stat in snapshot.statistics('lineno')[:self.top]],
+            'cprofile_top': text.getvalue().splitlines(),
+        }
+        return False
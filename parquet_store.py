@@ -0,0 +1,192 @@
+import glob
+import json
+import os
+import shutil
+
+import pandas as pd
+
+
+# Colunas usadas como partição (diretórios no estilo Hive: UF_ATENDIMENTO=MG/ANO_ATENDIMENTO=16)
+PARTITION_COLUMNS = ['UF_ATENDIMENTO', 'ANO_ATENDIMENTO']
+# Colunas de dimensão, gravadas com codificação de dicionário
+DIMENSION_COLUMNS = ['SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA']
+MONTH_COLUMN = 'MES_ATENDIMENTO'
+VALUE_COLUMN = 'TOTAL_PROCEDIMENTOS'
+
+# Versão do layout das partições. Incremente ao mudar as colunas gravadas: partições de
+# uma versão anterior são regravadas mesmo que os .dbc de origem não tenham mudado.
+STORE_FORMAT_VERSION = 2
+
+# Arquivo, na raiz do dataset, com a assinatura dos .dbc que originaram cada UF (e a
+# versão dos dados, ver write_parquet_dataset)
+SOURCES_FILENAME = '_sources.json'
+PARTITION_FILENAME = 'part-0.parquet'
+
+
+def _require_pyarrow():
+    """
+    Importa o pyarrow sob demanda, para que o restante do projeto funcione sem ele.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("A saída Parquet requer o pacote 'pyarrow' (pip install pyarrow).")
+    return pyarrow
+
+
+def partition_dir(root, uf, year):
+    """
+    Diretório da partição de uma UF e de um ano dentro do dataset.
+    """
+    return os.path.join(root, f'UF_ATENDIMENTO={uf}', f'ANO_ATENDIMENTO={year}')
+
+
+def source_signature(filepaths):
+    """
+    Assinatura (nome, tamanho e mtime) de um conjunto de arquivos de origem.
+    Muda sempre que um arquivo é adicionado, removido ou alterado.
+    """
+    signature = []
+    for filepath in sorted(filepaths, key=os.path.basename):
+        stat = os.stat(filepath)
+        signature.append([os.path.basename(filepath), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _load_sources(root, data_version=None):
+    # Assinaturas gravadas por UF; vazias se o formato ou a versão dos dados mudou
+    path = os.path.join(root, SOURCES_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            sources = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if sources.pop('_format', None) != STORE_FORMAT_VERSION:
+        return {}
+    if sources.pop('_data_version', None) != data_version:
+        return {}
+    return sources
+
+
+def _save_sources(root, sources, data_version=None):
+    path = os.path.join(root, SOURCES_FILENAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(sources, _format=STORE_FORMAT_VERSION, _data_version=data_version), f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def write_partition(root, df_partition, uf, year):
+    """
+    Grava (ou regrava) uma única partição UF/ano. O arquivo é escrito num temporário
+    e renomeado, então um leitor nunca vê uma partição pela metade.
+    """
+    pa = _require_pyarrow()
+    directory = partition_dir(root, uf, year)
+    os.makedirs(directory, exist_ok=True)
+
+    data = {}
+    for col in DIMENSION_COLUMNS:
+        data[col] = df_partition[col].astype(str).astype('category')
+    data[MONTH_COLUMN] = df_partition[MONTH_COLUMN].astype('int64')
+    data[VALUE_COLUMN] = df_partition[VALUE_COLUMN].astype('int64')
+    table = pa.Table.from_pandas(pd.DataFrame(data), preserve_index=False)
+
+    path = os.path.join(directory, PARTITION_FILENAME)
+    tmp_path = path + '.tmp'
+    pa.parquet.write_table(table, tmp_path, use_dictionary=DIMENSION_COLUMNS, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def remove_uf(root, uf):
+    """
+    Remove todas as partições de uma UF.
+    """
+    shutil.rmtree(os.path.join(root, f'UF_ATENDIMENTO={uf}'), ignore_errors=True)
+
+
+def write_parquet_dataset(final_df_long, root, sources=None, data_version=None):
+    """
+    Grava o DataFrame mestre "long" como um dataset Parquet particionado por UF e ano.
+
+    sources é um dicionário {UF: [arquivos .dbc de origem]}. Com ele, só são regravadas as
+    UFs cujos arquivos de origem mudaram desde a última gravação (ou cujas partições não
+    existem); as demais partições ficam intactas. Sem sources, todas as UFs são regravadas.
+    data_version identifica as regras que geraram os totais (ex:
+    process_ciha_data.aggregate_cache_version: mapeamentos, classificador, prefixos do
+    PROC_REA e colunas do agregado); se ela mudou, todas as UFs são regravadas.
+    Retorna a lista das UFs regravadas.
+    """
+    _require_pyarrow()
+    os.makedirs(root, exist_ok=True)
+
+    ufs = sorted(final_df_long['UF_ATENDIMENTO'].unique()) if not final_df_long.empty else []
+    previous = _load_sources(root, data_version)
+    current = {uf: source_signature(files) for uf, files in sources.items()} if sources is not None else {}
+
+    changed_ufs = []
+    for uf in ufs:
+        if sources is not None and previous.get(uf) == current.get(uf) \
+                and os.path.isdir(os.path.join(root, f'UF_ATENDIMENTO={uf}')):
+            continue
+        changed_ufs.append(uf)
+
+    for uf in changed_ufs:
+        df_uf = final_df_long[final_df_long['UF_ATENDIMENTO'] == uf]
+        years = set()
+        for year, df_partition in df_uf.groupby('ANO_ATENDIMENTO', observed=True):
+            write_partition(root, df_partition, uf, year)
+            years.add(f'ANO_ATENDIMENTO={year}')
+        # Anos que deixaram de existir na UF não ficam para trás
+        uf_dir = os.path.join(root, f'UF_ATENDIMENTO={uf}')
+        for name in os.listdir(uf_dir):
+            if name not in years:
+                shutil.rmtree(os.path.join(uf_dir, name), ignore_errors=True)
+
+    # UFs que não estão mais no resultado
+    for name in os.listdir(root):
+        if name.startswith('UF_ATENDIMENTO=') and name.split('=', 1)[1] not in ufs:
+            remove_uf(root, name.split('=', 1)[1])
+
+    _save_sources(root, {uf: current.get(uf) for uf in ufs}, data_version)
+    return changed_ufs
+
+
+def read_parquet_dataset(root, ufs=None, years=None, columns=None):
+    """
+    Lê o dataset Parquet particionado. ufs e years restringem as partições lidas (as
+    demais nem são abertas) e columns restringe as colunas. Retorna um DataFrame com as
+    colunas de dimensão como categóricas.
+    """
+    pa = _require_pyarrow()
+    ds = pa.dataset
+    if columns is None:
+        columns = PARTITION_COLUMNS + [MONTH_COLUMN] + DIMENSION_COLUMNS + [VALUE_COLUMN]
+
+    # Seleciona as partições pelo nome do diretório, sem abrir os arquivos das demais
+    wanted_ufs = None if ufs is None else {str(uf) for uf in ufs}
+    wanted_years = None if years is None else {int(year) for year in years}
+    paths = []
+    for filepath in sorted(glob.glob(os.path.join(root, 'UF_ATENDIMENTO=*', 'ANO_ATENDIMENTO=*', PARTITION_FILENAME))):
+        year_dir = os.path.dirname(filepath)
+        uf = os.path.basename(os.path.dirname(year_dir)).split('=', 1)[1]
+        year = int(os.path.basename(year_dir).split('=', 1)[1])
+        if (wanted_ufs is None or uf in wanted_ufs) and (wanted_years is None or year in wanted_years):
+            paths.append(filepath)
+
+    if not paths:
+        return pd.DataFrame({col: pd.Series(dtype='int64' if col in ('ANO_ATENDIMENTO', MONTH_COLUMN, VALUE_COLUMN) else object)
+                             for col in columns})
+
+    partitioning = ds.partitioning(pa.schema([('UF_ATENDIMENTO', pa.string()),
+                                              ('ANO_ATENDIMENTO', pa.int64())]), flavor='hive')
+    dataset = ds.dataset(paths, format='parquet', partitioning=partitioning, partition_base_dir=root)
+    df = dataset.to_table(columns=list(columns)).to_pandas()
+    for col in PARTITION_COLUMNS:
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
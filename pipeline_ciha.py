@@ -0,0 +1,291 @@
+import argparse
+import glob
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from aggregate_cache import AggregateCache
+from count_accumulator import CountAccumulator
+from dbf_cache import DEFAULT_MAX_BYTES as DEFAULT_DBF_CACHE_MAX_BYTES, DbfCache
+from download_ciha_data import (BRAZILIAN_STATES, FTP_BASE_URL, DownloadManifest, HostRateLimiter,
+                                add_http_arguments, download_single_file, generate_ciha_urls, http_session_from_args)
+from engines import ENGINE_NAMES
+from instrumentation import Instrumentation, get_instrumentation, set_instrumentation, stage
+from process_ciha_data import (DEFAULT_CHUNK_SIZE, FINAL_GROUPING_COLS, PROC_REA_PREFIXES, _process_file_task,
+                               aggregate_cache_version, excelll, pool_context, write_master_outputs)
+from rollups import DEFAULT_ROLLUPS, parse_rollup_specs
+
+
+# Marca de fim da fila de arquivos baixados
+_DONE = None
+
+
+def _download_producer(file_urls, data_dir, files_queue, download_workers, limiter, manifest, failed_downloads,
+                       http=None):
+    """
+    Baixa as URLs com download_workers threads e coloca o caminho local de cada arquivo
+    baixado (ou já atualizado) na fila. files_queue é limitada: quando o processamento
+    fica para trás, put() bloqueia e os downloads esperam (backpressure).
+    Ao final, enfileira também os demais .dbc já presentes em data_dir (como em
+    main_processing_script, que processa o diretório inteiro) e a marca de fim.
+    """
+    enqueued = set()
+    lock = threading.Lock()
+
+    def enqueue(filepath):
+        with lock:
+            if filepath in enqueued:
+                return
+            enqueued.add(filepath)
+        files_queue.put(filepath)
+
+    def worker(file_url):
+        with limiter.slot(urlparse(file_url).netloc): # Mesma chave (host:porta) dos downloads
+            success = download_single_file(file_url, download_directory=data_dir, limiter=limiter,
+                                           manifest=manifest, http=http)
+        if success:
+            enqueue(os.path.join(data_dir, os.path.basename(urlparse(file_url).path)))
+        else:
+            failed_downloads.append(file_url)
+            print(f"AVISO: Download de {file_url} falhou. Prosseguindo para o próximo arquivo.")
+
+    try:
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for future in [executor.submit(worker, file_url) for file_url in file_urls]:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"  - ERRO no download: {e}", file=sys.stderr)
+        for filepath in sorted(glob.glob(os.path.join(data_dir, '*.dbc'))):
+            enqueue(filepath)
+    finally:
+        if manifest is not None:
+            manifest.flush()
+        files_queue.put(_DONE)
+
+
+def pipeline_download_and_process(file_urls, data_dir, output_file_csv_master, workers=1, download_workers=2,
+                                  queue_size=None, requests_per_second=1.0, max_in_flight=4, manifest=None,
+                                  cache_dir=None, rebuild_cache=False, cache_content_hash=False, parquet_dir=None,
+                                  rollups=None, http=None, **process_kwargs):
+    """
+    Baixa e processa os arquivos do CIHA ao mesmo tempo: cada arquivo, assim que termina
+    de ser baixado por download_single_file, entra numa fila limitada consumida por
+    workers processos de process_single_dbc_file (com workers=1, no próprio processo).
+    - Os downloads ficam no máximo queue_size arquivos (padrão: 2 * workers) à frente do
+      processamento; um novo arquivo só é retirado da fila quando há um processo livre.
+    - Arquivos com agregado válido no cache (cache_dir) não são reprocessados.
+    - A consolidação e as saídas (CSV mestre, Parquet, rollups) são as de main_processing_script
+      (write_master_outputs), sobre todos os .dbc de data_dir.
+    http (opcional) é o HttpSession dos downloads HTTP/HTTPS.
+    process_kwargs são repassados a process_single_dbc_file (chunk_size, proc_rea_prefixes,
+    classification_table). Retorna (DataFrame mestre ou None, URLs que falharam no download).
+    """
+    workers = max(1, workers)
+    queue_size = queue_size or 2 * workers
+    os.makedirs(data_dir, exist_ok=True)
+
+    cache = None
+    if cache_dir:
+        cache = AggregateCache(cache_dir,
+                               aggregate_cache_version(process_kwargs.get('proc_rea_prefixes', PROC_REA_PREFIXES),
+                                                       process_kwargs.get('classification_table')),
+                               use_content_hash=cache_content_hash, rebuild=rebuild_cache)
+
+    instrumentation = get_instrumentation()
+    task_kwargs = dict(process_kwargs, instrumented=instrumentation.enabled)
+    limiter = HostRateLimiter(requests_per_second=requests_per_second, max_in_flight=max_in_flight)
+    files_queue = queue.Queue(maxsize=queue_size)
+    failed_downloads = []
+    producer = threading.Thread(target=_download_producer, name='downloads', daemon=True,
+                                args=(file_urls, data_dir, files_queue, download_workers, limiter, manifest,
+                                      failed_downloads, http))
+
+    print(f"Pipeline: {download_workers} downloads simultâneos, {workers} processo(s), fila de {queue_size} arquivos.")
+    dbc_filepaths = []
+    results = {} # filepath -> True/False (processado com sucesso)
+    pending = {} # filepath -> future (modo paralelo)
+    free_workers = threading.Semaphore(workers)
+    accumulator = CountAccumulator(FINAL_GROUPING_COLS)
+    cache_hits = 0
+
+    def collect(filepath, df_agg, from_cache=False):
+        # Soma o agregado às contagens e o descarta (a memória não cresce com o número de arquivos)
+        results[filepath] = df_agg is not None
+        if df_agg is not None:
+            accumulator.add(df_agg)
+            if cache is not None and not from_cache:
+                cache.put(filepath, df_agg)
+
+    def collect_finished(wait=False):
+        for filepath, future in list(pending.items()):
+            if not wait and not future.done():
+                continue
+            try:
+                df_agg, records, profiles = future.result()
+                instrumentation.extend(records, profiles)
+            except Exception as e:
+                # Falha do próprio processo trabalhador (ex: processo encerrado abruptamente)
+                print(f"  - ERRO no processo trabalhador para {filepath}: {e}", file=sys.stderr)
+                df_agg = None
+            del pending[filepath]
+            collect(filepath, df_agg)
+
+    with stage('pipeline', workers=workers, download_workers=download_workers) as st:
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(process_kwargs.get('engine')))
+        producer.start()
+        try:
+            while True:
+                # Só retira um arquivo da fila quando há um processo livre
+                free_workers.acquire()
+                collect_finished()
+                filepath = files_queue.get()
+                if filepath is _DONE:
+                    break
+                dbc_filepaths.append(filepath)
+
+                df_cached = cache.get(filepath) if cache is not None else None
+                if df_cached is not None:
+                    collect(filepath, df_cached, from_cache=True)
+                    cache_hits += 1
+                    free_workers.release()
+                elif executor is None:
+                    df_agg, records, profiles = _process_file_task(filepath, **task_kwargs)
+                    instrumentation.extend(records, profiles)
+                    collect(filepath, df_agg)
+                    free_workers.release()
+                else:
+                    future = executor.submit(_process_file_task, filepath, **task_kwargs)
+                    future.add_done_callback(lambda _: free_workers.release())
+                    pending[filepath] = future
+            collect_finished(wait=True)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        producer.join()
+        st.set(files=len(dbc_filepaths), cache_hits=cache_hits, failed_downloads=len(failed_downloads))
+
+    if cache is not None:
+        with stage('cache_gravacao'):
+            cache.save()
+        print(f"Cache de agregados: {cache_hits} arquivos reaproveitados, {len(dbc_filepaths) - cache_hits} processados.")
+
+    if failed_downloads:
+        print("\n--- Links que FALHARAM no download: ---")
+        for failed_url in failed_downloads:
+            print(f"- {failed_url}")
+
+    final_df_long = write_master_outputs(dbc_filepaths, results, accumulator, output_file_csv_master, parquet_dir,
+                                         rollups, data_version=aggregate_cache_version(
+                                             process_kwargs.get('proc_rea_prefixes', PROC_REA_PREFIXES),
+                                             process_kwargs.get('classification_table')))
+    return final_df_long, failed_downloads
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Baixa e processa os arquivos .dbc do CIHA ao mesmo tempo: "
+                                                 "cada arquivo é processado assim que o download termina.")
+    parser.add_argument('--base-url', default=FTP_BASE_URL,
+                        help="URL base (FTP ou HTTP) do diretório com os arquivos .dbc.")
+    parser.add_argument('--data-dir', default=os.path.join(base_dir, 'data'),
+                        help="Diretório local dos arquivos .dbc (padrão: data).")
+    parser.add_argument('--start-year', type=int, default=2011)
+    parser.add_argument('--end-year', type=int, default=2025)
+    parser.add_argument('--states', nargs='+', default=BRAZILIAN_STATES, help="UFs a baixar (padrão: todas).")
+    parser.add_argument('--download-workers', type=int, default=2,
+                        help="Número de downloads simultâneos (padrão: 2).")
+    parser.add_argument('--rps', type=float, default=1.0,
+                        help="Máximo de requisições por segundo por host.")
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help="Máximo de downloads simultâneos por host.")
+    parser.add_argument('--force', action='store_true',
+                        help="Baixa todos os arquivos de novo, ignorando o manifesto de downloads.")
+    add_http_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos para o processamento dos arquivos (padrão: 1).")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="Máximo de arquivos baixados à espera de processamento (padrão: 2 x --workers).")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Desativa o cache de agregados e processa todos os arquivos.")
+    parser.add_argument('--chunk-size', type=int, default=None, nargs='?', const=DEFAULT_CHUNK_SIZE,
+                        help="Modo streaming do processamento (ver process_ciha_data.py).")
+    parser.add_argument('--proc-rea-prefixes', nargs='+', default=list(PROC_REA_PREFIXES),
+                        help="Prefixos do PROC_REA mantidos (padrão: 02).")
+    parser.add_argument('--classification-table', default=None,
+                        help="Tabela de referência do PROC_REA (ver process_ciha_data.py).")
+    parser.add_argument('--engine', choices=ENGINE_NAMES, default='pandas',
+                        help="Motor do enriquecimento e da agregação (ver process_ciha_data.py).")
+    parser.add_argument('--parquet-dir', default=None, nargs='?', const='',
+                        help="Grava também o dataset Parquet particionado (padrão: output/datasus_sumario_nacional_parquet).")
+    parser.add_argument('--excel-per-uf', default=None, nargs='?', const='',
+                        help="Grava um arquivo Excel por UF no lugar do consolidado (padrão: output/resumo_por_uf).")
+    parser.add_argument('--rollups', nargs='+', default=list(DEFAULT_ROLLUPS), metavar='ROLLUP',
+                        help="Agregações pré-calculadas gravadas ao lado do CSV mestre (ver process_ciha_data.py).")
+    parser.add_argument('--no-rollups', action='store_true', help="Não grava os rollups.")
+    parser.add_argument('--dbf-cache-dir', default=None, nargs='?', const='',
+                        help="Cache dos DBFs descompactados (padrão do diretório: output/cache_dbf; ver process_ciha_data.py).")
+    parser.add_argument('--dbf-cache-max-gb', type=float, default=DEFAULT_DBF_CACHE_MAX_BYTES / 1024 ** 3,
+                        help="Espaço máximo do cache de DBFs, em GB.")
+    parser.add_argument('--report', default=None, nargs='?', const='',
+                        help="Liga a instrumentação e grava o relatório JSON da execução "
+                             "(padrão do arquivo: output/relatorio_pipeline.json).")
+    parser.add_argument('--no-report', action='store_true', help=argparse.SUPPRESS) # Já é o padrão
+    args = parser.parse_args()
+
+    rollups = None
+    if not args.no_rollups:
+        try:
+            rollups = parse_rollup_specs(args.rollups, FINAL_GROUPING_COLS)
+        except ValueError as e:
+            parser.error(str(e))
+
+    report_path = None
+    if args.report is not None and not args.no_report:
+        report_path = args.report or os.path.join(base_dir, 'output', 'relatorio_pipeline.json')
+        set_instrumentation(Instrumentation(enabled=True))
+
+    manifest = None
+    if not args.force:
+        os.makedirs(args.data_dir, exist_ok=True)
+        manifest = DownloadManifest(args.data_dir)
+
+    parquet_dir = None
+    if args.parquet_dir is not None:
+        parquet_dir = args.parquet_dir or os.path.join(base_dir, 'output', 'datasus_sumario_nacional_parquet')
+
+    dbf_cache = None
+    if args.dbf_cache_dir is not None:
+        dbf_cache = DbfCache(args.dbf_cache_dir or os.path.join(base_dir, 'output', 'cache_dbf'),
+                             max_bytes=int(args.dbf_cache_max_gb * 1024 ** 3))
+
+    file_urls = generate_ciha_urls(args.base_url, args.start_year, args.end_year, args.states)
+    print(f"Total de {len(file_urls)} URLs geradas para tentar baixar.")
+
+    final_df_long, failed_downloads = pipeline_download_and_process(
+        file_urls, args.data_dir, os.path.join(base_dir, 'output', 'datasus_sumario_nacional_long.csv'),
+        workers=args.workers, download_workers=args.download_workers, queue_size=args.queue_size,
+        requests_per_second=args.rps, max_in_flight=args.max_in_flight, manifest=manifest,
+        cache_dir=None if args.no_cache else os.path.join(base_dir, 'output', 'cache_agregados'),
+        parquet_dir=parquet_dir, chunk_size=args.chunk_size, proc_rea_prefixes=tuple(args.proc_rea_prefixes),
+        classification_table=args.classification_table, engine=args.engine,
+        rollups=rollups, http=http_session_from_args(args), dbf_cache=dbf_cache)
+
+    if final_df_long is not None:
+        per_uf_dir = None
+        if args.excel_per_uf is not None:
+            per_uf_dir = args.excel_per_uf or os.path.join(base_dir, 'output', 'resumo_por_uf')
+        excelll(final_df_long, os.path.join(base_dir, 'output', 'resumo_consolidado_por_uf.xlsx'),
+                per_uf_dir=per_uf_dir, workers=args.workers)
+
+    if report_path:
+        get_instrumentation().write_report(report_path, script='pipeline_ciha', workers=args.workers,
+                                           download_workers=args.download_workers, urls=len(file_urls),
+                                           failed_downloads=failed_downloads)
+        print(f"Relatório da execução salvo em: {report_path}")
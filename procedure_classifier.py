@@ -0,0 +1,275 @@
+import csv
+import os
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from aggregate_cache import mappings_version
+
+
+# Colunas da tabela de referência (nomes das colunas do SIGTAP + colunas do projeto).
+# Linhas sem CO_PROCEDIMENTO definem grupos e subgrupos; linhas com CO_PROCEDIMENTO
+# definem a região corporal de um procedimento.
+REFERENCE_COLUMNS = [
+    'CO_GRUPO', 'NO_GRUPO', 'CO_SUB_GRUPO', 'NO_SUB_GRUPO', 'PROC_GRU_NOME', 'REGIAO_DETALHADA',
+    'CO_PROCEDIMENTO', 'NO_PROCEDIMENTO', 'REGIAO_CORPORAL_DETALHADA',
+]
+REFERENCE_DELIMITER = ';'
+
+# Versão do formato do índice compilado (.npz). Incremente ao mudar os arrays gravados.
+COMPILED_FORMAT_VERSION = 1
+
+# Rótulos padrão para códigos sem correspondência na tabela
+OUTRO_GRUPO = 'Outro Grupo'
+OUTRO_SUBGRUPO = 'Outro Subgrupo'
+OUTROS_DIAGNOSTICOS = 'Outros Diagnósticos'
+REGIAO_GERAL = 'Geral'
+OUTRA_REGIAO = 'Outra Região Diagnóstica'
+
+
+class ProcedureClassifier:
+    """
+    Classificação do PROC_REA compilada em arrays indexados por inteiros:
+      - grupo (2 primeiros dígitos): array denso de 100 posições;
+      - subgrupo e PROC_GRU_NOME (4 primeiros dígitos): arrays densos de 10.000 posições;
+      - região corporal (código de 10 dígitos): chaves int64 ordenadas + busca binária.
+    Os rótulos de cada coluna ficam em ordem lexicográfica, de modo que o índice de um
+    rótulo é o próprio código da categoria em pd.Categorical.
+    """
+
+    def __init__(self, arrays):
+        self.group_labels = [str(label) for label in arrays['group_labels']]
+        self.subgroup_labels = [str(label) for label in arrays['subgroup_labels']]
+        self.proc_gru_nome_labels = [str(label) for label in arrays['proc_gru_nome_labels']]
+        self.regiao_labels = [str(label) for label in arrays['regiao_labels']]
+        self.group_of_prefix = arrays['group_of_prefix']
+        self.subgroup_of_prefix = arrays['subgroup_of_prefix']
+        self.proc_gru_nome_of_prefix = arrays['proc_gru_nome_of_prefix']
+        self.detailed = arrays['detailed']
+        self.procedure_keys = arrays['procedure_keys']
+        self.procedure_regiao = arrays['procedure_regiao']
+        self.version = str(arrays['version'])
+
+    @classmethod
+    def from_tables(cls, groups, subgroups, procedures):
+        """
+        Compila as tabelas normalizadas:
+          groups: {'02': nome do grupo}
+          subgroups: {'0204': (nome do subgrupo, PROC_GRU_NOME ou None, região detalhada?)}
+          procedures: {'0204010012': região corporal}
+        """
+        group_labels = sorted(set(groups.values()) | {OUTRO_GRUPO})
+        subgroup_labels = sorted({name for name, _, _ in subgroups.values()} | {OUTRO_SUBGRUPO})
+        proc_gru_nome_labels = sorted({pgn for _, pgn, _ in subgroups.values() if pgn} | {OUTROS_DIAGNOSTICOS})
+        regiao_labels = sorted(set(procedures.values()) | {REGIAO_GERAL, OUTRA_REGIAO})
+
+        group_of_prefix = np.full(100, group_labels.index(OUTRO_GRUPO), dtype=np.int16)
+        for code, name in groups.items():
+            group_of_prefix[int(code)] = group_labels.index(name)
+
+        subgroup_of_prefix = np.full(10000, subgroup_labels.index(OUTRO_SUBGRUPO), dtype=np.int16)
+        proc_gru_nome_of_prefix = np.full(10000, proc_gru_nome_labels.index(OUTROS_DIAGNOSTICOS), dtype=np.int16)
+        detailed = np.zeros(len(proc_gru_nome_labels), dtype=bool)
+        for code, (name, pgn, has_detailed_region) in subgroups.items():
+            subgroup_of_prefix[int(code)] = subgroup_labels.index(name)
+            if pgn:
+                proc_gru_nome_of_prefix[int(code)] = proc_gru_nome_labels.index(pgn)
+                detailed[proc_gru_nome_labels.index(pgn)] |= bool(has_detailed_region)
+
+        procedure_codes = sorted(procedures)
+        procedure_keys = np.array([int(code) for code in procedure_codes], dtype=np.int64)
+        procedure_regiao = np.array([regiao_labels.index(procedures[code]) for code in procedure_codes], dtype=np.int16)
+
+        version = mappings_version(COMPILED_FORMAT_VERSION, groups,
+                                   {code: list(value) for code, value in subgroups.items()}, procedures)
+        return cls({
+            'group_labels': group_labels, 'subgroup_labels': subgroup_labels,
+            'proc_gru_nome_labels': proc_gru_nome_labels, 'regiao_labels': regiao_labels,
+            'group_of_prefix': group_of_prefix, 'subgroup_of_prefix': subgroup_of_prefix,
+            'proc_gru_nome_of_prefix': proc_gru_nome_of_prefix, 'detailed': detailed,
+            'procedure_keys': procedure_keys, 'procedure_regiao': procedure_regiao, 'version': version,
+        })
+
+    @classmethod
+    def from_mappings(cls, grupo_map, subgrupo_map, proc_gru_nome_map, regiao_map, detailed_proc_gru_nomes):
+        """
+        Compila a partir dos dicionários de mapeamento de process_ciha_data.
+        """
+        subgroups = subgroup_table(subgrupo_map, proc_gru_nome_map, detailed_proc_gru_nomes)
+        return cls.from_tables(dict(grupo_map), subgroups, dict(regiao_map))
+
+    @classmethod
+    def from_reference_csv(cls, csv_path):
+        """
+        Lê a tabela de referência no layout do SIGTAP (ver REFERENCE_COLUMNS) e a compila.
+        """
+        groups, subgroups, procedures = {}, {}, {}
+        with open(csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.DictReader(f, delimiter=REFERENCE_DELIMITER)
+            missing = [col for col in ('CO_GRUPO', 'CO_SUB_GRUPO', 'CO_PROCEDIMENTO') if col not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"Colunas ausentes na tabela de referência {csv_path}: {missing}")
+            for line_number, row in enumerate(reader, start=2):
+                row = {key: (value or '').strip() for key, value in row.items() if key}
+                group, subgroup, procedure = row['CO_GRUPO'], row['CO_SUB_GRUPO'], row['CO_PROCEDIMENTO']
+                if procedure:
+                    if len(procedure) != 10 or not procedure.isdigit():
+                        raise ValueError(f"{csv_path}, linha {line_number}: CO_PROCEDIMENTO inválido: '{procedure}'")
+                    group, subgroup = group or procedure[:2], subgroup or procedure[2:4]
+                    if row.get('REGIAO_CORPORAL_DETALHADA'):
+                        procedures[procedure] = row['REGIAO_CORPORAL_DETALHADA']
+                if len(group) != 2 or not group.isdigit() or (subgroup and (len(subgroup) != 2 or not subgroup.isdigit())):
+                    raise ValueError(f"{csv_path}, linha {line_number}: CO_GRUPO/CO_SUB_GRUPO inválidos.")
+                if row.get('NO_GRUPO'):
+                    groups[group] = row['NO_GRUPO']
+                if subgroup and row.get('NO_SUB_GRUPO') and not procedure:
+                    subgroups[group + subgroup] = (row['NO_SUB_GRUPO'], row.get('PROC_GRU_NOME') or None,
+                                                   row.get('REGIAO_DETALHADA', '').upper() in ('S', 'SIM', '1'))
+        return cls.from_tables(groups, subgroups, procedures)
+
+    @classmethod
+    def load(cls, csv_path, compiled_path=None):
+        """
+        Carrega a tabela de referência usando o índice compilado (.npz) gravado ao lado
+        dela, se ele ainda corresponder ao arquivo (tamanho e mtime); caso contrário,
+        lê e compila o CSV e grava o índice para as próximas execuções.
+        """
+        compiled_path = compiled_path or os.path.splitext(csv_path)[0] + '.idx.npz'
+        stat = os.stat(csv_path)
+        source_key = np.array([COMPILED_FORMAT_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if os.path.exists(compiled_path):
+            try:
+                with np.load(compiled_path, allow_pickle=False) as data:
+                    if np.array_equal(data['source_key'], source_key):
+                        return cls({key: data[key] for key in data.files})
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                # Índice truncado ou corrompido: é só recompilado
+                print(f"AVISO: Índice compilado ilegível ({e}). Recompilando {csv_path}.", file=sys.stderr)
+
+        classifier = cls.from_reference_csv(csv_path)
+        try:
+            classifier.save(compiled_path, source_key)
+        except OSError as e:
+            print(f"AVISO: Não foi possível gravar o índice compilado em {compiled_path} ({e}).", file=sys.stderr)
+        return classifier
+
+    def save(self, compiled_path, source_key):
+        # Temporário com nome único no mesmo diretório: os processos do pool podem compilar
+        # a mesma tabela ao mesmo tempo, e cada um renomeia só o próprio arquivo
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(compiled_path) + '.',
+                                        suffix='.tmp', dir=os.path.dirname(os.path.abspath(compiled_path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._write_arrays(f, source_key)
+            os.replace(tmp_path, compiled_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write_arrays(self, f, source_key):
+        np.savez(f, source_key=source_key,
+                 group_labels=np.array(self.group_labels, dtype=str),
+                 subgroup_labels=np.array(self.subgroup_labels, dtype=str),
+                 proc_gru_nome_labels=np.array(self.proc_gru_nome_labels, dtype=str),
+                 regiao_labels=np.array(self.regiao_labels, dtype=str),
+                 group_of_prefix=self.group_of_prefix, subgroup_of_prefix=self.subgroup_of_prefix,
+                 proc_gru_nome_of_prefix=self.proc_gru_nome_of_prefix, detailed=self.detailed,
+                 procedure_keys=self.procedure_keys, procedure_regiao=self.procedure_regiao,
+                 version=np.array(self.version))
+
+    def classify(self, proc_codes):
+        """
+        Classifica, numa única passada vetorizada, uma lista de códigos PROC_REA (em geral
+        os valores distintos da coluna). Retorna um dicionário com os códigos (índices
+        nos rótulos) de grupo, subgrupo, PROC_GRU_NOME e REGIAO_CORPORAL_DETALHADA.
+        """
+        codes = pd.Series(proc_codes, dtype=object).astype(str)
+
+        # Grupo e subgrupo pelos primeiros dígitos (o código não precisa ter 10 dígitos)
+        prefix2 = _digits_to_int(codes.str[:2], 2)
+        prefix4 = _digits_to_int(codes.str[:4], 4)
+        group = np.where(prefix2 >= 0, self.group_of_prefix[np.maximum(prefix2, 0)],
+                         self.group_labels.index(OUTRO_GRUPO))
+        subgroup = np.where(prefix4 >= 0, self.subgroup_of_prefix[np.maximum(prefix4, 0)],
+                            self.subgroup_labels.index(OUTRO_SUBGRUPO))
+        proc_gru_nome = np.where(prefix4 >= 0, self.proc_gru_nome_of_prefix[np.maximum(prefix4, 0)],
+                                 self.proc_gru_nome_labels.index(OUTROS_DIAGNOSTICOS))
+
+        # Região pelo código completo, por busca binária nas chaves ordenadas
+        keys = _digits_to_int(codes.str.strip(), 10)
+        positions = np.minimum(np.searchsorted(self.procedure_keys, keys), max(len(self.procedure_keys) - 1, 0))
+        if len(self.procedure_keys):
+            found = (keys >= 0) & (self.procedure_keys[positions] == keys)
+            regiao = np.where(found, self.procedure_regiao[positions], self.regiao_labels.index(OUTRA_REGIAO))
+        else:
+            regiao = np.full(len(codes), self.regiao_labels.index(OUTRA_REGIAO))
+        regiao = np.where(self.detailed[proc_gru_nome], regiao, self.regiao_labels.index(REGIAO_GERAL))
+
+        return {
+            'group': group.astype(np.int16),
+            'subgroup': subgroup.astype(np.int16),
+            'proc_gru_nome': proc_gru_nome.astype(np.int16),
+            'regiao': regiao.astype(np.int16),
+        }
+
+
+def subgroup_table(subgrupo_map, proc_gru_nome_map, detailed_proc_gru_nomes):
+    """
+    Converte SUBGRUPO_MAP ({'02': {'04': nome}}) e PROC_GRU_NOME_MAP ({nome: 'RX'}) na
+    tabela normalizada de subgrupos de ProcedureClassifier.from_tables.
+    """
+    subgroups = {}
+    for group, group_subgroups in subgrupo_map.items():
+        for subgroup, name in group_subgroups.items():
+            pgn = proc_gru_nome_map.get(name)
+            subgroups[group + subgroup] = (name, pgn, pgn in detailed_proc_gru_nomes)
+    return subgroups
+
+
+def _digits_to_int(strings, width):
+    # Converte strings de exatamente `width` dígitos em int64; as demais viram -1
+    valid = strings.str.fullmatch(r'\d{%d}' % width, na=False).to_numpy(dtype=bool)
+    values = np.full(len(strings), -1, dtype=np.int64)
+    if valid.any():
+        values[valid] = strings[valid].astype(np.int64).to_numpy()
+    return values
+
+
+def write_reference_csv(csv_path, groups, subgroups, procedures, procedure_names=None):
+    """
+    Grava tabelas normalizadas (ver ProcedureClassifier.from_tables) no layout da tabela
+    de referência: uma linha por grupo, uma por subgrupo e uma por procedimento.
+    """
+    procedure_names = procedure_names or {}
+    os.makedirs(os.path.dirname(os.path.abspath(csv_path)), exist_ok=True)
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REFERENCE_COLUMNS, delimiter=REFERENCE_DELIMITER)
+        writer.writeheader()
+        for group, name in sorted(groups.items()):
+            writer.writerow({'CO_GRUPO': group, 'NO_GRUPO': name})
+        for code, (name, pgn, has_detailed_region) in sorted(subgroups.items()):
+            writer.writerow({'CO_GRUPO': code[:2], 'CO_SUB_GRUPO': code[2:], 'NO_SUB_GRUPO': name,
+                             'PROC_GRU_NOME': pgn or '', 'REGIAO_DETALHADA': 'S' if has_detailed_region else 'N'})
+        for code, regiao in sorted(procedures.items()):
+            writer.writerow({'CO_GRUPO': code[:2], 'CO_SUB_GRUPO': code[2:4], 'CO_PROCEDIMENTO': code,
+                             'NO_PROCEDIMENTO': procedure_names.get(code, ''), 'REGIAO_CORPORAL_DETALHADA': regiao})
+
+
+# Classificadores já carregados neste processo, por caminho da tabela de referência
+_loaded = {}
+
+
+def load_classifier(csv_path):
+    """
+    Classificador da tabela de referência csv_path, carregado uma vez por processo
+    (os processos do pool reaproveitam o índice compilado gravado ao lado do CSV).
+    """
+    key = os.path.abspath(csv_path)
+    if key not in _loaded:
+        _loaded[key] = ProcedureClassifier.load(key)
+    return _loaded[key]
@@ -1,8 +1,32 @@
+import numpy as np
 import pandas as pd
 import os, sys
 import glob
+import argparse
+import itertools
+import zlib
+import collections
+import contextlib
+import multiprocessing
+import xlsxwriter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 
+from aggregate_cache import AggregateCache, mappings_version
+from count_accumulator import CountAccumulator
+from instrumentation import (FileProfiler, Instrumentation, MemorySampler, get_instrumentation, set_instrumentation, stage,
+                             timed_iter)
+from parquet_store import write_parquet_dataset
+from rollups import DEFAULT_ROLLUPS, materialize_rollups, parse_rollup_specs, write_rollups
+from scheduler import MemoryBudget, estimate_file_memory, memory_calibration, print_memory_calibration, schedule_files
+from preview import (CI_UPPER_COLUMN, DEFAULT_FILES_PER_STRATUM, DEFAULT_RECORD_FRACTION, estimate_totals, preview_path,
+                     relative_margin_summary, select_preview_files, write_preview_metadata)
+from dbf_cache import DEFAULT_MAX_BYTES as DEFAULT_DBF_CACHE_MAX_BYTES, DbfCache
+from engines import ENGINE_NAMES, DataFrameEngine, PolarsEngine
+from dbf_reader import RecordSample, UnsupportedFieldError, iter_dbf_column_chunks, read_dbf_columns
+from procedure_classifier import (OUTRA_REGIAO, OUTRO_SUBGRUPO, OUTROS_DIAGNOSTICOS, REGIAO_GERAL,
+                                  ProcedureClassifier, load_classifier, subgroup_table, write_reference_csv)
+
 # Importe o seu módulo C compilado
 try:
     from datasus import read_dbc
@@ -183,6 +207,80 @@ PROC_REA_TO_REGIAO_MAP = {
 }
 
 
+# Colunas do DBF efetivamente usadas pelo pipeline. Apenas elas são decodificadas.
+DBF_COLUMNS = ['SEXO', 'IDADE', 'PROC_REA']
+
+# Tamanho padrão do bloco (em registros) no modo streaming
+DEFAULT_CHUNK_SIZE = 200000
+
+
+# Faixas etárias (idade mínima, idade máxima, rótulo), em ordem crescente e sem lacunas
+FAIXAS_ETARIAS = [
+    (0, 4, '0-4'), (5, 9, '5-9'), (10, 14, '10-14'), (15, 19, '15-19'),
+    (20, 29, '20-29'), (30, 39, '30-39'), (40, 49, '40-49'), (50, 59, '50-59'),
+    (60, 69, '60-69'), (70, 79, '70-79'), (80, 200, '80+') # 200 para garantir que pegue idades muito avançadas
+]
+
+# Rótulos padrão para valores sem correspondência nos mapeamentos
+# (os rótulos do PROC_REA ficam em procedure_classifier)
+IDADE_DESCONHECIDA = 'Idade Desconhecida'
+
+# Procedimentos que recebem a região corporal detalhada
+PROCS_WITH_DETAILED_REGIONS = ['RM', 'TC', 'RX']
+
+# Prefixos do PROC_REA mantidos pelo pipeline. O padrão é o grupo
+# '02 - Procedimentos com finalidade diagnóstica'; pode incluir outros grupos (ex: '03')
+# ou prefixos mais longos (ex: '0204' para apenas radiologia).
+PROC_REA_PREFIXES = ('02',)
+
+# Categorias fixas das colunas derivadas, em ordem lexicográfica para que o groupby
+# sobre os códigos produza a mesma ordem de linhas do groupby sobre strings.
+# (as categorias do PROC_GRU_NOME e da região são os rótulos do classificador)
+FAIXA_ETARIA_CATEGORIES = sorted([label for _, _, label in FAIXAS_ETARIAS] + [IDADE_DESCONHECIDA])
+
+# Classificador do PROC_REA compilado a partir dos dicionários acima. Uma tabela de
+# referência externa (--classification-table, layout do SIGTAP) pode substituí-lo.
+DEFAULT_CLASSIFIER = ProcedureClassifier.from_mappings(GRUPO_MAP, SUBGRUPO_MAP, PROC_GRU_NOME_MAP,
+                                                       PROC_REA_TO_REGIAO_MAP, PROCS_WITH_DETAILED_REGIONS)
+
+
+# Versão do formato do DataFrame agregado por arquivo. Incremente sempre que as regras
+# de process_single_dbc_file mudarem de forma que altere o resultado, para invalidar o
+# cache de agregados junto com a mudança.
+AGGREGATE_SCHEMA_VERSION = 2
+
+# Dimensões do DataFrame mestre "long" (a soma de TOTAL_PROCEDIMENTOS é feita por elas)
+FINAL_GROUPING_COLS = [
+    'UF_ATENDIMENTO',
+    'ANO_ATENDIMENTO',
+    'MES_ATENDIMENTO',
+    'SEXO',
+    'FAIXA_ETARIA',
+    'PROC_GRU_NOME',
+    'REGIAO_CORPORAL_DETALHADA'
+]
+
+
+def get_classifier(classification_table=None):
+    """
+    Classificador do PROC_REA: o da tabela de referência classification_table (carregado
+    uma vez por processo) ou, sem tabela, o compilado dos dicionários de mapeamento.
+    """
+    if classification_table:
+        return load_classifier(classification_table)
+    return DEFAULT_CLASSIFIER
+
+
+def aggregate_cache_version(proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None):
+    """
+    Versão usada para validar o cache de agregados: combina a versão do classificador
+    (hash das tabelas de mapeamento), os prefixos do PROC_REA filtrados e a versão do
+    formato do agregado.
+    """
+    return mappings_version(get_classifier(classification_table).version,
+                            sorted(proc_rea_prefixes), AGGREGATE_SCHEMA_VERSION)
+
+
 # --- Funções Auxiliares (Mesmas que a estrutura inicial) ---
 
 def calculate_age_group(age_value):
@@ -191,35 +289,326 @@ def calculate_age_group(age_value):
     age_value deve ser um número inteiro ou conversível para tal.
     Retorna a faixa etária como string ou 'Idade Desconhecida'.
     """
-    faixas_etarias = [
-        (0, 4, '0-4'), (5, 9, '5-9'), (10, 14, '10-14'), (15, 19, '15-19'),
-        (20, 29, '20-29'), (30, 39, '30-39'), (40, 49, '40-49'), (50, 59, '50-59'),
-        (60, 69, '60-69'), (70, 79, '70-79'), (80, 200, '80+') # 200 para garantir que pegue idades muito avançadas
-    ]
-
     try:
         age = int(age_value) # Tenta converter a idade para inteiro
         
-        for min_age, max_age, label in faixas_etarias:
+        for min_age, max_age, label in FAIXAS_ETARIAS:
             if min_age <= age <= max_age:
                 return label
         
         # Se a idade estiver fora das faixas definidas (ex: negativa ou muito alta)
-        return 'Idade Desconhecida' 
+        return IDADE_DESCONHECIDA
     except (ValueError, TypeError):
         # Captura erros se age_value não for um número válido
-        return 'Idade Desconhecida'
+        return IDADE_DESCONHECIDA
+
+
+def _as_string_categorical(series):
+    """
+    Garante uma Series categórica de strings. As colunas vindas do leitor por colunas já
+    são categóricas; as demais passam por astype(str), como no processamento original.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    return series.astype(str).astype('category')
+
+
+def _recode(codes, labels, categories):
+    """
+    Monta um Categorical com as categorias `categories` a partir dos códigos de cada linha
+    em um Categorical de origem e do rótulo (`labels`) de cada categoria de origem.
+    """
+    label_codes = pd.Categorical(labels, categories=categories).codes
+    return pd.Categorical.from_codes(label_codes[codes], categories=categories)
+
+
+def _age_group_codes(age_values):
+    """
+    Converte valores de idade (os valores distintos da coluna IDADE) em códigos de
+    FAIXA_ETARIA_CATEGORIES, por busca binária nos limites das faixas.
+    """
+    if pd.api.types.is_numeric_dtype(age_values):
+        # IDADE numérica (campo 'N' do DBF): int() trunca 45.7 e 45.0 em 45; vazios (NaN) são inválidos
+        numeric = pd.to_numeric(np.asarray(age_values), errors='coerce').astype(np.float64)
+        valid = np.isfinite(numeric) & (np.abs(numeric) < 2 ** 62)
+        ages = np.where(valid, np.trunc(np.where(valid, numeric, 0)), -1).astype(np.int64)
+    else:
+        ages = np.full(len(age_values), -1, dtype=np.int64)
+        valid = np.zeros(len(age_values), dtype=bool)
+        for i, value in enumerate(age_values):
+            try:
+                ages[i] = int(value)
+                valid[i] = True
+            except (ValueError, TypeError):
+                pass
+
+    lower_bounds = np.array([min_age for min_age, _, _ in FAIXAS_ETARIAS])
+    bins = np.searchsorted(lower_bounds, ages, side='right') - 1
+    valid &= (bins >= 0) & (ages <= FAIXAS_ETARIAS[-1][1])
+
+    labels = np.array([label for _, _, label in FAIXAS_ETARIAS] + [IDADE_DESCONHECIDA], dtype=object)
+    bins[~valid] = len(FAIXAS_ETARIAS)
+    return pd.Categorical(labels[bins], categories=FAIXA_ETARIA_CATEGORIES).codes
+
+
+def enrich_diagnostic_frame(df, proc_rea_prefixes=PROC_REA_PREFIXES, classifier=None):
+    """
+    Enriquecimento vetorizado dos registros de um arquivo:
+    normaliza SEXO, filtra os PROC_REA que começam com proc_rea_prefixes (padrão: grupo '02'),
+    classifica PROC_GRU_NOME e
+    REGIAO_CORPORAL_DETALHADA (com classifier, padrão: DEFAULT_CLASSIFIER) e calcula FAIXA_ETARIA.
+    Cada regra é aplicada uma única vez por valor distinto (categoria) e o resultado é
+    propagado às linhas pelos códigos inteiros. Retorna um DataFrame só com as linhas de
+    diagnóstico e as colunas derivadas como pd.Categorical.
+    """
+    classifier = classifier or DEFAULT_CLASSIFIER
+    # Normalizar SEXO
+    sexo = _as_string_categorical(df['SEXO'])
+    sexo_labels = (pd.Series(sexo.cat.categories, dtype=object).str.strip()
+                   .replace({'1': 'Masculino', '3': 'Feminino', '0': 'Indefinido'}).fillna('Indefinido'))
+    sexo_categories = sorted(set(sexo_labels))
+
+    # Classificação do PROC_REA, calculada sobre os códigos distintos numa única passada
+    proc_rea = _as_string_categorical(df['PROC_REA'])
+    proc_codes = pd.Series(proc_rea.cat.categories, dtype=object)
+    classified = classifier.classify(proc_codes)
+
+    # Filtrar o DataFrame para o grupo '02 - Procedimentos com finalidade diagnóstica'
+    # (ou os prefixos configurados)
+    is_diagnostic = proc_codes.str.startswith(tuple(proc_rea_prefixes)).to_numpy(dtype=bool)
+    row_proc_codes = proc_rea.cat.codes.to_numpy()
+    mask = is_diagnostic[row_proc_codes] & (row_proc_codes >= 0)
+    row_proc_codes = row_proc_codes[mask]
+
+    idade = df['IDADE']
+    if isinstance(idade.dtype, pd.CategoricalDtype) or not pd.api.types.is_numeric_dtype(idade.dtype):
+        idade = _as_string_categorical(idade)
+    else:
+        idade = idade.astype('category') # Sem astype(str), que transformaria 45.0 em '45.0'
+    # Código extra no fim para as linhas sem categoria (IDADE vazia, código -1)
+    faixa_codes = np.append(_age_group_codes(idade.cat.categories),
+                            FAIXA_ETARIA_CATEGORIES.index(IDADE_DESCONHECIDA))
+
+    return pd.DataFrame({
+        'SEXO': _recode(sexo.cat.codes.to_numpy()[mask], sexo_labels.to_numpy(), sexo_categories),
+        'FAIXA_ETARIA': pd.Categorical.from_codes(faixa_codes[idade.cat.codes.to_numpy()[mask]],
+                                                  categories=FAIXA_ETARIA_CATEGORIES),
+        'PROC_GRU_NOME': pd.Categorical.from_codes(classified['proc_gru_nome'][row_proc_codes],
+                                                   categories=classifier.proc_gru_nome_labels),
+        'REGIAO_CORPORAL_DETALHADA': pd.Categorical.from_codes(classified['regiao'][row_proc_codes],
+                                                               categories=classifier.regiao_labels),
+    })
+
+
+def decompress_dbc(filepath, encoding='cp850', dbf_cache=None):
+    """
+    Descompacta um arquivo .dbc com read_dbc. Com dbf_cache (um DbfCache), usa o DBF
+    descompactado em cache, se houver, e guarda no cache os DBFs descompactados.
+    Retorna (caminho do DBF ou None, objeto de read_dbc ou None, mapeável), onde
+    mapeável indica um DBF do cache, que pode ser lido com mmap (ver dbf_reader).
+    """
+    if dbf_cache is not None:
+        cached_path = dbf_cache.get(filepath)
+        if cached_path is not None:
+            return cached_path, None, True
+
+    with stage('descompactacao', file=os.path.basename(filepath)) as st:
+        dbf_object = read_dbc(filepath, encoding)
+        dbf_path = getattr(dbf_object, 'filename', None)
+        if not (dbf_path and os.path.exists(dbf_path)):
+            dbf_path = None
+        cached_path = None
+        if dbf_cache is not None and dbf_path is not None:
+            cached_path = dbf_cache.put(filepath, dbf_path)
+        st.set(bytes_in=os.path.getsize(filepath), dbf_cached=cached_path is not None)
+    if cached_path is not None:
+        return cached_path, dbf_object, True
+    return dbf_path, dbf_object, False
+
+
+def read_dbc_columns(filepath, columns, encoding='cp850', row_filter=None, dbf_cache=None, row_sample=None):
+    """
+    Descompacta um arquivo .dbc e lê apenas as colunas pedidas.
+    O DBF descompactado é lido direto do disco para arrays tipados (ver dbf_reader),
+    sem montar um dicionário por registro. row_filter ({coluna: prefixos}) descarta os
+    registros que não casam antes da decodificação. Se o objeto retornado por read_dbc não
+    expuser o caminho do DBF, ou o DBF tiver campos de tipo não suportado, usa os registros
+    do próprio objeto (sem o filtro antecipado; o enriquecimento filtra depois).
+    Com dbf_cache, o DBF vem do cache de DBFs descompactados e é lido com mmap.
+    Com row_sample (um RecordSample), só uma amostra aleatória dos registros é lida.
+    """
+    filename = os.path.basename(filepath)
+    dbf_path, dbf_object, mapped = decompress_dbc(filepath, encoding, dbf_cache)
+
+    with stage('leitura', file=filename) as st:
+        df = None
+        if dbf_path:
+            st.set(bytes_in=os.path.getsize(dbf_path), mmap=mapped)
+            try:
+                df = read_dbf_columns(dbf_path, columns, encoding, row_filter, use_mmap=mapped, row_sample=row_sample)
+            except UnsupportedFieldError as e:
+                print(f"  - AVISO: Leitura por colunas indisponível para {filepath} ({e}). Lendo registros completos.")
+        if df is None:
+            if dbf_object is None:
+                dbf_object = read_dbc(filepath, encoding)
+            df = pd.DataFrame(list(dbf_object.records))[columns]
+            if row_sample is not None:
+                df = df[row_sample.mask(len(df))]
+        st.set(rows_out=len(df))
+    return df
+
+
+def read_dbc_column_chunks(filepath, columns, encoding='cp850', chunk_size=DEFAULT_CHUNK_SIZE, row_filter=None,
+                           dbf_cache=None, row_sample=None):
+    """
+    Como read_dbc_columns, mas gera DataFrames de no máximo chunk_size registros.
+    Com columns=None, gera blocos com os registros completos.
+    """
+    filename = os.path.basename(filepath)
+    dbf_path, dbf_object, mapped = decompress_dbc(filepath, encoding, dbf_cache)
+
+    if columns is not None and dbf_path:
+        try:
+            yield from timed_iter(iter_dbf_column_chunks(dbf_path, columns, encoding, chunk_size, row_filter,
+                                                         use_mmap=mapped, row_sample=row_sample),
+                                  'leitura', file=filename)
+            return
+        except UnsupportedFieldError as e:
+            print(f"  - AVISO: Leitura por colunas indisponível para {filepath} ({e}). Lendo registros completos.")
+
+    if dbf_object is None:
+        dbf_object = read_dbc(filepath, encoding)
+    records = iter(dbf_object.records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        df_chunk = pd.DataFrame(chunk)
+        if row_sample is not None:
+            df_chunk = df_chunk[row_sample.mask(len(df_chunk))]
+        yield df_chunk[columns] if columns is not None else df_chunk
+
+
+def count_diagnostic_frame(df_diagnostic):
+    """
+    Conta os procedimentos de um DataFrame enriquecido por SEXO, FAIXA_ETARIA,
+    PROC_GRU_NOME e REGIAO_CORPORAL_DETALHADA. O groupby roda sobre os códigos das
+    colunas categóricas.
+    """
+    grouping_cols = [
+        'SEXO',
+        'FAIXA_ETARIA',
+        'PROC_GRU_NOME',
+        'REGIAO_CORPORAL_DETALHADA'
+    ]
+    return df_diagnostic.groupby(grouping_cols, observed=True).size().reset_index(name='TOTAL_PROCEDIMENTOS')
+
+
+def merge_counts(df_counts, df_partial):
+    """
+    Soma uma tabela de contagens parcial à tabela acumulada (modo streaming).
+    As duas tabelas têm no máximo uma linha por combinação de dimensões, então o
+    resultado continua pequeno qualquer que seja o tamanho do arquivo.
+    """
+    grouping_cols = [col for col in df_counts.columns if col != 'TOTAL_PROCEDIMENTOS']
+    merged = pd.concat([df_counts, df_partial], ignore_index=True)
+    return merged.groupby(grouping_cols, observed=True)['TOTAL_PROCEDIMENTOS'].sum().reset_index()
+
+
+def pool_context(engine=None):
+    """
+    Contexto de multiprocessing dos pools de processos. Com o motor polars, os processos
+    são criados com 'spawn': um fork depois que o pool de threads do Polars foi iniciado
+    pode travar o processo filho.
+    """
+    return multiprocessing.get_context('spawn') if engine == 'polars' else None
+
+
+class PandasEngine(DataFrameEngine):
+    """
+    Motor padrão: enrich_diagnostic_frame + count_diagnostic_frame, em pandas.
+    """
+
+    name = 'pandas'
+
+    def enrich(self, df, proc_rea_prefixes, classifier):
+        return enrich_diagnostic_frame(df, proc_rea_prefixes, classifier)
+
+    def count(self, enriched):
+        return count_diagnostic_frame(enriched)
+
+
+_engines = {}
+
+
+def get_engine(name='pandas'):
+    """
+    Motor do enriquecimento e da agregação pelo nome (ver ENGINE_NAMES), criado uma vez
+    por processo.
+    """
+    if name not in _engines:
+        if name == 'pandas':
+            _engines[name] = PandasEngine()
+        elif name == 'polars':
+            _engines[name] = PolarsEngine(FAIXAS_ETARIAS, IDADE_DESCONHECIDA, FAIXA_ETARIA_CATEGORIES)
+        else:
+            raise ValueError(f"Motor desconhecido '{name}'. Use um de {ENGINE_NAMES}.")
+    return _engines[name]
+
+
+def _enrich_and_count(df, proc_rea_prefixes, filename, classifier=None, engine=None):
+    # Enriquecimento + contagem de um DataFrame (ou bloco), medidos como etapas separadas
+    engine = engine or get_engine()
+    classifier = classifier or DEFAULT_CLASSIFIER
+    with stage('enriquecimento', file=filename, engine=engine.name) as st:
+        enriched = engine.enrich(df, proc_rea_prefixes, classifier)
+        st.set(rows_in=len(df), rows_out=engine.num_rows(enriched))
+    with stage('agregacao', file=filename, engine=engine.name) as st:
+        df_counts = engine.count(enriched)
+        st.set(rows_in=engine.num_rows(enriched), rows_out=len(df_counts))
+    return df_counts
+
+
+def uf_from_filename(filepath):
+    """
+    UF de um arquivo do CIHA a partir do nome (ex: CIHAMG1605.dbc -> 'MG').
+    """
+    return os.path.basename(filepath).split('.')[0][4:6]
 
 
-def process_single_dbc_file(filepath, encoding='cp850'):
+def stratum_from_filename(filepath):
+    """
+    Estrato (UF, ano) de um arquivo do CIHA, usado no sorteio do modo prévia
+    (ex: CIHAMG1605.dbc -> ('MG', 16)).
+    """
+    return uf_from_filename(filepath), int(os.path.basename(filepath).split('.')[0][6:8])
+
+
+def process_single_dbc_file(filepath, encoding='cp850', columns=DBF_COLUMNS, chunk_size=None,
+                            proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None, dbf_cache=None,
+                            engine='pandas', sample_fraction=None, sample_seed=0):
     """
     Processa um único arquivo .dbc:
-    1. Descompacta e lê o DBF em um DataFrame Pandas.
+    1. Descompacta e lê o DBF em um DataFrame Pandas (apenas as colunas em `columns`;
+       com columns=None, lê os registros completos).
+       Com chunk_size, roda em modo streaming: os registros são lidos em blocos de
+       chunk_size, cada bloco é enriquecido e agregado e as contagens são somadas a uma
+       tabela acumulada, sem manter o arquivo inteiro em memória.
+       Com dbf_cache (um DbfCache), o DBF descompactado é guardado em cache e, nas
+       execuções seguintes, lido com mmap direto do cache, sem descompactar de novo.
     2. Adiciona colunas de UF, Ano e Mês (extraídas do nome do arquivo).
-    3. Enriquece os dados com NOME_GRUPO, NOME_SUB_GRUPO, PROC_GRU_NOME, REGIAO_CORPORAL_DETALHADA.
+    3. Enriquece os dados com NOME_GRUPO, NOME_SUB_GRUPO, PROC_GRU_NOME, REGIAO_CORPORAL_DETALHADA
+       (pelos dicionários de mapeamento ou pela tabela de referência classification_table).
     4. Cria a coluna FAIXA_ETARIA (usando a coluna 'IDADE' existente).
-    5. Filtra para procedimentos de diagnóstico (Grupo 02).
+    5. Filtra para procedimentos de diagnóstico (Grupo 02, ou os prefixos em proc_rea_prefixes).
+       Na leitura por colunas, o filtro é aplicado aos bytes brutos do PROC_REA, antes da
+       decodificação dos registros.
     6. Agrega os dados por todas as dimensões especificadas (formato "long").
+    Os passos 3 a 6 rodam no motor engine ('pandas' ou 'polars', ver engines.py); os dois
+    motores produzem as mesmas contagens.
+    Com sample_fraction (modo prévia, ver preview.py), só uma amostra aleatória dessa
+    fração dos registros é lida, e as contagens são as da amostra (sem expansão). A
+    amostra depende só de sample_seed e do nome do arquivo.
     Retorna um DataFrame agregado para o arquivo ou None em caso de erro.
     """
     # 0. VERIFICAR TAMANHO DO ARQUIVO
@@ -228,7 +617,7 @@ def process_single_dbc_file(filepath, encoding='cp850'):
         if file_size == 0:
             print(f"  - ALERTA: Arquivo {filepath} vazio.")
             # Retorna um DataFrame vazio com as colunas esperadas
-            return pd.DataFrame(columns=['UF_ATENDIMENTO', 'ANO_ATENDIMENTO', 'SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA', 'TOTAL_PROCEDIMENTOS'])
+            return pd.DataFrame(columns=FINAL_GROUPING_COLS + ['TOTAL_PROCEDIMENTOS'])
     except FileNotFoundError:
         print(f"  - ERRO: Arquivo {filepath} não encontrado. Pulando.", file=sys.stderr)
         return None
@@ -240,68 +629,57 @@ def process_single_dbc_file(filepath, encoding='cp850'):
         print(f"Iniciando processamento de: {filepath}")
         # Extrair UF, Ano e Mês do nome do arquivo (ex: SP202301.dbc)
         filename_parts = os.path.basename(filepath).split('.')[0]
-        uf = filename_parts[4:6]
+        uf = uf_from_filename(filepath)
         ano_atendimento = int(filename_parts[6:8])
-        # mes_atendimento = int(filename_parts[8:10]) # Mês não é usado na agregação final
+        mes_atendimento = int(filename_parts[8:10])
 
         # 1. Descompactar e ler o DBF
-        dbf_object = read_dbc(filepath, encoding)
-        df = pd.DataFrame(list(dbf_object.records)) 
-
-        # Adicionar metadados do arquivo
-        df['UF_ATENDIMENTO'] = uf
-        df['ANO_ATENDIMENTO'] = ano_atendimento
-
-        # Normalizar SEXO
-        df['SEXO'] = df['SEXO'].astype(str).str.strip().replace({'1': 'Masculino', '3': 'Feminino', '0': 'Indefinido'})
-        df['SEXO'] = df['SEXO'].fillna('Indefinido')
+        # 2. Normalizar SEXO, filtrar o grupo '02' e enriquecer (vetorizado, colunas categóricas)
+        # 3. FAIXA_ETARIA é calculada a partir da coluna 'IDADE' dentro do enriquecimento
+        # 4. Agregação dos dados (formato "long")
+        row_filter = {'PROC_REA': proc_rea_prefixes}
+        filename = os.path.basename(filepath)
+        classifier = get_classifier(classification_table)
+        engine = get_engine(engine)
+        row_sample = None
+        if sample_fraction is not None:
+            row_sample = RecordSample(sample_fraction, seed=[sample_seed, zlib.crc32(filename.encode('utf-8'))])
+        if chunk_size:
+            df_aggregated_long = None
+            for df_chunk in read_dbc_column_chunks(filepath, columns, encoding, chunk_size, row_filter, dbf_cache,
+                                                   row_sample):
+                df_partial = _enrich_and_count(df_chunk, proc_rea_prefixes, filename, classifier, engine)
+                del df_chunk
+                if df_aggregated_long is None:
+                    df_aggregated_long = df_partial
+                else:
+                    with stage('agregacao', file=filename) as st:
+                        df_aggregated_long = merge_counts(df_aggregated_long, df_partial)
+                        st.set(rows_out=len(df_aggregated_long))
+        else:
+            if columns is not None:
+                df = read_dbc_columns(filepath, columns, encoding, row_filter, dbf_cache, row_sample)
+            else:
+                with stage('descompactacao', file=filename) as st:
+                    dbf_object = read_dbc(filepath, encoding)
+                    st.set(bytes_in=file_size)
+                with stage('leitura', file=filename) as st:
+                    df = pd.DataFrame(list(dbf_object.records))
+                    if row_sample is not None:
+                        df = df[row_sample.mask(len(df))]
+                    st.set(rows_out=len(df))
+            df_aggregated_long = _enrich_and_count(df, proc_rea_prefixes, filename, classifier, engine)
+            del df
 
-        # Filtrar o DataFrame para o grupo '02 - Procedimentos com finalidade diagnóstica'
-        df_diagnostic = df[df['PROC_REA'].astype(str).str[:2] == '02'].copy()
-        if df_diagnostic.empty:
+        if df_aggregated_long is None or df_aggregated_long.empty:
             print(f"  - ATENÇÃO: Nenhum procedimento de diagnóstico encontrado em {filepath}. Retornando vazio.")
             # Retorna um DataFrame vazio com as colunas esperadas para ser concatenado sem problemas
-            return pd.DataFrame(columns=['UF_ATENDIMENTO', 'ANO_ATENDIMENTO', 'SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA', 'TOTAL_PROCEDIMENTOS'])
-
-        # 2. Enriquecer colunas de procedimentos
-        df_diagnostic['PROC_GRUPO_COD'] = df_diagnostic['PROC_REA'].astype(str).str[:2]
-        df_diagnostic['PROC_SUBGRUPO_COD'] = df_diagnostic['PROC_REA'].astype(str).str[2:4]
+            return pd.DataFrame(columns=FINAL_GROUPING_COLS + ['TOTAL_PROCEDIMENTOS'])
 
-        df_diagnostic['NOME_GRUPO'] = df_diagnostic['PROC_GRUPO_COD'].map(GRUPO_MAP).fillna('Outro Grupo')
-        
-        def map_subgroup(row):
-            group_code = row['PROC_GRUPO_COD']
-            subgroup_code = row['PROC_SUBGRUPO_COD']
-            if group_code in SUBGRUPO_MAP:
-                return SUBGRUPO_MAP[group_code].get(subgroup_code, 'Outro Subgrupo')
-            return 'Outro Subgrupo'
-        df_diagnostic['NOME_SUB_GRUPO'] = df_diagnostic.apply(map_subgroup, axis=1)
-
-        df_diagnostic['PROC_GRU_NOME'] = df_diagnostic['NOME_SUB_GRUPO'].map(PROC_GRU_NOME_MAP).fillna('Outros Diagnósticos')
-
-        # Criar REGIAO_CORPORAL_DETALHADA
-        df_diagnostic['REGIAO_CORPORAL_DETALHADA'] = 'Geral'
-        
-        procs_with_detailed_regions = ['RM', 'TC', 'RX']
-        mask_detailed_regions = df_diagnostic['PROC_GRU_NOME'].isin(procs_with_detailed_regions)
-        
-        df_diagnostic.loc[mask_detailed_regions, 'REGIAO_CORPORAL_DETALHADA'] = \
-            df_diagnostic.loc[mask_detailed_regions, 'PROC_REA'].astype(str).str.strip().map(PROC_REA_TO_REGIAO_MAP).fillna('Outra Região Diagnóstica')
-
-        # 3. Adicionar coluna FAIXA_ETARIA usando a coluna 'IDADE'
-        df_diagnostic['FAIXA_ETARIA'] = df_diagnostic['IDADE'].apply(calculate_age_group)
-        
-        # 4. Agregação dos dados (formato "long")
-        grouping_cols = [
-            'UF_ATENDIMENTO',
-            'ANO_ATENDIMENTO',
-            'SEXO',
-            'FAIXA_ETARIA',
-            'PROC_GRU_NOME',
-            'REGIAO_CORPORAL_DETALHADA'
-        ]
-        
-        df_aggregated_long = df_diagnostic.groupby(grouping_cols).size().reset_index(name='TOTAL_PROCEDIMENTOS')
+        # UF, ano e mês são constantes no arquivo e são adicionados só ao resultado agregado
+        df_aggregated_long.insert(0, 'UF_ATENDIMENTO', uf)
+        df_aggregated_long.insert(1, 'ANO_ATENDIMENTO', ano_atendimento)
+        df_aggregated_long.insert(2, 'MES_ATENDIMENTO', mes_atendimento)
         print(f"  - Finalizado processamento de {filepath}. {len(df_aggregated_long)} linhas agregadas.")
         return df_aggregated_long
 
@@ -313,31 +691,209 @@ def process_single_dbc_file(filepath, encoding='cp850'):
         return None
 
 
-def main_processing_script(input_dir, output_file_csv_master):
+def _process_file_task(filepath, instrumented=False, profile_file=None, profile_dir=None, memory_estimate=None,
+                       **process_kwargs):
+    """
+    Executa process_single_dbc_file com um coletor de medições próprio (no processo do
+    pool ou no processo principal). Se o nome do arquivo for profile_file, roda também
+    com cProfile e tracemalloc (o .prof é gravado em profile_dir).
+    Com a instrumentação ligada, mede também o pico de memória do arquivo, registrado ao
+    lado da estimativa memory_estimate (bytes, ver scheduler) para a calibração.
+    Retorna (df_agg, medições, perfis).
+    """
+    previous = get_instrumentation()
+    instrumentation = set_instrumentation(Instrumentation(enabled=instrumented))
+    filename = os.path.basename(filepath)
+    profiles = []
+    try:
+        with instrumentation.stage('arquivo', file=filename) as st:
+            with MemorySampler() if instrumented else contextlib.nullcontext() as sampler:
+                if profile_file and filename == profile_file:
+                    profile_path = None
+                    if profile_dir:
+                        profile_path = os.path.join(profile_dir, f"perfil_{os.path.splitext(filename)[0]}.prof")
+                    with FileProfiler(filename, profile_path) as profiler:
+                        df_agg = process_single_dbc_file(filepath, **process_kwargs)
+                    profiles.append(profiler.result)
+                else:
+                    df_agg = process_single_dbc_file(filepath, **process_kwargs)
+            st.set(rows_out=None if df_agg is None else len(df_agg), ok=df_agg is not None)
+            if sampler is not None:
+                st.set(mem_peak_mb=sampler.peak_mb,
+                       mem_estimated_mb=None if memory_estimate is None else round(memory_estimate / 1024 ** 2, 1))
+    finally:
+        set_instrumentation(previous)
+    return df_agg, instrumentation.records, profiles
+
+
+def _process_files(filepaths, workers=1, profile_file=None, profile_dir=None, memory_budget=None, **process_kwargs):
+    """
+    Processa os arquivos com process_single_dbc_file, em série ou num pool de processos,
+    do maior para o menor consumo de memória estimado (ver scheduler), para que os
+    arquivos grandes não fiquem para o fim. Com memory_budget (bytes), um arquivo só
+    começa quando a soma das estimativas dos arquivos em andamento, mais a dele, cabe no
+    limite; a ordem é mantida (um arquivo grande não é ultrapassado pelos menores).
+    process_kwargs são repassados a process_single_dbc_file.
+    As medições de cada arquivo (inclusive as feitas nos processos do pool) são
+    incorporadas ao coletor ativo (ver instrumentation).
+    Gera pares (filepath, df_agg) na ordem em que os arquivos terminam; df_agg é None em
+    caso de erro. A soma dos agregados (CountAccumulator) não depende dessa ordem.
+    """
+    instrumentation = get_instrumentation()
+    jobs = schedule_files(filepaths, process_kwargs.get('chunk_size'), process_kwargs.get('engine') or 'pandas')
+    task_kwargs = dict(process_kwargs, instrumented=instrumentation.enabled,
+                       profile_file=profile_file, profile_dir=profile_dir)
+    if workers > 1 and len(jobs) > 1:
+        budget = MemoryBudget(memory_budget)
+        limit = f", limite de memória de {memory_budget / 1024 ** 2:.0f} MB" if memory_budget else ""
+        print(f"Modo paralelo: {workers} processos{limit}.")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(process_kwargs.get('engine'))) as executor:
+            pending = collections.deque(jobs)
+            running = {}
+            while pending or running:
+                while pending and len(running) < workers and budget.admits(pending[0]):
+                    job = pending.popleft()
+                    budget.start(job)
+                    future = executor.submit(_process_file_task, job.filepath, memory_estimate=job.estimated_bytes,
+                                             **task_kwargs)
+                    running[future] = job
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    budget.finish(job)
+                    try:
+                        df_agg, records, profiles = future.result()
+                        instrumentation.extend(records, profiles)
+                    except Exception as e:
+                        # Falha do próprio processo trabalhador (ex: processo encerrado abruptamente)
+                        print(f"  - ERRO no processo trabalhador para {job.filepath}: {e}", file=sys.stderr)
+                        df_agg = None
+                    yield job.filepath, df_agg
+    else:
+        for job in jobs:
+            df_agg, records, profiles = _process_file_task(job.filepath, memory_estimate=job.estimated_bytes,
+                                                           **task_kwargs)
+            instrumentation.extend(records, profiles)
+            yield job.filepath, df_agg
+
+
+def combine_aggregates(all_aggregated_dfs):
+    """
+    Soma os DataFrames agregados de cada arquivo por UF, ano, mês e demais dimensões,
+    gerando o DataFrame mestre "long" (ver CountAccumulator).
+    """
+    accumulator = CountAccumulator(FINAL_GROUPING_COLS)
+    for df_agg in all_aggregated_dfs:
+        accumulator.add(df_agg)
+    return decode_master_frame(accumulator)
+
+
+def decode_master_frame(accumulator):
+    """
+    Monta o DataFrame mestre "long" a partir das contagens acumuladas dos arquivos.
+    """
+    with stage('consolidacao') as st:
+        final_df_long = accumulator.to_frame()
+        st.set(files=accumulator.frames_added, rows_out=len(final_df_long))
+    return final_df_long
+
+
+def main_processing_script(input_dir, output_file_csv_master, workers=1,
+                           cache_dir=None, rebuild_cache=False, cache_content_hash=False,
+                           chunk_size=None, proc_rea_prefixes=PROC_REA_PREFIXES, parquet_dir=None,
+                           profile_file=None, profile_dir=None, classification_table=None,
+                           rollups=None, rollup_dir=None, dbf_cache=None, engine='pandas', memory_budget=None):
     """
     Função principal para orquestrar o processamento de todos os arquivos .dbc.
     1. Encontra todos os arquivos .dbc no diretório de entrada.
     2. Processa cada arquivo, enriquecendo e agregando os dados.
+       Os arquivos são processados do maior para o menor (ver scheduler). Com workers > 1,
+       em paralelo num pool de processos; o CSV final é idêntico ao do modo serial.
+       Com memory_budget (bytes), a soma da memória estimada dos arquivos em andamento
+       fica dentro do limite.
+       Com cache_dir, os agregados por arquivo ficam em cache e só os arquivos novos ou
+       alterados são descompactados (rebuild_cache=True descarta o cache antes).
+       Com chunk_size, cada arquivo é lido em modo streaming (ver process_single_dbc_file).
+       proc_rea_prefixes define os grupos/prefixos do PROC_REA mantidos (padrão: '02').
+       classification_table é uma tabela de referência (CSV no layout do SIGTAP, ver
+       procedure_classifier) que substitui os dicionários de mapeamento.
+       Com dbf_cache (um DbfCache), os DBFs descompactados ficam em cache (ver dbf_cache.py).
+       engine escolhe o motor do enriquecimento e da agregação ('pandas' ou 'polars').
     3. Concatena todos os resultados agregados em um DataFrame mestre "long".
     4. Salva o DataFrame mestre "long" em um arquivo CSV.
+       Com parquet_dir, grava também um dataset Parquet particionado por UF e ano
+       (ver parquet_store); só as UFs cujos arquivos .dbc mudaram são regravadas.
+       Com rollups ({nome: [dimensões]}, ver rollups.py), grava também as agregações
+       pré-calculadas em rollup_dir (padrão: <CSV mestre>_rollups).
     5. Transforma o DataFrame mestre para o formato "wide" por UF e salva em um único arquivo Excel
        com planilhas separadas por UF.
+    As etapas são medidas no coletor ativo de instrumentation (se estiver ligado). Com
+    profile_file (nome de um .dbc), esse arquivo roda também com cProfile e tracemalloc.
     """
     
     dbc_filepaths = glob.glob(os.path.join(input_dir, '*.dbc'))
     print(f"Encontrados {len(dbc_filepaths)} arquivos .dbc para processar no diretório: {input_dir}")
 
-    all_aggregated_dfs = []
-    failed_files = [] # Lista para armazenar informações dos arquivos que falharam
+    cache = None
+    if cache_dir:
+        cache = AggregateCache(cache_dir, aggregate_cache_version(proc_rea_prefixes, classification_table),
+                               use_content_hash=cache_content_hash, rebuild=rebuild_cache)
+
+    # Os agregados de cada arquivo são somados às contagens assim que ficam prontos e
+    # descartados em seguida; results guarda só se o arquivo foi processado com sucesso
+    accumulator = CountAccumulator(FINAL_GROUPING_COLS)
+    results = {}
+    pending_filepaths = []
+    with stage('cache_consulta') as st:
+        for filepath in dbc_filepaths:
+            df_cached = cache.get(filepath) if cache is not None else None
+            if df_cached is not None:
+                accumulator.add(df_cached)
+                results[filepath] = True
+            else:
+                pending_filepaths.append(filepath)
+        st.set(files=len(dbc_filepaths), hits=len(results))
+    if cache is not None:
+        print(f"Cache de agregados: {len(results)} arquivos reaproveitados, {len(pending_filepaths)} a processar.")
+
+    with stage('processamento', workers=workers) as st:
+        for filepath, df_agg in _process_files(pending_filepaths, workers, profile_file=profile_file,
+                                               profile_dir=profile_dir, chunk_size=chunk_size,
+                                               proc_rea_prefixes=proc_rea_prefixes,
+                                               classification_table=classification_table,
+                                               dbf_cache=dbf_cache, engine=engine,
+                                               memory_budget=memory_budget):
+            results[filepath] = df_agg is not None
+            if df_agg is not None:
+                accumulator.add(df_agg)
+                if cache is not None:
+                    cache.put(filepath, df_agg)
+        st.set(files=len(pending_filepaths))
+    print_memory_calibration(memory_calibration(get_instrumentation().records))
+
+    if cache is not None:
+        with stage('cache_gravacao'):
+            cache.save()
 
-    for filepath in dbc_filepaths:
-        df_agg = process_single_dbc_file(filepath)
-        if df_agg is not None: # Se processou com sucesso (mesmo que seja um DataFrame vazio)
-            all_aggregated_dfs.append(df_agg)
-        else: # Se process_single_dbc_file retornou None (indicando erro)
-            failed_files.append(filepath)
+    return write_master_outputs(dbc_filepaths, results, accumulator, output_file_csv_master, parquet_dir,
+                                rollups, rollup_dir,
+                                data_version=aggregate_cache_version(proc_rea_prefixes, classification_table))
 
-    if not all_aggregated_dfs:
+
+def write_master_outputs(dbc_filepaths, results, accumulator, output_file_csv_master, parquet_dir=None,
+                         rollups=None, rollup_dir=None, data_version=None):
+    """
+    Etapas finais de main_processing_script (e do pipeline de download e processamento):
+    monta o DataFrame mestre a partir das contagens de accumulator (um CountAccumulator
+    com os agregados de todos os arquivos), salva o CSV mestre (e, com parquet_dir, o dataset Parquet; com rollups,
+    as agregações pré-calculadas em rollup_dir) e lista os arquivos que falharam. Retorna o DataFrame mestre "long" ou None se nada foi processado.
+    data_version (ver aggregate_cache_version) vai para o dataset Parquet: se ela mudou, todas as UFs são regravadas.
+    """
+    # results: {filepath: True se processou com sucesso (mesmo que sem registros),
+    # False se process_single_dbc_file retornou None (indicando erro)}
+    failed_files = [filepath for filepath in dbc_filepaths if not results[filepath]]
+
+    if len(failed_files) == len(dbc_filepaths):
         print("\nNenhum dado processado com sucesso de todos os arquivos. Saindo.")
         if failed_files:
             print("\nArquivos que falharam no processamento:")
@@ -345,17 +901,7 @@ def main_processing_script(input_dir, output_file_csv_master):
                 print(f"  - {f}")
         return
 
-    final_df_long = pd.concat(all_aggregated_dfs, ignore_index=True)
-    
-    final_grouping_cols = [
-        'UF_ATENDIMENTO',
-        'ANO_ATENDIMENTO',
-        'SEXO',
-        'FAIXA_ETARIA',
-        'PROC_GRU_NOME',
-        'REGIAO_CORPORAL_DETALHADA'
-    ]
-    final_df_long = final_df_long.groupby(final_grouping_cols)['TOTAL_PROCEDIMENTOS'].sum().reset_index()
+    final_df_long = decode_master_frame(accumulator)
 
     print(f"\nDataFrame mestre em formato 'long' criado com {len(final_df_long)} linhas.")
     
@@ -364,9 +910,35 @@ def main_processing_script(input_dir, output_file_csv_master):
 
 
     os.makedirs(os.path.dirname(output_file_csv_master), exist_ok=True)
-    final_df_long.to_csv(output_file_csv_master, index=False, encoding='utf-8')
+    with stage('csv') as st:
+        # Gravado num temporário e renomeado: quem lê o CSV (ex: query_service) nunca vê um arquivo pela metade
+        final_df_long.to_csv(output_file_csv_master + '.tmp', index=False, encoding='utf-8')
+        os.replace(output_file_csv_master + '.tmp', output_file_csv_master)
+        st.set(rows_out=len(final_df_long), bytes_out=os.path.getsize(output_file_csv_master))
     print(f"DataFrame mestre salvo em: {output_file_csv_master}")
 
+    if rollups:
+        rollup_dir = rollup_dir or os.path.splitext(output_file_csv_master)[0] + '_rollups'
+        with stage('rollups') as st:
+            rollup_dfs = materialize_rollups(final_df_long, rollups)
+            write_rollups(rollup_dfs, rollup_dir, rollups)
+            st.set(rollups=len(rollup_dfs), rows_out=sum(len(df) for df in rollup_dfs.values()))
+        print(f"Rollups ({', '.join(rollup_dfs)}) salvos em: {rollup_dir}")
+
+    if parquet_dir:
+        # Arquivos de origem (processados com sucesso) de cada UF, para regravar só o que mudou
+        sources = {}
+        for filepath in dbc_filepaths:
+            if results[filepath]:
+                sources.setdefault(uf_from_filename(filepath), []).append(filepath)
+        try:
+            with stage('parquet') as st:
+                rewritten_ufs = write_parquet_dataset(final_df_long, parquet_dir, sources, data_version)
+                st.set(ufs_rewritten=len(rewritten_ufs))
+            print(f"Dataset Parquet salvo em: {parquet_dir} (UFs regravadas: {', '.join(rewritten_ufs) or 'nenhuma'})")
+        except ImportError as e:
+            print(f"AVISO: {e} O dataset Parquet não foi gravado.", file=sys.stderr)
+
     # excelll(final_df_long, output_excel_filepath)
 
     print("\nProcessamento concluído!")
@@ -378,80 +950,270 @@ def main_processing_script(input_dir, output_file_csv_master):
     return final_df_long
 
 
-def excelll(final_df_long, output_consolidated_excel_filepath):
+def preview_processing_script(input_dir, output_file_csv_master, files_per_stratum=DEFAULT_FILES_PER_STRATUM,
+                              record_fraction=DEFAULT_RECORD_FRACTION, seed=0, workers=1, chunk_size=None,
+                              proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None, dbf_cache=None,
+                              engine='pandas'):
+    """
+    Modo prévia (ver preview.py): processa só uma amostra estratificada, com
+    files_per_stratum arquivos sorteados por UF e ano (0: todos) e a fração
+    record_fraction dos registros de cada arquivo, e grava a tabela "long" com os
+    totais estimados e o intervalo de 95% de cada grupo em PREVIA_<CSV mestre>, mais
+    a descrição da amostra em PREVIA_<CSV mestre>.json. O cache de agregados não é
+    usado nem alterado. Com sorteio de arquivos, a tabela não tem MES_ATENDIMENTO.
+    Retorna o DataFrame estimado ou None se nenhum arquivo foi processado.
+    """
+    dbc_filepaths = glob.glob(os.path.join(input_dir, '*.dbc'))
+    selected, strata = select_preview_files(dbc_filepaths, stratum_from_filename, files_per_stratum, seed)
+    sample_files = len(selected) < len(dbc_filepaths)
+    print("=" * 70)
+    print(f"MODO PRÉVIA: resultados ESTIMADOS a partir de uma amostra ({len(selected)} de {len(dbc_filepaths)} "
+          f"arquivos, {record_fraction:.0%} dos registros).")
+    print("=" * 70)
+
+    file_aggregates, failed_files = [], []
+    with stage('processamento', workers=workers, preview=True) as st:
+        for filepath, df_agg in _process_files(selected, workers, chunk_size=chunk_size,
+                                               proc_rea_prefixes=proc_rea_prefixes,
+                                               classification_table=classification_table, dbf_cache=dbf_cache,
+                                               engine=engine, sample_fraction=record_fraction, sample_seed=seed):
+            if df_agg is None:
+                failed_files.append(filepath)
+            else:
+                file_aggregates.append((filepath, df_agg))
+        st.set(files=len(selected))
+    if not file_aggregates:
+        print("\nNenhum arquivo da amostra processado com sucesso. Saindo.")
+        return None
+    # Estratos sem nenhum arquivo processado ficam de fora da estimativa
+    missing_strata = sorted(set(strata) - {stratum_from_filename(filepath) for filepath, _ in file_aggregates})
+
+    group_cols = [col for col in FINAL_GROUPING_COLS if not (sample_files and col == 'MES_ATENDIMENTO')]
+    with stage('estimativa') as st:
+        # Número de registros de todos os arquivos, do cabeçalho (variável auxiliar do estimador de razão)
+        record_counts = {filepath: estimate_file_memory(filepath).numrecords for filepath in dbc_filepaths}
+        df_estimate = estimate_totals(file_aggregates, stratum_from_filename, strata, record_counts, record_fraction,
+                                      group_cols)
+        st.set(rows_out=len(df_estimate))
+
+    output_path = preview_path(output_file_csv_master)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    df_estimate.to_csv(output_path + '.tmp', index=False, encoding='utf-8')
+    os.replace(output_path + '.tmp', output_path)
+    write_preview_metadata(output_path + '.json', arquivos_por_estrato=files_per_stratum,
+                           fracao_registros=record_fraction, semente=seed, arquivos_total=len(dbc_filepaths),
+                           arquivos_amostra=[os.path.basename(filepath) for filepath, _ in file_aggregates],
+                           arquivos_com_falha=[os.path.basename(filepath) for filepath in failed_files],
+                           estratos_sem_amostra=[f"{uf}/{ano:02d}" for uf, ano in missing_strata],
+                           colunas=group_cols, nivel_confianca=0.95)
+
+    no_interval = int(df_estimate[CI_UPPER_COLUMN].isna().sum())
+    margin = relative_margin_summary(df_estimate)
+    print(f"\nPRÉVIA (ESTIMATIVA) salva em: {output_path} ({len(df_estimate)} grupos)")
+    print(f"  - Total estimado de procedimentos: {df_estimate['TOTAL_PROCEDIMENTOS'].sum():,}")
+    if margin is not None:
+        print(f"  - Margem típica dos intervalos de 95%: ±{margin:.1%}")
+    if no_interval:
+        print(f"  - {no_interval} grupos sem intervalo (um só arquivo sorteado no estrato; use --preview-files 2 ou mais).")
+    if missing_strata:
+        print(f"  - ATENÇÃO: estratos sem nenhum arquivo processado: {', '.join(f'{uf}/{ano:02d}' for uf, ano in missing_strata)}")
+    return df_estimate
+
+
+EXCEL_INDEX_COLS = ['SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA']
+
+
+def pivot_wide_by_uf(final_df_long, years=None):
+    """
+    Transforma o DataFrame mestre "long" para o formato "wide" de todas as UFs numa
+    única passada (um só pivot_table, com a UF no índice).
+    Gera pares (UF, DataFrame wide da UF) em ordem alfabética de UF, com as colunas
+    EXCEL_INDEX_COLS + TOTAL_<ano> (todos os anos do DataFrame mestre, em ordem, ou os
+    anos de years, quando final_df_long tem só uma parte das linhas do mestre).
+    """
+    all_years = sorted(final_df_long['ANO_ATENDIMENTO'].unique() if years is None else years)
+    year_columns_ordered = [f'TOTAL_{year}' for year in all_years]
+
+    with stage('excel_pivot') as st:
+        df_wide = final_df_long.pivot_table(
+            index=['UF_ATENDIMENTO'] + EXCEL_INDEX_COLS,
+            columns='ANO_ATENDIMENTO',
+            values='TOTAL_PROCEDIMENTOS',
+            aggfunc='sum',
+            fill_value=0,
+            observed=True
+        )
+        # Anos sem nenhum registro numa UF ficam com 0, como antes
+        df_wide.columns = [f'TOTAL_{year}' for year in df_wide.columns]
+        df_wide = df_wide.reindex(columns=year_columns_ordered, fill_value=0)
+        st.set(rows_in=len(final_df_long), rows_out=len(df_wide))
+
+    for uf, df_uf_wide in df_wide.groupby(level='UF_ATENDIMENTO', sort=True, observed=True):
+        yield uf, df_uf_wide.droplevel('UF_ATENDIMENTO').reset_index()
+
+
+def write_uf_sheet(workbook, uf, df_uf_wide):
+    """
+    Grava a planilha de uma UF linha a linha, direto das colunas do DataFrame wide,
+    formatada como a tabela Excel 'Tabela_<UF>'.
+    """
+    worksheet = workbook.add_worksheet(uf)
+    columns = list(df_uf_wide.columns)
+
+    # Cabeçalho na linha 0 e uma linha por combinação de dimensões
+    worksheet.write_row(0, 0, columns)
+    column_values = [df_uf_wide[col].tolist() for col in columns]
+    for row_idx, row in enumerate(zip(*column_values), start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+    # Cria a tabela Excel sobre o intervalo escrito (cabeçalho + len(df_uf_wide) linhas)
+    worksheet.add_table(0, 0, len(df_uf_wide), len(columns) - 1, {
+        'name': f"Tabela_{uf}",
+        'columns': [{'header': col} for col in columns]
+    })
+
+    # Autoajustar a largura das colunas (opcional, pode ser lento para muitas colunas/linhas)
+    # for i, col in enumerate(columns):
+    #     max_len = max(df_uf_wide[col].astype(str).map(len).max(), len(col))
+    #     worksheet.set_column(i, i, max_len + 2) # +2 para um pequeno padding
+    return worksheet
+
+
+def _write_uf_workbook(filepath, uf, df_uf_wide):
+    # Executado nos processos do pool: um arquivo Excel por UF
+    workbook = xlsxwriter.Workbook(filepath)
+    write_uf_sheet(workbook, uf, df_uf_wide)
+    workbook.close()
+    return filepath
+
+
+def excelll(final_df_long, output_consolidated_excel_filepath, per_uf_dir=None, workers=1):
     """
     Transforma o DataFrame mestre "long" para o formato "wide" por UF
     e salva todas as UFs em planilhas separadas dentro de um único arquivo Excel,
     formatando os dados como tabelas Excel.
+    O pivot de todas as UFs é feito numa única passada (ver pivot_wide_by_uf) e as
+    linhas são gravadas direto com o xlsxwriter, sem passar pelo pd.ExcelWriter.
+    Com per_uf_dir, grava em vez disso um arquivo por UF (resumo_<UF>.xlsx) nesse
+    diretório, com workers processos em paralelo.
     """
+
+    if per_uf_dir:
+        os.makedirs(per_uf_dir, exist_ok=True)
+        print(f"Gerando um arquivo Excel por UF em: {per_uf_dir} (processos: {workers})...")
+        with stage('excel_escrita', workers=workers) as st:
+            saved_files = []
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_write_uf_workbook, os.path.join(per_uf_dir, f'resumo_{uf}.xlsx'), uf, df_uf_wide)
+                               for uf, df_uf_wide in pivot_wide_by_uf(final_df_long)]
+                    for future in futures:
+                        saved_files.append(future.result())
+                        print(f"  - Arquivo salvo: {saved_files[-1]}")
+            else:
+                for uf, df_uf_wide in pivot_wide_by_uf(final_df_long):
+                    saved_files.append(_write_uf_workbook(os.path.join(per_uf_dir, f'resumo_{uf}.xlsx'), uf, df_uf_wide))
+                    print(f"  - Arquivo salvo: {saved_files[-1]}")
+            st.set(files=len(saved_files), bytes_out=sum(os.path.getsize(path) for path in saved_files))
+        return
+
     os.makedirs(os.path.dirname(output_consolidated_excel_filepath), exist_ok=True)
-    
+
     unique_ufs = sorted(final_df_long['UF_ATENDIMENTO'].unique())
     print(f"Gerando arquivo Excel consolidado em: {output_consolidated_excel_filepath} com {len(unique_ufs)} planilhas...")
 
-    all_years = sorted(final_df_long['ANO_ATENDIMENTO'].unique())
-    year_columns_ordered = [f'TOTAL_{year}' for year in all_years]
-
-    excel_index_cols = ['SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA']
-
-    # Usa pd.ExcelWriter com o motor 'xlsxwriter' para acesso a funcionalidades avançadas
-    with pd.ExcelWriter(output_consolidated_excel_filepath, engine='xlsxwriter') as writer:
-        for uf in unique_ufs:
+    workbook = xlsxwriter.Workbook(output_consolidated_excel_filepath)
+    try:
+        for uf, df_uf_wide in pivot_wide_by_uf(final_df_long):
             print(f"  - Preparando planilha para UF: {uf}")
-            df_uf = final_df_long[final_df_long['UF_ATENDIMENTO'] == uf].copy()
-            
-            df_uf_wide = df_uf.pivot_table(
-                index=excel_index_cols,
-                columns='ANO_ATENDIMENTO',
-                values='TOTAL_PROCEDIMENTOS',
-                fill_value=0
-            ).reset_index()
-
-            current_year_cols_as_int = [col for col in df_uf_wide.columns if isinstance(col, int)]
-            rename_map = {col_int: f'TOTAL_{col_int}' for col_int in current_year_cols_as_int}
-            df_uf_wide = df_uf_wide.rename(columns=rename_map)
-
-            for expected_col_name in year_columns_ordered:
-                if expected_col_name not in df_uf_wide.columns:
-                    df_uf_wide[expected_col_name] = 0
-
-            final_excel_cols_order = excel_index_cols + year_columns_ordered
-            df_uf_wide = df_uf_wide[final_excel_cols_order]
-
-            # Salva o DataFrame como uma planilha
-            df_uf_wide.to_excel(writer, sheet_name=uf, index=False, startrow=0, startcol=0)
-
-            # --- Adicionar Formato de Tabela Excel ---
-            # Obtém o objeto worksheet do xlsxwriter
-            workbook = writer.book
-            worksheet = writer.sheets[uf]
-
-            # Define o intervalo da tabela (incluindo o cabeçalho)
-            # len(df_uf_wide) é o número de linhas de dados
-            # len(df_uf_wide.columns) é o número de colunas
-            # O Excel é baseado em 0-indexado, então a última linha é len-1, última coluna é len-1
-            # E o cabeçalho está na linha 0.
-            max_row = len(df_uf_wide)
-            max_col = len(df_uf_wide.columns) - 1 # Índices de coluna são 0 a N-1
-
-            # Cria a tabela Excel
-            # O nome da tabela pode ser a própria UF ou algo como "Tabela_UF"
-            table_name = f"Tabela_{uf}"
-            worksheet.add_table(0, 0, max_row, max_col, {
-                'name': table_name,
-                'columns': [{'header': col} for col in df_uf_wide.columns]
-            })
-
-            # Autoajustar a largura das colunas (opcional, pode ser lento para muitas colunas/linhas)
-            # for i, col in enumerate(df_uf_wide.columns):
-            #     max_len = max(df_uf_wide[col].astype(str).map(len).max(), len(col))
-            #     worksheet.set_column(i, i, max_len + 2) # +2 para um pequeno padding
-            
+            with stage('excel_escrita', uf=uf) as st:
+                write_uf_sheet(workbook, uf, df_uf_wide)
+                st.set(rows_out=len(df_uf_wide))
             print(f"    - Planilha '{uf}' formatada como tabela Excel.")
+    finally:
+        with stage('excel_fechamento') as st:
+            workbook.close()
+            st.set(bytes_out=os.path.getsize(output_consolidated_excel_filepath))
 
 # --- Bloco Principal de Execução ---
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Processa os arquivos .dbc do CIHA e gera o CSV mestre e o Excel por UF.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos para o processamento dos arquivos (padrão: 1, modo serial).")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Diretório do cache de agregados por arquivo (padrão: output/cache_agregados).")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Desativa o cache de agregados e processa todos os arquivos.")
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help="Descarta o cache de agregados e reprocessa todos os arquivos.")
+    parser.add_argument('--cache-hash', action='store_true',
+                        help="Valida os caches (de agregados e de DBFs) também pelo hash do conteúdo quando o mtime do arquivo mudar.")
+    parser.add_argument('--chunk-size', type=int, default=None, nargs='?', const=DEFAULT_CHUNK_SIZE,
+                        help=f"Modo streaming: lê cada arquivo em blocos deste número de registros "
+                             f"(padrão do bloco: {DEFAULT_CHUNK_SIZE}), limitando o uso de memória.")
+    parser.add_argument('--proc-rea-prefixes', nargs='+', default=list(PROC_REA_PREFIXES),
+                        help="Prefixos do PROC_REA mantidos (padrão: 02). Ex: --proc-rea-prefixes 02 03")
+    parser.add_argument('--parquet-dir', default=None, nargs='?', const='',
+                        help="Grava também um dataset Parquet particionado por UF e ano "
+                             "(padrão: output/datasus_sumario_nacional_parquet). Requer pyarrow.")
+    parser.add_argument('--excel-per-uf', default=None, nargs='?', const='',
+                        help="Grava um arquivo Excel por UF (resumo_<UF>.xlsx), em paralelo com --workers processos, "
+                             "no lugar do Excel consolidado (padrão do diretório: output/resumo_por_uf).")
+    parser.add_argument('--report', default=None, nargs='?', const='',
+                        help="Liga a instrumentação das etapas e grava o relatório JSON da execução "
+                             "(padrão do arquivo: output/relatorio_processamento.json).")
+    parser.add_argument('--no-report', action='store_true', help=argparse.SUPPRESS) # Já é o padrão
+    parser.add_argument('--profile-file', default=None,
+                        help="Nome de um arquivo .dbc (ex: CIHASP1605.dbc) a ser processado com cProfile e "
+                             "tracemalloc; o perfil vai para o relatório e para um .prof ao lado dele.")
+    parser.add_argument('--classification-table', default=None,
+                        help="Tabela de referência (CSV ';' no layout do SIGTAP, ex: referencia/classificacao_procedimentos.csv) "
+                             "usada no lugar dos dicionários de mapeamento para classificar o PROC_REA.")
+    parser.add_argument('--export-classification-table', default=None, metavar='CSV',
+                        help="Grava os dicionários de mapeamento no layout da tabela de referência e sai.")
+    parser.add_argument('--rollups', nargs='+', default=list(DEFAULT_ROLLUPS), metavar='ROLLUP',
+                        help="Agregações pré-calculadas gravadas ao lado do CSV mestre: nomes de rollups padrão "
+                             f"({', '.join(DEFAULT_ROLLUPS)}) ou colunas separadas por '+' (ex: UF_ATENDIMENTO+SEXO).")
+    parser.add_argument('--no-rollups', action='store_true', help="Não grava os rollups.")
+    parser.add_argument('--engine', choices=ENGINE_NAMES, default='pandas',
+                        help="Motor do enriquecimento e da agregação: pandas (padrão) ou polars (várias threads; "
+                             "requer pip install polars).")
+    parser.add_argument('--dbf-cache-dir', default=None, nargs='?', const='',
+                        help="Guarda os DBFs descompactados neste diretório e, nas próximas execuções, lê os "
+                             "arquivos inalterados direto dele com mmap (padrão do diretório: output/cache_dbf).")
+    parser.add_argument('--dbf-cache-max-gb', type=float, default=DEFAULT_DBF_CACHE_MAX_BYTES / 1024 ** 3,
+                        help="Espaço máximo do cache de DBFs, em GB; os DBFs usados há mais tempo são removidos "
+                             f"primeiro (padrão: {DEFAULT_DBF_CACHE_MAX_BYTES // 1024 ** 3}).")
+    parser.add_argument('--preview', action='store_true',
+                        help="Modo prévia: processa só uma amostra estratificada e grava os totais ESTIMADOS, com "
+                             "intervalos de 95%%, em output/PREVIA_<CSV mestre> (sem Excel, Parquet, rollups nem cache).")
+    parser.add_argument('--preview-files', type=int, default=DEFAULT_FILES_PER_STRATUM,
+                        help=f"Arquivos sorteados por UF e ano no modo prévia (padrão: {DEFAULT_FILES_PER_STRATUM}; "
+                             f"0 = todos).")
+    parser.add_argument('--preview-fraction', type=float, default=DEFAULT_RECORD_FRACTION,
+                        help=f"Fração dos registros de cada arquivo sorteado no modo prévia "
+                             f"(padrão: {DEFAULT_RECORD_FRACTION}).")
+    parser.add_argument('--preview-seed', type=int, default=0,
+                        help="Semente do sorteio do modo prévia (padrão: 0).")
+    parser.add_argument('--memory-budget-mb', type=float, default=None,
+                        help="Limite da memória estimada dos arquivos processados ao mesmo tempo, em MB "
+                             "(padrão: sem limite além de --workers). Os arquivos vão do maior para o menor.")
+    args = parser.parse_args()
+
+    rollups = None
+    if not args.no_rollups:
+        try:
+            rollups = parse_rollup_specs(args.rollups, FINAL_GROUPING_COLS)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.export_classification_table:
+        subgroups = subgroup_table(SUBGRUPO_MAP, PROC_GRU_NOME_MAP, PROCS_WITH_DETAILED_REGIONS)
+        write_reference_csv(args.export_classification_table, GRUPO_MAP, subgroups, PROC_REA_TO_REGIAO_MAP)
+        print(f"Tabela de referência salva em: {args.export_classification_table}")
+        sys.exit(0)
+
     # Define os diretórios de entrada e saída
     # Assumindo a seguinte estrutura:
     # Pasta_maior/
@@ -469,10 +1231,67 @@ if __name__ == "__main__":
     # Caminho para o arquivo CSV mestre (formato "long")
     output_csv_master_path = os.path.join(base_dir, 'output', 'datasus_sumario_nacional_long.csv')
 
-    final_df_long = main_processing_script(input_data_dir, output_csv_master_path)
+    # Cache dos agregados por arquivo (só os .dbc novos ou alterados são reprocessados)
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(base_dir, 'output', 'cache_agregados')
+
+    # Instrumentação das etapas e relatório JSON da execução (opcional)
+    report_path = None
+    if args.report is not None and not args.no_report:
+        report_path = args.report or os.path.join(base_dir, 'output', 'relatorio_processamento.json')
+        set_instrumentation(Instrumentation(enabled=True))
+
+    # Dataset Parquet particionado (opcional)
+    parquet_dir = None
+    if args.parquet_dir is not None:
+        parquet_dir = args.parquet_dir or os.path.join(base_dir, 'output', 'datasus_sumario_nacional_parquet')
+
+    # Cache dos DBFs descompactados (opcional)
+    dbf_cache = None
+    if args.dbf_cache_dir is not None:
+        dbf_cache = DbfCache(args.dbf_cache_dir or os.path.join(base_dir, 'output', 'cache_dbf'),
+                             max_bytes=int(args.dbf_cache_max_gb * 1024 ** 3), use_content_hash=args.cache_hash)
+
+    if args.preview:
+        if not 0 < args.preview_fraction <= 1:
+            parser.error("--preview-fraction deve estar entre 0 (exclusive) e 1.")
+        df_estimate = preview_processing_script(input_data_dir, output_csv_master_path,
+                                                files_per_stratum=args.preview_files,
+                                                record_fraction=args.preview_fraction, seed=args.preview_seed,
+                                                workers=args.workers, chunk_size=args.chunk_size,
+                                                proc_rea_prefixes=tuple(args.proc_rea_prefixes),
+                                                classification_table=args.classification_table,
+                                                dbf_cache=dbf_cache, engine=args.engine)
+        if report_path:
+            get_instrumentation().write_report(preview_path(report_path), script='process_ciha_data', preview=True,
+                                               workers=args.workers, preview_files=args.preview_files,
+                                               preview_fraction=args.preview_fraction, preview_seed=args.preview_seed)
+        sys.exit(0 if df_estimate is not None else 1)
+
+    final_df_long = main_processing_script(input_data_dir, output_csv_master_path, workers=args.workers,
+                                           cache_dir=cache_dir, rebuild_cache=args.rebuild_cache,
+                                           cache_content_hash=args.cache_hash, chunk_size=args.chunk_size,
+                                           proc_rea_prefixes=tuple(args.proc_rea_prefixes),
+                                           parquet_dir=parquet_dir, profile_file=args.profile_file,
+                                           profile_dir=os.path.dirname(os.path.abspath(report_path or output_csv_master_path)),
+                                           classification_table=args.classification_table,
+                                           rollups=rollups, dbf_cache=dbf_cache, engine=args.engine,
+                                           memory_budget=args.memory_budget_mb and int(args.memory_budget_mb * 1024 ** 2))
     # final_df_long = pd.read_csv(output_csv_master_path, header=0)
     
     # Diretório onde os arquivos Excel por UF serão salvos
     output_excel_dir = os.path.join(base_dir, 'output', 'resumo_consolidado_por_uf.xlsx')
     
-    excelll(final_df_long, output_excel_dir)
\ No newline at end of file
+    # Um arquivo Excel por UF (opcional)
+    per_uf_dir = None
+    if args.excel_per_uf is not None:
+        per_uf_dir = args.excel_per_uf or os.path.join(base_dir, 'output', 'resumo_por_uf')
+
+    excelll(final_df_long, output_excel_dir, per_uf_dir=per_uf_dir, workers=args.workers)
+
+    if report_path:
+        get_instrumentation().write_report(report_path, script='process_ciha_data', workers=args.workers,
+                                           chunk_size=args.chunk_size, memory_budget_mb=args.memory_budget_mb,
+                                           memory_calibration=memory_calibration(get_instrumentation().records))
+        print(f"Relatório da execução salvo em: {report_path}")
\ No newline at end of file
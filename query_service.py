@@ -0,0 +1,300 @@
+"""
+Serviço local de consultas sobre o CSV mestre (datasus_sumario_nacional_long.csv).
+
+O CSV é carregado uma única vez num índice em memória (códigos inteiros por coluna e
+listas de linhas por valor de UF_ATENDIMENTO, ANO_ATENDIMENTO, PROC_GRU_NOME e
+REGIAO_CORPORAL_DETALHADA). As consultas (filtros + group by + soma de
+TOTAL_PROCEDIMENTOS) são respondidas sobre o índice, com um cache LRU dos resultados.
+Quando main_processing_script grava um novo CSV, o índice é recarregado e o cache limpo.
+
+Uso:
+    python query_service.py --filter UF_ATENDIMENTO=MG --filter ANO_ATENDIMENTO=16,17 --group-by PROC_GRU_NOME
+    python query_service.py --serve --port 8765
+    curl 'http://127.0.0.1:8765/query?UF_ATENDIMENTO=MG&group_by=PROC_GRU_NOME,SEXO'
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+
+VALUE_COLUMN = 'TOTAL_PROCEDIMENTOS'
+# Colunas com lista de linhas por valor (as mais usadas nos filtros dos painéis)
+INDEXED_COLUMNS = ['UF_ATENDIMENTO', 'ANO_ATENDIMENTO', 'PROC_GRU_NOME', 'REGIAO_CORPORAL_DETALHADA']
+# Colunas devolvidas como inteiros nos resultados
+INTEGER_COLUMNS = ['ANO_ATENDIMENTO', 'MES_ATENDIMENTO']
+
+
+class AggregateIndex:
+    """
+    Índice em memória de um DataFrame mestre "long": cada coluna de dimensão vira um
+    array de códigos inteiros (categorias em ordem lexicográfica, ou numérica nas colunas
+    de INTEGER_COLUMNS) e, nas colunas de INDEXED_COLUMNS, cada valor aponta para o
+    array ordenado das suas linhas.
+    """
+
+    def __init__(self, df):
+        self.columns = [col for col in df.columns if col != VALUE_COLUMN]
+        self.values = df[VALUE_COLUMN].to_numpy(dtype=np.int64)
+        self.codes = {}
+        self.labels = {}
+        self.lookup = {}
+        for col in self.columns:
+            labels = df[col].astype(str)
+            categories = sorted(labels.unique())
+            if col in INTEGER_COLUMNS and all(label.lstrip('-').isdigit() for label in categories):
+                categories.sort(key=int) # Anos e meses em ordem numérica nos resultados
+            categorical = pd.Categorical(labels, categories=categories)
+            self.codes[col] = categorical.codes.astype(np.int64)
+            self.labels[col] = list(categorical.categories)
+            self.lookup[col] = {label: code for code, label in enumerate(self.labels[col])}
+
+        self.postings = {}
+        for col in INDEXED_COLUMNS:
+            if col not in self.codes:
+                continue
+            order = np.argsort(self.codes[col], kind='stable')
+            bounds = np.searchsorted(self.codes[col][order], np.arange(len(self.labels[col]) + 1))
+            self.postings[col] = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.labels[col]))]
+
+    def __len__(self):
+        return len(self.values)
+
+    def _check_columns(self, columns):
+        unknown = [col for col in columns if col not in self.codes]
+        if unknown:
+            raise ValueError(f"Colunas desconhecidas: {unknown}. Disponíveis: {self.columns}")
+
+    def rows(self, filters):
+        """
+        Posições das linhas que atendem a todos os filtros ({coluna: [valores]}).
+        Os filtros em colunas indexadas são resolvidos pelas listas de linhas (e
+        intersectados, do mais seletivo para o menos); os demais, sobre essas linhas.
+        """
+        self._check_columns(filters)
+        wanted = {col: [self.lookup[col][str(v)] for v in values if str(v) in self.lookup[col]]
+                  for col, values in filters.items()}
+
+        indexed = []
+        for col in [col for col in wanted if col in self.postings]:
+            parts = [self.postings[col][code] for code in wanted[col]]
+            indexed.append(np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64))
+        positions = None
+        for part in sorted(indexed, key=len):
+            positions = part if positions is None else np.intersect1d(positions, part, assume_unique=True)
+        if positions is None:
+            positions = np.arange(len(self.values))
+
+        for col in [col for col in wanted if col not in self.postings]:
+            positions = positions[np.isin(self.codes[col][positions], wanted[col])]
+        return positions
+
+    def query(self, filters=None, group_by=None):
+        """
+        Soma de TOTAL_PROCEDIMENTOS das linhas filtradas, por group_by (lista de colunas).
+        Retorna uma lista de dicionários, em ordem das colunas de group_by.
+        """
+        group_by = list(group_by or [])
+        self._check_columns(group_by)
+        positions = self.rows(filters or {})
+        values = self.values[positions]
+        if not group_by:
+            return [{VALUE_COLUMN: int(values.sum())}]
+
+        # Chave única por combinação de códigos (base mista) e soma por chave
+        key = np.zeros(len(positions), dtype=np.int64)
+        for col in group_by:
+            key = key * len(self.labels[col]) + self.codes[col][positions]
+        unique_keys, inverse = np.unique(key, return_inverse=True)
+        totals = np.bincount(inverse, weights=values, minlength=len(unique_keys)).round().astype(np.int64)
+
+        decoded = {}
+        for col in reversed(group_by):
+            size = len(self.labels[col])
+            decoded[col] = unique_keys % size
+            unique_keys = unique_keys // size
+
+        result = []
+        for i in range(len(totals)):
+            row = {}
+            for col in group_by:
+                label = self.labels[col][decoded[col][i]]
+                row[col] = int(label) if col in INTEGER_COLUMNS and label.lstrip('-').isdigit() else label
+            row[VALUE_COLUMN] = int(totals[i])
+            result.append(row)
+        return result
+
+
+class QueryService:
+    """
+    Índice do CSV mestre + cache LRU dos resultados. A cada consulta (no máximo a cada
+    check_interval segundos) confere o tamanho e o mtime do CSV e recarrega o índice se
+    o arquivo mudou.
+    """
+
+    def __init__(self, csv_path, cache_size=256, check_interval=1.0):
+        self.csv_path = csv_path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.index = None
+        self.signature = None
+        self.loaded_at = None
+        self._checked_at = 0.0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    def _signature(self):
+        stat = os.stat(self.csv_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def reload_if_changed(self, force=False):
+        """
+        Recarrega o índice se o CSV mudou desde a última carga. Retorna True se recarregou.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+            signature = self._signature()
+            if not force and signature == self.signature:
+                return False
+
+        start = time.perf_counter()
+        df = pd.read_csv(self.csv_path, keep_default_na=False,
+                         dtype={col: str for col in ('UF_ATENDIMENTO', 'SEXO', 'FAIXA_ETARIA', 'PROC_GRU_NOME',
+                                                     'REGIAO_CORPORAL_DETALHADA')})
+        index = AggregateIndex(df)
+        with self._lock:
+            self.index = index
+            self.signature = signature
+            self.loaded_at = time.time()
+            self._cache.clear()
+        print(f"Índice carregado: {len(index)} linhas de {self.csv_path} em {time.perf_counter() - start:.2f}s.",
+              file=sys.stderr)
+        return True
+
+    def query(self, filters=None, group_by=None):
+        """
+        Responde uma consulta (ver AggregateIndex.query). Retorna um dicionário com as
+        linhas do resultado e se ele veio do cache.
+        """
+        self.reload_if_changed()
+        filters = {col: values if isinstance(values, (list, tuple, set)) else [values]
+                   for col, values in (filters or {}).items()}
+        key = (tuple(sorted((col, tuple(sorted(str(v) for v in values))) for col, values in filters.items())),
+               tuple(group_by or ()))
+
+        with self._lock:
+            index = self.index
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return {'rows': self._cache[key], 'cached': True}
+
+        rows = index.query(filters, group_by)
+        with self._lock:
+            if index is self.index:
+                self._cache[key] = rows
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return {'rows': rows, 'cached': False}
+
+
+def parse_query_string(query_string):
+    """
+    Converte '?UF_ATENDIMENTO=MG,SP&group_by=PROC_GRU_NOME' em (filtros, group_by).
+    """
+    params = parse_qs(query_string, keep_blank_values=True)
+    group_by = [col for value in params.pop('group_by', []) for col in value.split(',') if col]
+    filters = {col: [v for value in values for v in value.split(',')] for col, values in params.items()}
+    return filters, group_by
+
+
+def make_handler(service):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                self._send_json(200, {'rows': len(service.index), 'csv': service.csv_path,
+                                      'loaded_at': service.loaded_at})
+                return
+            if url.path != '/query':
+                self._send_json(404, {'error': 'Use /query ou /health.'})
+                return
+            start = time.perf_counter()
+            try:
+                filters, group_by = parse_query_string(url.query)
+                result = service.query(filters, group_by)
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Servindo consultas em http://{host}:{port}/query (Ctrl+C para sair).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Consultas (filtros, group by e soma) sobre o CSV mestre do CIHA.")
+    parser.add_argument('--csv', default=os.path.join(base_dir, 'output', 'datasus_sumario_nacional_long.csv'),
+                        help="CSV mestre gerado por process_ciha_data.py.")
+    parser.add_argument('--filter', action='append', default=[], metavar='COLUNA=V1[,V2]',
+                        help="Filtro de uma coluna (pode ser repetido). Ex: --filter UF_ATENDIMENTO=MG,SP")
+    parser.add_argument('--group-by', nargs='*', default=[], help="Colunas do agrupamento.")
+    parser.add_argument('--serve', action='store_true', help="Sobe o servidor HTTP local de consultas.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=256, help="Máximo de resultados no cache LRU (padrão: 256).")
+    args = parser.parse_args()
+
+    service = QueryService(args.csv, cache_size=args.cache_size)
+    if args.serve:
+        serve(service, args.host, args.port)
+        sys.exit(0)
+
+    filters = {}
+    for item in args.filter:
+        col, sep, values = item.partition('=')
+        if not sep:
+            parser.error(f"Filtro inválido '{item}': use COLUNA=VALOR[,VALOR].")
+        filters.setdefault(col, []).extend(values.split(','))
+    start = time.perf_counter()
+    try:
+        result = service.query(filters, args.group_by)
+    except ValueError as e:
+        parser.error(str(e))
+    print(pd.DataFrame(result['rows']).to_string(index=False))
+    print(f"\n{len(result['rows'])} linhas em {(time.perf_counter() - start) * 1000:.1f} ms.", file=sys.stderr)
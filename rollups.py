@@ -0,0 +1,134 @@
+import json
+import os
+
+import pandas as pd
+
+
+VALUE_COLUMN = 'TOTAL_PROCEDIMENTOS'
+
+# Índice, dentro do diretório dos rollups, com as dimensões e o arquivo de cada rollup
+INDEX_FILENAME = '_rollups.json'
+
+# Rollups gravados por padrão: nome -> dimensões (colunas do DataFrame mestre).
+# 'modalidade' é o PROC_GRU_NOME (RM, TC, RX, ...).
+DEFAULT_ROLLUPS = {
+    'nacional': [],
+    'ano': ['ANO_ATENDIMENTO'],
+    'ano_mes': ['ANO_ATENDIMENTO', 'MES_ATENDIMENTO'],
+    'uf': ['UF_ATENDIMENTO'],
+    'uf_ano': ['UF_ATENDIMENTO', 'ANO_ATENDIMENTO'],
+    'uf_sexo': ['UF_ATENDIMENTO', 'SEXO'],
+    'modalidade_ano': ['PROC_GRU_NOME', 'ANO_ATENDIMENTO'],
+    'modalidade_ano_mes': ['PROC_GRU_NOME', 'ANO_ATENDIMENTO', 'MES_ATENDIMENTO'],
+    'uf_modalidade_ano': ['UF_ATENDIMENTO', 'PROC_GRU_NOME', 'ANO_ATENDIMENTO'],
+}
+
+
+def parse_rollup_specs(specs, dimensions):
+    """
+    Converte a lista de rollups da linha de comando em {nome: [dimensões]}.
+    Cada item é o nome de um rollup de DEFAULT_ROLLUPS, uma lista de colunas separadas
+    por '+' (ex: UF_ATENDIMENTO+SEXO) ou 'nome=COLUNA+COLUNA'. dimensions são as colunas
+    válidas (as de agrupamento do DataFrame mestre).
+    """
+    rollups = {}
+    for spec in specs:
+        if spec in DEFAULT_ROLLUPS:
+            rollups[spec] = list(DEFAULT_ROLLUPS[spec])
+            continue
+        name, _, columns = spec.rpartition('=')
+        columns = [col.strip() for col in columns.split('+') if col.strip()]
+        invalid = [col for col in columns if col not in dimensions]
+        if invalid or not columns:
+            raise ValueError(f"Rollup inválido '{spec}': use um de {sorted(DEFAULT_ROLLUPS)} "
+                             f"ou colunas de {dimensions} separadas por '+'.")
+        rollups[name or '_'.join(col.lower() for col in columns)] = columns
+    return rollups
+
+
+def materialize_rollups(final_df_long, rollups):
+    """
+    Calcula os rollups ({nome: [dimensões]}) do DataFrame mestre "long" numa única passada
+    pela rede de agregações: os rollups são calculados do mais detalhado para o menos
+    detalhado, e cada um a partir do menor rollup já calculado que contém as suas
+    dimensões. Só os mais detalhados percorrem a tabela completa.
+    Retorna {nome: DataFrame com as dimensões + TOTAL_PROCEDIMENTOS}, na ordem de rollups.
+    """
+    computed = {}
+    for name, dims in sorted(rollups.items(), key=lambda item: -len(item[1])):
+        parent = final_df_long
+        for other, df_other in computed.items():
+            if set(dims) <= set(rollups[other]) and len(df_other) < len(parent):
+                parent = df_other
+        if dims:
+            computed[name] = parent.groupby(dims, observed=True)[VALUE_COLUMN].sum().reset_index()
+        else:
+            computed[name] = pd.DataFrame({VALUE_COLUMN: [int(parent[VALUE_COLUMN].sum())]})
+    return {name: computed[name] for name in rollups}
+
+
+def write_rollups(rollup_dfs, directory, rollups):
+    """
+    Grava cada rollup em <directory>/<nome>.csv (de forma atômica) e o índice _rollups.json.
+    Rollups de uma gravação anterior que não estão mais na configuração são removidos.
+    """
+    os.makedirs(directory, exist_ok=True)
+    previous = load_rollup_index(directory)
+    index = {}
+    for name, df in rollup_dfs.items():
+        filename = f'{name}.csv'
+        path = os.path.join(directory, filename)
+        df.to_csv(path + '.tmp', index=False, encoding='utf-8')
+        os.replace(path + '.tmp', path)
+        index[name] = {'dimensions': rollups[name], 'file': filename, 'rows': int(len(df))}
+
+    for name, entry in previous.items():
+        if name not in index:
+            try:
+                os.remove(os.path.join(directory, entry['file']))
+            except OSError:
+                pass
+
+    path = os.path.join(directory, INDEX_FILENAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_rollup_index(directory):
+    path = os.path.join(directory, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _read_rollup_csv(directory, entry):
+    # Valores vazios das dimensões (ex: SEXO em branco) continuam sendo uma categoria, não NaN
+    return pd.read_csv(os.path.join(directory, entry['file']), keep_default_na=False)
+
+
+def read_rollup(directory, dimensions=None, name=None):
+    """
+    Lê um rollup gravado, pelo nome ou pelas dimensões desejadas. Sem um rollup com
+    exatamente essas dimensões, usa o menor que as contém e agrega só ele.
+    Retorna None se nenhum rollup servir (nesse caso, use o CSV mestre).
+    Ex: read_rollup('output/datasus_sumario_nacional_long_rollups', ['UF_ATENDIMENTO', 'SEXO'])
+    """
+    index = load_rollup_index(directory)
+    if name is not None:
+        entry = index.get(name)
+        return None if entry is None else _read_rollup_csv(directory, entry)
+
+    dimensions = list(dimensions or [])
+    candidates = [entry for entry in index.values() if set(dimensions) <= set(entry['dimensions'])]
+    if not candidates:
+        return None
+    entry = min(candidates, key=lambda entry: entry['rows'])
+    df = _read_rollup_csv(directory, entry)
+    if set(entry['dimensions']) == set(dimensions):
+        return df[dimensions + [VALUE_COLUMN]]
+    return materialize_rollups(df, {'_': dimensions})['_']
@@ -0,0 +1,132 @@
+"""
+Ordem e admissão dos arquivos .dbc no processamento em lote.
+
+Os arquivos do CIHA variam em ordens de grandeza (RR e AP são minúsculos, SP e MG são
+enormes). Na ordem do glob, um arquivo grande que fica para o fim segura a execução
+sozinho, e vários grandes ao mesmo tempo estouram a memória. schedule_files() ordena os
+arquivos do maior para o menor, pela estimativa da memória ocupada no processamento, e
+MemoryBudget limita a soma das estimativas dos arquivos em andamento.
+
+A estimativa vem do cabeçalho do DBF, que fica sem compressão no início do .dbc:
+número de registros x (tamanho do registro + memória das colunas decodificadas por
+registro). No modo streaming só chunk_size registros ficam em memória de cada vez. Os
+coeficientes saíram de medições com data/CIHAMG1605.dbc e com os arquivos sintéticos de
+benchmarks/synthetic_ciha.py; memory_calibration() compara as estimativas com os picos
+medidos em cada arquivo, para ajustá-los.
+"""
+import os
+import sys
+from collections import namedtuple
+
+from dbf_reader import read_dbf_layout
+
+
+# Memória além do próprio registro bruto, por registro em memória: colunas decodificadas,
+# máscaras do filtro e cópias do enriquecimento (medida com o pico do RSS por arquivo)
+DECODED_BYTES_PER_RECORD = {'pandas': 100, 'polars': 150}
+# Custo fixo por arquivo (DataFrames intermediários, classificador, etc.)
+BASE_BYTES_PER_FILE = 2 * 1024 ** 2
+# Razão aproximada entre o DBF descompactado e o .dbc, usada quando o cabeçalho não pode ser lido
+DBC_EXPANSION_RATIO = 6
+
+FileJob = namedtuple('FileJob', ['filepath', 'size_bytes', 'numrecords', 'estimated_bytes'])
+
+
+def estimate_file_memory(filepath, chunk_size=None, engine='pandas'):
+    """
+    Estima o pico de memória do processamento de um arquivo .dbc, a partir do número de
+    registros e do tamanho do registro no cabeçalho do DBF. Retorna um FileJob
+    (numrecords é None se o cabeçalho não pôde ser lido).
+    """
+    size_bytes = os.path.getsize(filepath)
+    extra = DECODED_BYTES_PER_RECORD.get(engine, DECODED_BYTES_PER_RECORD['pandas'])
+    try:
+        with open(filepath, 'rb') as f:
+            layout = read_dbf_layout(f)
+    except (OSError, ValueError):
+        layout = None
+
+    if layout is None or layout.recordlen == 0:
+        # Sem cabeçalho legível: supõe registros do tamanho médio dos arquivos do CIHA
+        estimated = BASE_BYTES_PER_FILE + size_bytes * DBC_EXPANSION_RATIO
+        return FileJob(filepath, size_bytes, None, estimated)
+
+    records_in_memory = min(layout.numrecords, chunk_size) if chunk_size else layout.numrecords
+    estimated = BASE_BYTES_PER_FILE + records_in_memory * (layout.recordlen + extra)
+    return FileJob(filepath, size_bytes, layout.numrecords, estimated)
+
+
+def schedule_files(filepaths, chunk_size=None, engine='pandas'):
+    """
+    FileJobs dos arquivos, do maior para o menor consumo de memória estimado (empates
+    pelo tamanho em disco e pelo nome, para a ordem ser estável).
+    """
+    jobs = [estimate_file_memory(filepath, chunk_size, engine) for filepath in filepaths]
+    return sorted(jobs, key=lambda job: (-job.estimated_bytes, -job.size_bytes, job.filepath))
+
+
+class MemoryBudget:
+    """
+    Admissão dos arquivos em andamento sob um limite de memória: um arquivo só começa se
+    a soma das estimativas dos arquivos em andamento, mais a dele, couber em
+    budget_bytes. Um arquivo sozinho é sempre admitido, mesmo acima do limite (com um
+    aviso), para a execução não travar. budget_bytes=None desliga o limite.
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+        self.running = 0
+
+    def admits(self, job):
+        if self.budget_bytes is None or self.running == 0:
+            return True
+        return self.in_flight_bytes + job.estimated_bytes <= self.budget_bytes
+
+    def start(self, job):
+        if self.budget_bytes is not None and job.estimated_bytes > self.budget_bytes:
+            print(f"  - AVISO: {os.path.basename(job.filepath)} deve usar cerca de "
+                  f"{job.estimated_bytes / 1024 ** 2:.0f} MB, acima do limite de memória "
+                  f"({self.budget_bytes / 1024 ** 2:.0f} MB). Processando sozinho.", file=sys.stderr)
+        self.running += 1
+        self.in_flight_bytes += job.estimated_bytes
+        self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+
+    def finish(self, job):
+        self.running -= 1
+        self.in_flight_bytes -= job.estimated_bytes
+
+
+def memory_calibration(records):
+    """
+    Compara a memória estimada com o pico medido de cada arquivo, a partir das medições
+    da etapa 'arquivo' (campos mem_estimated_mb e mem_peak_mb, ver
+    process_ciha_data._process_file_task). Retorna uma lista de dicionários (arquivo,
+    estimado, medido, razão medido/estimado), do maior pico para o menor.
+    """
+    rows = []
+    for record in records:
+        if record.get('stage') != 'arquivo' or record.get('mem_peak_mb') is None:
+            continue
+        estimated = record.get('mem_estimated_mb')
+        rows.append({'file': record.get('file'), 'estimated_mb': estimated, 'peak_mb': record['mem_peak_mb'],
+                     'ratio': round(record['mem_peak_mb'] / estimated, 2) if estimated else None})
+    return sorted(rows, key=lambda row: -row['peak_mb'])
+
+
+def print_memory_calibration(rows, limit=20):
+    """
+    Imprime a tabela de memory_calibration (os limit arquivos de maior pico).
+    """
+    if not rows:
+        return
+    print("\nMemória por arquivo (estimada x pico medido):")
+    for row in rows[:limit]:
+        ratio = f"{row['ratio']:.2f}" if row['ratio'] is not None else '-'
+        print(f"  {row['file']:<18} estimada {row['estimated_mb'] or 0:8.1f} MB  medida {row['peak_mb']:8.1f} MB  "
+              f"razão {ratio}")
+    ratios = sorted(row['ratio'] for row in rows if row['ratio'] is not None)
+    if ratios:
+        print(f"  Razão medido/estimado: mediana {ratios[len(ratios) // 2]:.2f}, máxima {ratios[-1]:.2f} "
+              f"({len(ratios)} arquivos)")
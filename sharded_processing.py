@@ -0,0 +1,536 @@
+"""
+Processamento distribuído dos arquivos .dbc por vários trabalhadores (na mesma máquina
+ou em várias), coordenados só por um diretório de trabalho compartilhado (ex: NFS).
+
+Cada trabalhador percorre os .dbc do diretório de entrada e reserva um arquivo criando
+o seu arquivo de reserva (lease) com O_CREAT | O_EXCL: só um trabalhador consegue. Enquanto
+processa, renova o mtime da reserva (heartbeat). Uma reserva sem renovação há mais de
+lease_timeout segundos é de um trabalhador que morreu e é retomada por outro. O agregado
+de cada arquivo é gravado na pasta de resultados (um .pkl + um .json que marca o
+resultado como pronto), numa subpasta por versão dos mapeamentos: depois de uma mudança
+nos mapeamentos, todos os arquivos são reprocessados. O comando merge soma os resultados
+e grava as mesmas saídas de main_processing_script.
+
+Layout do diretório de trabalho:
+    <work_dir>/leases/<arquivo>.lease
+    <work_dir>/results/<versão>/<arquivo>.pkl, <arquivo>.json (ou <arquivo>.failed.json)
+
+Uso (teste local com 3 trabalhadores):
+    python sharded_processing.py worker --input-dir data --work-dir /tmp/ciha_work --processes 3
+    python sharded_processing.py status --input-dir data --work-dir /tmp/ciha_work
+    python sharded_processing.py merge --input-dir data --work-dir /tmp/ciha_work
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+import pandas as pd
+
+from count_accumulator import CountAccumulator
+from dbf_cache import DEFAULT_MAX_BYTES as DEFAULT_DBF_CACHE_MAX_BYTES, DbfCache
+from engines import ENGINE_NAMES
+from instrumentation import Instrumentation, get_instrumentation, set_instrumentation
+from process_ciha_data import (DEFAULT_CHUNK_SIZE, FINAL_GROUPING_COLS, PROC_REA_PREFIXES, aggregate_cache_version,
+                               excelll, pool_context, process_single_dbc_file, write_master_outputs)
+from rollups import DEFAULT_ROLLUPS, parse_rollup_specs
+
+
+DEFAULT_LEASE_TIMEOUT = 600
+DEFAULT_POLL_INTERVAL = 10.0
+LEASE_SUFFIX = '.lease'
+FAILED_SUFFIX = '.failed.json'
+
+
+class WorkDir:
+    """
+    Diretório de trabalho compartilhado: reservas (leases) e resultados de uma versão dos
+    mapeamentos. Os arquivos são identificados pelo nome (ex: CIHAMG1605.dbc), já que o
+    caminho do diretório compartilhado pode ser diferente em cada máquina.
+    """
+
+    def __init__(self, work_dir, version, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.work_dir = work_dir
+        self.version = version
+        self.lease_timeout = lease_timeout
+        self.lease_dir = os.path.join(work_dir, 'leases')
+        self.results_dir = os.path.join(work_dir, 'results', version[:16])
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.results_dir, exist_ok=True)
+
+    def lease_path(self, filename):
+        return os.path.join(self.lease_dir, filename + LEASE_SUFFIX)
+
+    def _result_base(self, filename):
+        return os.path.join(self.results_dir, filename)
+
+    # --- Resultados ---
+
+    def result_entry(self, filepath):
+        """
+        Metadados do resultado pronto de filepath, ou None se não houver resultado válido
+        (ausente, de outra versão ou de uma versão anterior do arquivo .dbc).
+        """
+        try:
+            with open(self._result_base(os.path.basename(filepath)) + '.json', 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stat = os.stat(filepath)
+        except (OSError, ValueError):
+            return None
+        if (entry.get('version') != self.version or entry.get('size') != stat.st_size
+                or entry.get('mtime_ns') != stat.st_mtime_ns):
+            return None
+        return entry
+
+    def failure_entry(self, filepath):
+        """
+        Metadados da falha registrada para filepath (mesma versão do arquivo), ou None.
+        """
+        try:
+            with open(self._result_base(os.path.basename(filepath)) + FAILED_SUFFIX, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stat = os.stat(filepath)
+        except (OSError, ValueError):
+            return None
+        if entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def _write_json(self, path, payload):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _source_stat(self, filepath):
+        stat = os.stat(filepath)
+        return {'file': os.path.basename(filepath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def put_result(self, filepath, df_agg, worker, elapsed):
+        """
+        Grava o agregado de filepath: primeiro o .pkl e depois o .json, que marca o
+        resultado como pronto (os dois de forma atômica).
+        """
+        base = self._result_base(os.path.basename(filepath))
+        df_agg.to_pickle(base + '.pkl.tmp')
+        os.replace(base + '.pkl.tmp', base + '.pkl')
+        entry = dict(self._source_stat(filepath), version=self.version, worker=worker, rows=int(len(df_agg)),
+                     seconds=round(elapsed, 3), finished_at=time.time())
+        self._write_json(base + '.json', entry)
+        try:
+            os.remove(base + FAILED_SUFFIX)
+        except OSError:
+            pass
+
+    def put_failure(self, filepath, worker, error):
+        self._write_json(self._result_base(os.path.basename(filepath)) + FAILED_SUFFIX,
+                         dict(self._source_stat(filepath), worker=worker, error=error, failed_at=time.time()))
+
+    def clear_failures(self):
+        for path in glob.glob(os.path.join(self.results_dir, '*' + FAILED_SUFFIX)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def read_result(self, filepath):
+        return pd.read_pickle(self._result_base(os.path.basename(filepath)) + '.pkl')
+
+    # --- Reservas ---
+
+    def try_claim(self, filename, owner):
+        """
+        Tenta reservar filename para owner ({'worker': ..., 'token': ...}). Uma reserva
+        vencida (sem heartbeat há mais de lease_timeout segundos) é retomada.
+        Retorna True se a reserva é de owner.
+        """
+        path = self.lease_path(filename)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._reclaim_if_stale(path, owner):
+                    return False
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(dict(owner, claimed_at=time.time()), f)
+            return True
+        return False
+
+    def _is_stale(self, path):
+        return time.time() - os.stat(path).st_mtime > self.lease_timeout
+
+    def _reclaim_if_stale(self, path, owner):
+        """
+        Remove uma reserva vencida. O rename é atômico: se dois trabalhadores tentarem
+        retomar a mesma reserva, só um consegue movê-la. Se, entre a checagem e o rename,
+        a reserva foi renovada (ou recriada), ela é devolvida ao lugar.
+        """
+        try:
+            if not self._is_stale(path):
+                return False
+        except FileNotFoundError:
+            return True # Liberada nesse meio-tempo: tenta reservar de novo
+        moved = f"{path}.stale.{owner['token']}"
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return True
+        try:
+            if not self._is_stale(moved):
+                try:
+                    os.link(moved, path) # Devolve a reserva ativa (falha se outra já foi criada)
+                except OSError:
+                    pass
+                return False
+            previous = self.read_lease(moved)
+            print(f"Reserva vencida de {os.path.basename(path)[:-len(LEASE_SUFFIX)]} "
+                  f"(trabalhador {previous.get('worker', '?')}) retomada.")
+            return True
+        finally:
+            try:
+                os.remove(moved)
+            except OSError:
+                pass
+
+    def read_lease(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def owns(self, filename, owner):
+        return self.read_lease(self.lease_path(filename)).get('token') == owner['token']
+
+    def heartbeat(self, filename, owner):
+        """
+        Renova a reserva (mtime). Retorna False se a reserva não é mais de owner.
+        """
+        if not self.owns(filename, owner):
+            return False
+        try:
+            os.utime(self.lease_path(filename))
+        except OSError:
+            return False
+        return True
+
+    def release(self, filename, owner):
+        if self.owns(filename, owner):
+            try:
+                os.remove(self.lease_path(filename))
+            except OSError:
+                pass
+
+    def active_leases(self):
+        """
+        Reservas em vigor: {arquivo: dados da reserva}, sem as vencidas.
+        """
+        leases = {}
+        for path in glob.glob(os.path.join(self.lease_dir, '*' + LEASE_SUFFIX)):
+            try:
+                if self._is_stale(path):
+                    continue
+            except OSError:
+                continue
+            leases[os.path.basename(path)[:-len(LEASE_SUFFIX)]] = self.read_lease(path)
+        return leases
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renova a reserva de um arquivo a cada interval segundos enquanto ele é processado.
+    """
+
+    def __init__(self, work, filename, owner, interval):
+        super().__init__(daemon=True)
+        self.work = work
+        self.filename = filename
+        self.owner = owner
+        self.interval = interval
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if not self.work.heartbeat(self.filename, self.owner):
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def work_version(proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None):
+    # Mesma versão do cache de agregados: os resultados só valem para os mesmos mapeamentos
+    return aggregate_cache_version(proc_rea_prefixes, classification_table)
+
+
+def list_dbc_files(input_dir):
+    return sorted(glob.glob(os.path.join(input_dir, '*.dbc')))
+
+
+def run_worker(input_dir, work_dir, worker_id=None, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+               poll_interval=DEFAULT_POLL_INTERVAL, max_files=None, wait=True, retry_failed=False,
+               chunk_size=None, proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None, dbf_cache=None,
+               engine='pandas'):
+    """
+    Laço de um trabalhador: reserva um arquivo sem resultado pronto, processa com
+    process_single_dbc_file, grava o agregado e libera a reserva, até não sobrar arquivo.
+    Com wait=True, se os arquivos restantes estiverem reservados por outros trabalhadores,
+    espera poll_interval segundos e tenta de novo (retomando as reservas que vencerem);
+    com wait=False, termina. max_files limita os arquivos processados por este trabalhador.
+    retry_failed=True descarta as falhas registradas e tenta esses arquivos de novo.
+    Retorna o número de arquivos processados.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    owner = {'worker': worker_id, 'token': uuid.uuid4().hex, 'host': socket.gethostname(), 'pid': os.getpid()}
+    work = WorkDir(work_dir, work_version(proc_rea_prefixes, classification_table), lease_timeout)
+    if retry_failed:
+        work.clear_failures()
+    heartbeat_interval = max(lease_timeout / 4, 0.05)
+    processed = 0
+
+    while max_files is None or processed < max_files:
+        remaining = [filepath for filepath in list_dbc_files(input_dir)
+                     if work.result_entry(filepath) is None and work.failure_entry(filepath) is None]
+        if not remaining:
+            break
+        claimed = False
+        for filepath in remaining:
+            filename = os.path.basename(filepath)
+            if not work.try_claim(filename, owner):
+                continue
+            # Outro trabalhador pode ter terminado o arquivo entre a listagem e a reserva
+            if work.result_entry(filepath) is not None:
+                work.release(filename, owner)
+                continue
+            claimed = True
+            heartbeat = _Heartbeat(work, filename, owner, heartbeat_interval)
+            heartbeat.start()
+            start = time.perf_counter()
+            try:
+                print(f"[{worker_id}] Processando {filename}")
+                df_agg = process_single_dbc_file(filepath, chunk_size=chunk_size, proc_rea_prefixes=proc_rea_prefixes,
+                                                 classification_table=classification_table, dbf_cache=dbf_cache,
+                                                 engine=engine)
+                if df_agg is None:
+                    work.put_failure(filepath, worker_id, "process_single_dbc_file retornou None")
+                else:
+                    # O resultado é determinístico: mesmo que a reserva tenha sido retomada
+                    # por outro trabalhador, gravar o mesmo agregado de novo é inofensivo
+                    work.put_result(filepath, df_agg, worker_id, time.perf_counter() - start)
+                    processed += 1
+            except Exception:
+                work.put_failure(filepath, worker_id, traceback.format_exc())
+                print(f"[{worker_id}] ERRO ao processar {filename}", file=sys.stderr)
+            finally:
+                heartbeat.stop()
+                if heartbeat.lost:
+                    print(f"[{worker_id}] AVISO: a reserva de {filename} foi retomada por outro trabalhador.",
+                          file=sys.stderr)
+                work.release(filename, owner)
+            break # Lista de novo: outros trabalhadores podem ter terminado arquivos nesse meio-tempo
+
+        if not claimed:
+            if not wait:
+                break
+            time.sleep(poll_interval)
+
+    print(f"[{worker_id}] Fim: {processed} arquivos processados.")
+    return processed
+
+
+def run_workers(processes, input_dir, work_dir, **worker_kwargs):
+    """
+    Inicia processes trabalhadores (processos independentes) nesta máquina e espera
+    todos terminarem. Retorna os códigos de saída.
+    """
+    if processes <= 1:
+        run_worker(input_dir, work_dir, **worker_kwargs)
+        return [0]
+    hostname = socket.gethostname()
+    context = pool_context(worker_kwargs.get('engine')) or multiprocessing
+    workers = []
+    for i in range(processes):
+        kwargs = dict(worker_kwargs, worker_id=f"{worker_kwargs.get('worker_id') or hostname}-{i + 1}")
+        process = context.Process(target=run_worker, args=(input_dir, work_dir), kwargs=kwargs)
+        process.start()
+        workers.append(process)
+    for process in workers:
+        process.join()
+    return [process.exitcode for process in workers]
+
+
+def work_status(input_dir, work_dir, lease_timeout=DEFAULT_LEASE_TIMEOUT, proc_rea_prefixes=PROC_REA_PREFIXES,
+                classification_table=None):
+    """
+    Situação de cada arquivo no diretório de trabalho: {'done': [...], 'failed': [...],
+    'leased': {arquivo: trabalhador}, 'pending': [...]} (caminhos dos .dbc).
+    """
+    work = WorkDir(work_dir, work_version(proc_rea_prefixes, classification_table), lease_timeout)
+    leases = work.active_leases()
+    status = {'done': [], 'failed': [], 'leased': {}, 'pending': []}
+    for filepath in list_dbc_files(input_dir):
+        filename = os.path.basename(filepath)
+        if work.result_entry(filepath) is not None:
+            status['done'].append(filepath)
+        elif work.failure_entry(filepath) is not None:
+            status['failed'].append(filepath)
+        elif filename in leases:
+            status['leased'][filepath] = leases[filename].get('worker', '?')
+        else:
+            status['pending'].append(filepath)
+    return status
+
+
+def merge_results(input_dir, work_dir, output_file_csv_master, parquet_dir=None, rollups=None, rollup_dir=None,
+                  allow_partial=False, proc_rea_prefixes=PROC_REA_PREFIXES, classification_table=None,
+                  lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    """
+    Soma os agregados gravados pelos trabalhadores e grava as mesmas saídas de
+    main_processing_script (CSV mestre, rollups, Parquet; ver write_master_outputs).
+    Se ainda houver arquivos sem resultado (pendentes ou reservados), não grava nada,
+    a não ser com allow_partial=True (nesse caso eles são listados como falhas). Reservas
+    sem heartbeat há mais de lease_timeout segundos contam como pendentes.
+    Retorna o DataFrame mestre "long" ou None.
+    """
+    status = work_status(input_dir, work_dir, lease_timeout, proc_rea_prefixes=proc_rea_prefixes,
+                         classification_table=classification_table)
+    unfinished = status['pending'] + list(status['leased'])
+    if unfinished and not allow_partial:
+        print(f"{len(unfinished)} arquivos ainda sem resultado (use --allow-partial para consolidar assim mesmo):")
+        for filepath in unfinished:
+            print(f"  - {filepath}")
+        return None
+
+    version = work_version(proc_rea_prefixes, classification_table)
+    work = WorkDir(work_dir, version, lease_timeout)
+    dbc_filepaths = list_dbc_files(input_dir)
+    accumulator = CountAccumulator(FINAL_GROUPING_COLS)
+    done = set(status['done'])
+    results = {}
+    for filepath in dbc_filepaths:
+        results[filepath] = filepath in done
+        if results[filepath]:
+            accumulator.add(work.read_result(filepath))
+    print(f"Resultados: {len(status['done'])} arquivos processados, {len(status['failed'])} com falha, "
+          f"{len(unfinished)} sem resultado.")
+    return write_master_outputs(dbc_filepaths, results, accumulator, output_file_csv_master, parquet_dir,
+                                rollups, rollup_dir, data_version=version)
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Processamento distribuído dos arquivos .dbc do CIHA com um "
+                                                 "diretório de trabalho compartilhado.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="Processa arquivos até não sobrar nenhum sem resultado.")
+    status_parser = subparsers.add_parser('status', help="Mostra a situação dos arquivos no diretório de trabalho.")
+    merge_parser = subparsers.add_parser('merge', help="Soma os resultados e grava o CSV mestre e demais saídas.")
+
+    for sub in (worker_parser, status_parser, merge_parser):
+        sub.add_argument('--input-dir', default=os.path.join(base_dir, 'data'),
+                         help="Diretório compartilhado dos arquivos .dbc (padrão: data).")
+        sub.add_argument('--work-dir', required=True,
+                         help="Diretório de trabalho compartilhado (reservas e resultados).")
+        sub.add_argument('--proc-rea-prefixes', nargs='+', default=list(PROC_REA_PREFIXES),
+                         help="Prefixos do PROC_REA mantidos (padrão: 02).")
+        sub.add_argument('--classification-table', default=None,
+                         help="Tabela de referência do PROC_REA (ver process_ciha_data.py).")
+        sub.add_argument('--lease-timeout', type=float, default=DEFAULT_LEASE_TIMEOUT,
+                         help=f"Segundos sem heartbeat para uma reserva ser considerada vencida "
+                              f"(padrão: {DEFAULT_LEASE_TIMEOUT}).")
+
+    worker_parser.add_argument('--processes', type=int, default=1,
+                               help="Número de trabalhadores iniciados nesta máquina (padrão: 1).")
+    worker_parser.add_argument('--worker-id', default=None, help="Nome do trabalhador (padrão: <host>-<pid>).")
+    worker_parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                               help="Espera entre as tentativas quando os arquivos restantes estão reservados "
+                                    f"(padrão: {DEFAULT_POLL_INTERVAL}s).")
+    worker_parser.add_argument('--no-wait', action='store_true',
+                               help="Termina quando não houver arquivo livre, sem esperar as reservas de outros.")
+    worker_parser.add_argument('--max-files', type=int, default=None,
+                               help="Máximo de arquivos processados por trabalhador.")
+    worker_parser.add_argument('--retry-failed', action='store_true',
+                               help="Tenta de novo os arquivos com falha registrada.")
+    worker_parser.add_argument('--chunk-size', type=int, default=None, nargs='?', const=DEFAULT_CHUNK_SIZE,
+                               help="Modo streaming do processamento (ver process_ciha_data.py).")
+    worker_parser.add_argument('--engine', choices=ENGINE_NAMES, default='pandas',
+                               help="Motor do enriquecimento e da agregação (ver process_ciha_data.py).")
+    worker_parser.add_argument('--dbf-cache-dir', default=None,
+                               help="Cache local dos DBFs descompactados (ver process_ciha_data.py).")
+    worker_parser.add_argument('--dbf-cache-max-gb', type=float, default=DEFAULT_DBF_CACHE_MAX_BYTES / 1024 ** 3,
+                               help="Espaço máximo do cache de DBFs, em GB.")
+
+    merge_parser.add_argument('--output-csv', default=os.path.join(base_dir, 'output', 'datasus_sumario_nacional_long.csv'),
+                              help="CSV mestre (padrão: output/datasus_sumario_nacional_long.csv).")
+    merge_parser.add_argument('--allow-partial', action='store_true',
+                              help="Consolida mesmo com arquivos ainda sem resultado.")
+    merge_parser.add_argument('--parquet-dir', default=None, nargs='?', const='',
+                              help="Grava também o dataset Parquet particionado (padrão: output/datasus_sumario_nacional_parquet).")
+    merge_parser.add_argument('--excel', action='store_true',
+                              help="Grava também o Excel consolidado por UF (output/resumo_consolidado_por_uf.xlsx).")
+    merge_parser.add_argument('--rollups', nargs='+', default=list(DEFAULT_ROLLUPS), metavar='ROLLUP',
+                              help="Agregações pré-calculadas gravadas ao lado do CSV mestre (ver process_ciha_data.py).")
+    merge_parser.add_argument('--no-rollups', action='store_true', help="Não grava os rollups.")
+    merge_parser.add_argument('--report', default=None,
+                              help="Arquivo JSON do relatório da consolidação (padrão: sem relatório).")
+    args = parser.parse_args()
+
+    mapping_kwargs = dict(proc_rea_prefixes=tuple(args.proc_rea_prefixes),
+                          classification_table=args.classification_table)
+
+    if args.command == 'worker':
+        dbf_cache = None
+        if args.dbf_cache_dir:
+            dbf_cache = DbfCache(args.dbf_cache_dir, max_bytes=int(args.dbf_cache_max_gb * 1024 ** 3))
+        exit_codes = run_workers(args.processes, args.input_dir, args.work_dir, worker_id=args.worker_id,
+                                 lease_timeout=args.lease_timeout, poll_interval=args.poll_interval,
+                                 max_files=args.max_files, wait=not args.no_wait, retry_failed=args.retry_failed,
+                                 chunk_size=args.chunk_size, dbf_cache=dbf_cache, engine=args.engine,
+                                 **mapping_kwargs)
+        sys.exit(0 if all(code == 0 for code in exit_codes) else 1)
+
+    if args.command == 'status':
+        status = work_status(args.input_dir, args.work_dir, args.lease_timeout, **mapping_kwargs)
+        print(f"Processados: {len(status['done'])}  Com falha: {len(status['failed'])}  "
+              f"Reservados: {len(status['leased'])}  Pendentes: {len(status['pending'])}")
+        for filepath, worker in status['leased'].items():
+            print(f"  - {os.path.basename(filepath)}: reservado por {worker}")
+        for filepath in status['failed']:
+            print(f"  - {os.path.basename(filepath)}: falhou")
+        sys.exit(0)
+
+    rollups = None
+    if not args.no_rollups:
+        try:
+            rollups = parse_rollup_specs(args.rollups, FINAL_GROUPING_COLS)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.report:
+        set_instrumentation(Instrumentation(enabled=True))
+
+    parquet_dir = None
+    if args.parquet_dir is not None:
+        parquet_dir = args.parquet_dir or os.path.join(base_dir, 'output', 'datasus_sumario_nacional_parquet')
+
+    final_df_long = merge_results(args.input_dir, args.work_dir, args.output_csv, parquet_dir=parquet_dir,
+                                  rollups=rollups, allow_partial=args.allow_partial,
+                                  lease_timeout=args.lease_timeout, **mapping_kwargs)
+    if final_df_long is not None and args.excel:
+        excelll(final_df_long, os.path.join(base_dir, 'output', 'resumo_consolidado_por_uf.xlsx'))
+
+    if args.report:
+        get_instrumentation().write_report(args.report, script='sharded_processing', work_dir=args.work_dir)
+        print(f"Relatório da consolidação salvo em: {args.report}")
+    sys.exit(0 if final_df_long is not None else 1)
@@ -0,0 +1,49 @@
+"""
+FAIXA_ETARIA com IDADE numérica (campo 'N' do DBF, float com vazios) e texto, nos dois
+motores, contra a regra original calculate_age_group aplicada linha a linha.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('datasus')
+import process_ciha_data
+
+FLOAT_AGES = [45.0, 45.7, 0.0, 9.0, 10.0, 79.9, 80.0, 99.0, 130.0, -1.0, -0.5, np.nan]
+TEXT_AGES = ['45', ' 45', '45.0', '', '9', '80', 'abc', '-1']
+
+
+def _records(ages):
+    n = len(ages)
+    return pd.DataFrame({
+        'SEXO': pd.Series(['1', '3'] * n)[:n].to_numpy(),
+        'IDADE': ages,
+        'PROC_REA': ['0204030030'] * n,
+    })
+
+
+def _expected(df):
+    faixas = df['IDADE'].map(process_ciha_data.calculate_age_group)
+    return faixas.value_counts().sort_index()
+
+
+def _engine_counts(df, engine_name):
+    engine = process_ciha_data.get_engine(engine_name)
+    counts = engine.count(engine.enrich(df, process_ciha_data.PROC_REA_PREFIXES, process_ciha_data.DEFAULT_CLASSIFIER))
+    totals = counts.groupby('FAIXA_ETARIA', observed=True)['TOTAL_PROCEDIMENTOS'].sum()
+    totals.index = totals.index.astype(str)
+    return totals[totals > 0].sort_index()
+
+
+@pytest.mark.parametrize('engine_name', ['pandas', 'polars'])
+@pytest.mark.parametrize('ages', [np.array(FLOAT_AGES, dtype=np.float64),
+                                  np.array([a for a in FLOAT_AGES if np.isfinite(a)]).astype(np.int64),
+                                  TEXT_AGES],
+                         ids=['float', 'int', 'text'])
+def test_age_groups_match_calculate_age_group(engine_name, ages):
+    if engine_name == 'polars':
+        pytest.importorskip('polars')
+    df = _records(ages)
+    expected = _expected(df)
+    result = _engine_counts(df, engine_name)
+    assert result.to_dict() == {label: int(count) for label, count in expected.items()}
@@ -0,0 +1,135 @@
+"""
+Downloads FTP contra um servidor local (pyftpdlib) numa porta livre, servindo um
+diretório temporário com o layout do DATASUS.
+"""
+import logging
+import os
+import socket
+import threading
+
+import pytest
+
+pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+import download_ciha_data
+
+REMOTE_DIR = 'dissemin/publicos/CIHA/201101_/Dados'
+REMOTE_FILES = {
+    'CIHAAC1101.dbc': b'AC' * 5000,
+    'CIHAAL1101.dbc': b'AL' * 7000,
+}
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    """
+    Servidor FTP anônimo local. Retorna a URL base do diretório dos arquivos.
+    """
+    root = tmp_path / 'servidor'
+    remote = root / REMOTE_DIR
+    remote.mkdir(parents=True)
+    for name, content in REMOTE_FILES.items():
+        (remote / name).write_bytes(content)
+
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(root))
+    handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+    server = FTPServer(('127.0.0.1', 0), handler)
+    port = server.socket.getsockname()[1]
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.05}, daemon=True)
+    thread.start()
+    yield f"ftp://127.0.0.1:{port}/{REMOTE_DIR}/"
+    server.close_all()
+    thread.join(timeout=5)
+
+
+def test_download_uses_url_port(ftp_server, tmp_path):
+    target = tmp_path / 'data'
+    assert download_ciha_data.download_single_file(ftp_server + 'CIHAAC1101.dbc', str(target))
+    assert (target / 'CIHAAC1101.dbc').read_bytes() == REMOTE_FILES['CIHAAC1101.dbc']
+
+
+def test_concurrent_download_reports_missing_files(ftp_server, tmp_path):
+    target = tmp_path / 'data'
+    urls = [ftp_server + name for name in ('CIHAAC1101.dbc', 'CIHAAP1101.dbc', 'CIHAAL1101.dbc')]
+    failed = download_ciha_data.download_concurrent(urls, str(target), workers=2, requests_per_second=0)
+    assert failed == [ftp_server + 'CIHAAP1101.dbc']
+    for name, content in REMOTE_FILES.items():
+        assert (target / name).read_bytes() == content
+
+
+
+def test_listed_download_uses_url_port(ftp_server, tmp_path):
+    target = tmp_path / 'data'
+    wanted = ['CIHAAC1101.dbc', 'CIHAAP1101.dbc', 'CIHAAL1101.dbc']
+    failed = download_ciha_data.download_listed_ftp(ftp_server, str(target), wanted_names=wanted, sessions=2)
+    assert failed == []
+    assert sorted(os.listdir(target)) == sorted(REMOTE_FILES)
+
+
+@pytest.mark.parametrize('unreachable', ['closed_port', 'missing_dir'])
+def test_listed_download_reports_listing_failure(ftp_server, tmp_path, unreachable):
+    if unreachable == 'closed_port':
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            base_url = f"ftp://127.0.0.1:{sock.getsockname()[1]}/{REMOTE_DIR}/"
+    else:
+        base_url = ftp_server.replace('/Dados/', '/Inexistente/')
+    wanted = ['CIHAAC1101.dbc', 'CIHAAL1101.dbc']
+    failed = download_ciha_data.download_listed_ftp(base_url, str(tmp_path / 'data'), wanted_names=wanted)
+    assert failed == [base_url + name for name in wanted]
+
+
+@pytest.mark.parametrize('mode', ['serial', 'concurrent'])
+def test_missing_files_leave_no_part_or_manifest_entry(ftp_server, tmp_path, mode):
+    target = tmp_path / 'data'
+    target.mkdir()
+    # Resto de uma execução anterior: parcial vazio e entrada incompleta de um arquivo inexistente
+    (target / ('CIHARR1101.dbc' + download_ciha_data.PART_SUFFIX)).write_bytes(b'')
+    manifest = download_ciha_data.DownloadManifest(str(target))
+    manifest.start('CIHARR1101.dbc', {'size': None, 'mdtm': None})
+
+    names = ['CIHAAC1101.dbc', 'CIHAAP1101.dbc', 'CIHARR1101.dbc', 'CIHAAL1101.dbc']
+    urls = [ftp_server + name for name in names]
+    if mode == 'serial':
+        failed = download_ciha_data.download_serial(urls, str(target), 0, manifest=manifest)
+    else:
+        failed = download_ciha_data.download_concurrent(urls, str(target), workers=2, requests_per_second=0,
+                                                        manifest=manifest)
+
+    assert failed == [ftp_server + 'CIHAAP1101.dbc', ftp_server + 'CIHARR1101.dbc']
+    assert sorted(os.listdir(target)) == sorted(list(REMOTE_FILES) + [download_ciha_data.DownloadManifest.FILENAME])
+    entries = download_ciha_data.DownloadManifest(str(target)).entries
+    assert sorted(entries) == sorted(REMOTE_FILES)
+    assert all(entry['complete'] for entry in entries.values())
+
+
+def test_refused_retr_leaves_no_part(ftp_server, tmp_path):
+    # Metadados já conhecidos (como na listagem): o 550 só aparece no RETR
+    target = tmp_path / 'data'
+    target.mkdir()
+    manifest = download_ciha_data.DownloadManifest(str(target))
+    local_filepath = str(target / 'CIHAAP1101.dbc')
+    with download_ciha_data.open_ftp('127.0.0.1', int(ftp_server.split(':')[2].split('/')[0])) as ftp:
+        with pytest.raises(download_ciha_data.error_perm):
+            download_ciha_data._ftp_fetch(ftp, f"/{REMOTE_DIR}/CIHAAP1101.dbc", local_filepath, manifest,
+                                          remote_meta={'size': 10, 'mdtm': '20110101000000'})
+    assert os.listdir(target) == []
+    assert manifest.entries == {}
+
+
+def test_manifest_writes_are_batched(tmp_path):
+    manifest = download_ciha_data.DownloadManifest(str(tmp_path), flush_every=3, flush_interval=3600)
+    manifest_path = tmp_path / download_ciha_data.DownloadManifest.FILENAME
+    for i in range(2):
+        manifest.complete(f"CIHAAC11{i:02d}.dbc", {'size': i, 'mdtm': None})
+    assert not manifest_path.exists()
+    manifest.complete('CIHAAC1102.dbc', {'size': 2, 'mdtm': None})
+    assert len(download_ciha_data.DownloadManifest(str(tmp_path)).entries) == 3
+    manifest.complete('CIHAAC1103.dbc', {'size': 3, 'mdtm': None})
+    manifest.flush()
+    assert len(download_ciha_data.DownloadManifest(str(tmp_path)).entries) == 4
@@ -0,0 +1,15 @@
+"""
+Paridade entre os motores pandas e polars (engines.py) no arquivo de referência
+data/CIHAMG1605.dbc: mesmo TOTAL_PROCEDIMENTOS em cada grupo, no modo normal e no
+modo streaming. Os tempos de cada motor ficam em benchmarks/engine_parity.py.
+"""
+import pytest
+
+pytest.importorskip('datasus')
+pytest.importorskip('polars')
+from benchmarks.engine_parity import GOLDEN_DBC, compare
+
+
+@pytest.mark.parametrize('chunk_size', [None, 50000], ids=['normal', 'blocos'])
+def test_engines_give_the_same_totals(chunk_size):
+    assert compare(GOLDEN_DBC, chunk_size) == []
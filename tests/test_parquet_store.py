@@ -0,0 +1,45 @@
+"""
+Regravação incremental do dataset Parquet (parquet_store.write_parquet_dataset).
+"""
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+import parquet_store
+
+
+def _master(total):
+    return pd.DataFrame({
+        'UF_ATENDIMENTO': ['AC', 'AC', 'MG'],
+        'ANO_ATENDIMENTO': [16, 16, 16],
+        'MES_ATENDIMENTO': [5, 6, 5],
+        'SEXO': ['Feminino', 'Masculino', 'Feminino'],
+        'FAIXA_ETARIA': ['40-49', '50-59', '40-49'],
+        'PROC_GRU_NOME': ['RX', 'TC', 'RX'],
+        'REGIAO_CORPORAL_DETALHADA': ['Membros superiores'] * 3,
+        'TOTAL_PROCEDIMENTOS': [total, 2 * total, 3 * total],
+    })
+
+
+@pytest.fixture
+def sources(tmp_path):
+    sources = {}
+    for uf in ('AC', 'MG'):
+        path = tmp_path / f'CIHA{uf}1605.dbc'
+        path.write_bytes(b'dbc')
+        sources[uf] = [str(path)]
+    return sources
+
+
+def test_unchanged_sources_and_version_are_skipped(tmp_path, sources):
+    root = str(tmp_path / 'parquet')
+    assert parquet_store.write_parquet_dataset(_master(1), root, sources, data_version='v1') == ['AC', 'MG']
+    assert parquet_store.write_parquet_dataset(_master(1), root, sources, data_version='v1') == []
+
+
+def test_new_data_version_rewrites_every_uf(tmp_path, sources):
+    # Mesmos .dbc, mas outras regras de agregação (mapeamentos, prefixos, colunas)
+    root = str(tmp_path / 'parquet')
+    parquet_store.write_parquet_dataset(_master(1), root, sources, data_version='v1')
+    assert parquet_store.write_parquet_dataset(_master(2), root, sources, data_version='v2') == ['AC', 'MG']
+    assert parquet_store.read_parquet_dataset(root)['TOTAL_PROCEDIMENTOS'].sum() == _master(2)['TOTAL_PROCEDIMENTOS'].sum()
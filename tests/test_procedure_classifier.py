@@ -0,0 +1,45 @@
+"""
+Índice compilado (.idx.npz) da tabela de referência (ProcedureClassifier.load/save).
+"""
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from procedure_classifier import ProcedureClassifier
+
+REFERENCE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'referencia', 'classificacao_procedimentos.csv')
+PROC_CODES = ['0204030030', '0206010010', '0207030014', '0301010072']
+
+
+def _classified(classifier):
+    return {key: np.asarray(codes).tolist() for key, codes in classifier.classify(PROC_CODES).items()}
+
+
+def _load(csv_path):
+    return _classified(ProcedureClassifier.load(csv_path))
+
+
+def test_corrupt_index_is_recompiled(tmp_path):
+    csv_path = str(tmp_path / 'classificacao.csv')
+    shutil.copy(REFERENCE_CSV, csv_path)
+    expected = _load(csv_path)
+
+    compiled_path = str(tmp_path / 'classificacao.idx.npz')
+    with open(compiled_path, 'wb') as f:
+        f.write(b'PK\x03\x04 corrompido')
+    assert _load(csv_path) == expected
+    with np.load(compiled_path, allow_pickle=False) as data:
+        assert 'source_key' in data.files
+
+
+def test_concurrent_compilation_leaves_one_valid_index(tmp_path):
+    csv_path = str(tmp_path / 'classificacao.csv')
+    shutil.copy(REFERENCE_CSV, csv_path)
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_load, [csv_path] * 8))
+    assert all(result == results[0] for result in results)
+    assert sorted(os.listdir(tmp_path)) == ['classificacao.csv', 'classificacao.idx.npz']
+    assert _load(csv_path) == results[0]
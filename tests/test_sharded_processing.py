@@ -0,0 +1,87 @@
+"""
+Processamento distribuído (sharded_processing): vários trabalhadores num diretório de
+trabalho temporário, com cópias de data/CIHAMG1605.dbc no lugar de outras UFs e meses.
+"""
+import os
+import shutil
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('datasus')
+import process_ciha_data
+import sharded_processing
+
+GOLDEN_DBC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'CIHAMG1605.dbc')
+FILENAMES = ['CIHAMG1605.dbc', 'CIHAMG1606.dbc', 'CIHASP1605.dbc', 'CIHABA1605.dbc']
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    directory = tmp_path / 'data'
+    directory.mkdir()
+    for filename in FILENAMES:
+        shutil.copy(GOLDEN_DBC, directory / filename)
+    return str(directory)
+
+
+def _write_lease(work_dir, filename, age_seconds):
+    # Reserva de um trabalhador de outra máquina, com o último heartbeat há age_seconds
+    work = sharded_processing.WorkDir(work_dir, sharded_processing.work_version())
+    assert work.try_claim(filename, {'worker': 'outra-maquina-1', 'token': 'outro'})
+    mtime = time.time() - age_seconds
+    os.utime(work.lease_path(filename), (mtime, mtime))
+    return work
+
+
+def test_workers_and_merge_match_main_processing_script(input_dir, tmp_path):
+    work_dir = str(tmp_path / 'work')
+    exit_codes = sharded_processing.run_workers(3, input_dir, work_dir, poll_interval=0.1)
+    assert exit_codes == [0, 0, 0]
+
+    status = sharded_processing.work_status(input_dir, work_dir)
+    assert len(status['done']) == len(FILENAMES)
+    assert not status['failed'] and not status['leased'] and not status['pending']
+
+    merged = sharded_processing.merge_results(input_dir, work_dir, str(tmp_path / 'merge.csv'))
+    expected = process_ciha_data.main_processing_script(input_dir, str(tmp_path / 'main.csv'))
+    pd.testing.assert_frame_equal(merged, expected)
+    with open(tmp_path / 'merge.csv', 'rb') as merged_csv, open(tmp_path / 'main.csv', 'rb') as main_csv:
+        assert merged_csv.read() == main_csv.read()
+
+
+def test_stale_lease_is_reclaimed(input_dir, tmp_path):
+    work_dir = str(tmp_path / 'work')
+    work = _write_lease(work_dir, 'CIHASP1605.dbc', age_seconds=3600)
+    processed = sharded_processing.run_worker(input_dir, work_dir, worker_id='local', lease_timeout=60, wait=False)
+    assert processed == len(FILENAMES)
+    assert work.result_entry(os.path.join(input_dir, 'CIHASP1605.dbc')) is not None
+    assert not os.listdir(work.lease_dir)
+
+
+def test_merge_refuses_while_a_live_lease_exists(input_dir, tmp_path):
+    work_dir = str(tmp_path / 'work')
+    _write_lease(work_dir, 'CIHASP1605.dbc', age_seconds=0)
+    processed = sharded_processing.run_worker(input_dir, work_dir, worker_id='local', lease_timeout=60, wait=False)
+    assert processed == len(FILENAMES) - 1
+
+    status = sharded_processing.work_status(input_dir, work_dir, lease_timeout=60)
+    assert list(status['leased']) == [os.path.join(input_dir, 'CIHASP1605.dbc')]
+    output_csv = tmp_path / 'merge.csv'
+    assert sharded_processing.merge_results(input_dir, work_dir, str(output_csv), lease_timeout=60) is None
+    assert not output_csv.exists()
+
+
+def test_merge_uses_the_lease_timeout(input_dir, tmp_path, monkeypatch):
+    # Reserva de um trabalhador que morreu há 2 minutos: vencida com lease_timeout=60
+    work_dir = str(tmp_path / 'work')
+    _write_lease(work_dir, 'CIHASP1605.dbc', age_seconds=120)
+    assert list(sharded_processing.work_status(input_dir, work_dir)['leased'])
+
+    statuses = []
+    work_status = sharded_processing.work_status
+    monkeypatch.setattr(sharded_processing, 'work_status',
+                        lambda *args, **kwargs: statuses.append(work_status(*args, **kwargs)) or statuses[-1])
+    assert sharded_processing.merge_results(input_dir, work_dir, str(tmp_path / 'merge.csv'), lease_timeout=60) is None
+    assert not statuses[0]['leased'] and len(statuses[0]['pending']) == len(FILENAMES)
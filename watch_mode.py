@@ -0,0 +1,444 @@
+"""
+Modo de observação (daemon): fica rodando, observa o diretório dos arquivos .dbc e, a
+cada lote de arquivos novos, alterados ou removidos, atualiza as saídas sem reprocessar
+o resto.
+
+O processo fica quente entre as atualizações: imports, mapeamentos e os agregados de
+cada arquivo ficam em memória. Numa atualização, só os arquivos que mudaram são
+processados; o agregado antigo de cada um sai das contagens do mestre
+(CountAccumulator.subtract) e o novo entra. Em seguida são regravados o CSV mestre,
+os rollups, as UFs afetadas do dataset Parquet e as planilhas Excel das UFs afetadas
+(no modo --excel-per-uf, só os arquivos resumo_<UF>.xlsx dessas UFs).
+
+Os eventos vêm do inotify (Linux), com leitura periódica do diretório como alternativa
+(outros sistemas ou --polling). Uma rajada de eventos (ex: um lote de downloads) vira
+uma só atualização: espera-se debounce segundos sem eventos novos, até no máximo
+max_delay segundos desde o primeiro evento.
+
+Uso:
+    python watch_mode.py --workers 4
+    python watch_mode.py --input-dir /dados/ciha --polling --poll-interval 30 --excel-per-uf
+"""
+import argparse
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import struct
+import sys
+import time
+
+import xlsxwriter
+
+from aggregate_cache import AggregateCache
+from count_accumulator import CountAccumulator
+from dbf_cache import DEFAULT_MAX_BYTES as DEFAULT_DBF_CACHE_MAX_BYTES, DbfCache
+from engines import ENGINE_NAMES
+from instrumentation import stage
+from process_ciha_data import (DEFAULT_CHUNK_SIZE, FINAL_GROUPING_COLS, PROC_REA_PREFIXES, _process_files,
+                               _write_uf_workbook, aggregate_cache_version, pivot_wide_by_uf, uf_from_filename,
+                               write_master_outputs, write_uf_sheet)
+from rollups import DEFAULT_ROLLUPS, parse_rollup_specs
+
+
+DEFAULT_DEBOUNCE = 5.0
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_POLL_INTERVAL = 10.0
+
+# Constantes do inotify (sys/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+def snapshot_dbc_files(directory):
+    """
+    Assinatura (tamanho, mtime em ns) de cada arquivo .dbc do diretório.
+    """
+    snapshot = {}
+    for filepath in glob.glob(os.path.join(directory, '*.dbc')):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            continue # Removido entre o glob e o stat
+        snapshot[filepath] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+class DirectoryWatcher:
+    """
+    Espera por mudanças nos arquivos .dbc de um diretório. wait(timeout) bloqueia até
+    timeout segundos (None: sem limite) e retorna True se houve alguma atividade.
+    Usa o inotify quando disponível (um arquivo conta quando é fechado após a escrita ou
+    movido para o diretório, então um download em andamento não dispara a atualização);
+    senão, compara a listagem do diretório a cada poll_interval segundos.
+    """
+
+    def __init__(self, directory, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._fd = None
+        if use_inotify:
+            self._fd = self._open_inotify(directory)
+        self.mode = 'inotify' if self._fd is not None else 'polling'
+        self._snapshot = snapshot_dbc_files(directory) if self._fd is None else None
+
+    @staticmethod
+    def _open_inotify(directory):
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            print(f"AVISO: inotify indisponível para {directory} ({os.strerror(errno)}). "
+                  f"Usando leitura periódica do diretório.", file=sys.stderr)
+            return None
+        return fd
+
+    def _read_events(self):
+        """
+        Lê os eventos pendentes. Retorna True se algum diz respeito a um arquivo .dbc.
+        """
+        relevant = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return relevant
+            offset = 0
+            while offset < len(data):
+                _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_len].rstrip(b'\0')
+                offset += EVENT_HEADER.size + name_len
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    # O diretório observado sumiu: segue com a leitura periódica
+                    print(f"AVISO: {self.directory} foi removido ou movido. Usando leitura periódica do diretório.",
+                          file=sys.stderr)
+                    self._fall_back_to_polling()
+                    return True
+                if mask & IN_Q_OVERFLOW or name.endswith(b'.dbc'):
+                    relevant = True
+
+    def _fall_back_to_polling(self):
+        os.close(self._fd)
+        self._fd = None
+        self.mode = 'polling'
+        self._snapshot = snapshot_dbc_files(self.directory)
+
+    def wait(self, timeout=None):
+        if self._fd is not None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                readable, _, _ = select.select([self._fd], [], [], remaining)
+                if not readable:
+                    return False
+                if self._read_events():
+                    return True
+                if self._fd is None:
+                    return True
+
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        snapshot = snapshot_dbc_files(self.directory)
+        changed = snapshot != self._snapshot
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class WatchService:
+    """
+    Estado quente do modo de observação: o agregado de cada arquivo .dbc processado, a
+    assinatura (tamanho, mtime) com que foi processado, as contagens do mestre e as
+    planilhas wide de cada UF.
+    process_kwargs (chunk_size, proc_rea_prefixes, classification_table, dbf_cache,
+    engine e memory_budget) são repassados a _process_files.
+    """
+
+    def __init__(self, input_dir, output_file_csv_master, excel_path=None, per_uf_dir=None, workers=1,
+                 cache_dir=None, cache_content_hash=False, parquet_dir=None, rollups=None, rollup_dir=None,
+                 **process_kwargs):
+        self.input_dir = input_dir
+        self.output_file_csv_master = output_file_csv_master
+        self.excel_path = excel_path
+        self.per_uf_dir = per_uf_dir
+        self.workers = workers
+        self.parquet_dir = parquet_dir
+        self.rollups = rollups
+        self.rollup_dir = rollup_dir
+        self.process_kwargs = process_kwargs
+
+        # Versão das regras de agregação: valida o cache e as partições Parquet já gravadas
+        self.data_version = aggregate_cache_version(process_kwargs.get('proc_rea_prefixes', PROC_REA_PREFIXES),
+                                                    process_kwargs.get('classification_table'))
+        self.cache = None
+        if cache_dir:
+            self.cache = AggregateCache(cache_dir, self.data_version, use_content_hash=cache_content_hash)
+
+        self.accumulator = CountAccumulator(FINAL_GROUPING_COLS)
+        self.aggregates = {} # filepath -> agregado incluído nas contagens
+        self.signatures = {} # filepath -> (tamanho, mtime_ns) da última tentativa de processamento
+        self.failed = set()
+        self.uf_sheets = {} # UF -> DataFrame wide da planilha
+        self.years = None
+        self.updates = 0
+
+    def update(self):
+        """
+        Compara o diretório com o estado em memória, processa os arquivos novos ou
+        alterados, retira os removidos e regrava as saídas. Retorna as UFs afetadas
+        (conjunto vazio se nada mudou).
+        """
+        snapshot = snapshot_dbc_files(self.input_dir)
+        changed = sorted(filepath for filepath, signature in snapshot.items()
+                         if self.signatures.get(filepath) != signature)
+        removed = sorted(filepath for filepath in self.signatures if filepath not in snapshot)
+        if not changed and not removed:
+            return set()
+
+        print(f"\nAtualização: {len(changed)} arquivo(s) novo(s) ou alterado(s), {len(removed)} removido(s).")
+        touched_ufs = set()
+        for filepath in removed:
+            df_old = self.aggregates.pop(filepath, None)
+            if df_old is not None:
+                self.accumulator.subtract(df_old)
+            self.signatures.pop(filepath)
+            self.failed.discard(filepath)
+            touched_ufs.add(uf_from_filename(filepath))
+            print(f"  - Removido: {os.path.basename(filepath)}")
+
+        pending = []
+        with stage('cache_consulta') as st:
+            for filepath in changed:
+                df_cached = self.cache.get(filepath) if self.cache is not None else None
+                if df_cached is not None:
+                    self._replace(filepath, df_cached, snapshot[filepath])
+                else:
+                    pending.append(filepath)
+            st.set(files=len(changed), hits=len(changed) - len(pending))
+
+        with stage('processamento', workers=self.workers) as st:
+            for filepath, df_agg in _process_files(pending, self.workers, **self.process_kwargs):
+                if df_agg is None:
+                    # O agregado anterior (se houver) continua valendo até o arquivo ser lido com sucesso
+                    self.signatures[filepath] = snapshot[filepath]
+                    self.failed.add(filepath)
+                    continue
+                self._replace(filepath, df_agg, snapshot[filepath])
+                if self.cache is not None:
+                    self.cache.put(filepath, df_agg)
+            st.set(files=len(pending))
+
+        if self.cache is not None:
+            with stage('cache_gravacao'):
+                self.cache.save()
+
+        touched_ufs.update(uf_from_filename(filepath) for filepath in changed)
+        self.write_outputs(touched_ufs)
+        self.updates += 1
+        return touched_ufs
+
+    def _replace(self, filepath, df_agg, signature):
+        df_old = self.aggregates.get(filepath)
+        if df_old is not None:
+            self.accumulator.subtract(df_old)
+        self.accumulator.add(df_agg)
+        self.aggregates[filepath] = df_agg
+        self.signatures[filepath] = signature
+        self.failed.discard(filepath)
+
+    def write_outputs(self, touched_ufs):
+        """
+        Regrava o CSV mestre (e Parquet e rollups) e as planilhas das UFs afetadas.
+        """
+        filepaths = sorted(self.signatures)
+        results = {filepath: filepath in self.aggregates for filepath in filepaths}
+        if not filepaths:
+            print("Nenhum arquivo .dbc no diretório observado.")
+            return
+        final_df_long = write_master_outputs(filepaths, results, self.accumulator, self.output_file_csv_master,
+                                             self.parquet_dir, self.rollups, self.rollup_dir,
+                                             data_version=self.data_version)
+        if final_df_long is not None and (self.excel_path or self.per_uf_dir):
+            self.write_excel(final_df_long, touched_ufs)
+
+    def write_excel(self, final_df_long, touched_ufs):
+        """
+        Refaz o pivot só das UFs afetadas (todas, se o conjunto de anos mudou, já que
+        cada ano é uma coluna) e regrava as planilhas. No modo por UF só os arquivos das
+        UFs afetadas são regravados; o Excel consolidado é um arquivo só e é regravado
+        inteiro, com as planilhas das demais UFs vindas da memória.
+        """
+        years = sorted(final_df_long['ANO_ATENDIMENTO'].unique())
+        if years != self.years:
+            touched_ufs = set(final_df_long['UF_ATENDIMENTO'].unique()) | set(self.uf_sheets)
+            self.years = years
+
+        df_touched = final_df_long[final_df_long['UF_ATENDIMENTO'].isin(touched_ufs)]
+        new_sheets = dict(pivot_wide_by_uf(df_touched, years))
+        for uf in sorted(touched_ufs):
+            if uf in new_sheets:
+                self.uf_sheets[uf] = new_sheets[uf]
+            else:
+                self.uf_sheets.pop(uf, None)
+
+        if self.per_uf_dir:
+            os.makedirs(self.per_uf_dir, exist_ok=True)
+            with stage('excel_escrita') as st:
+                for uf in sorted(touched_ufs):
+                    filepath = os.path.join(self.per_uf_dir, f'resumo_{uf}.xlsx')
+                    if uf not in self.uf_sheets:
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+                            print(f"  - Arquivo removido: {filepath}")
+                        continue
+                    _write_uf_workbook(filepath + '.tmp', uf, self.uf_sheets[uf])
+                    os.replace(filepath + '.tmp', filepath)
+                    print(f"  - Arquivo salvo: {filepath}")
+                st.set(files=len(touched_ufs))
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.excel_path)), exist_ok=True)
+        with stage('excel_escrita') as st:
+            # Gravado num temporário e renomeado, como o CSV mestre
+            workbook = xlsxwriter.Workbook(self.excel_path + '.tmp')
+            try:
+                for uf in sorted(self.uf_sheets):
+                    write_uf_sheet(workbook, uf, self.uf_sheets[uf])
+            finally:
+                workbook.close()
+            os.replace(self.excel_path + '.tmp', self.excel_path)
+            st.set(ufs_rewritten=len(touched_ufs), bytes_out=os.path.getsize(self.excel_path))
+        print(f"Excel consolidado salvo em: {self.excel_path} (UFs atualizadas: {', '.join(sorted(touched_ufs)) or 'nenhuma'})")
+
+    def run(self, watcher, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, max_updates=None):
+        """
+        Carga inicial e laço de observação. Termina com Ctrl+C ou depois de max_updates
+        atualizações (contando a carga inicial).
+        """
+        print(f"Carga inicial de {self.input_dir}...")
+        self.update()
+        print(f"\nObservando {self.input_dir} ({watcher.mode}). Ctrl+C para sair.")
+        try:
+            while max_updates is None or self.updates < max_updates:
+                if not watcher.wait(None if watcher.mode == 'inotify' else watcher.poll_interval):
+                    continue
+                # Espera a rajada de eventos acabar, até no máximo max_delay segundos
+                first_event = time.monotonic()
+                while time.monotonic() - first_event < max_delay:
+                    if not watcher.wait(min(debounce, max_delay - (time.monotonic() - first_event))):
+                        break
+                self.update()
+        except KeyboardInterrupt:
+            print("\nObservação encerrada.")
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Observa o diretório dos arquivos .dbc do CIHA e atualiza o CSV "
+                                                 "mestre e o Excel por UF conforme chegam arquivos novos.")
+    parser.add_argument('--input-dir', default=os.path.join(base_dir, 'data'),
+                        help="Diretório observado (padrão: data).")
+    parser.add_argument('--output-csv', default=os.path.join(base_dir, 'output', 'datasus_sumario_nacional_long.csv'),
+                        help="CSV mestre (padrão: output/datasus_sumario_nacional_long.csv).")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos para processar cada lote de arquivos (padrão: 1).")
+    parser.add_argument('--memory-budget-mb', type=float, default=None,
+                        help="Limite da memória estimada dos arquivos processados ao mesmo tempo, em MB "
+                             "(ver process_ciha_data.py).")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help=f"Segundos sem eventos novos para a atualização começar (padrão: {DEFAULT_DEBOUNCE}).")
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                        help="Espera máxima, desde o primeiro evento, antes de atualizar mesmo com eventos "
+                             f"chegando (padrão: {DEFAULT_MAX_DELAY}).")
+    parser.add_argument('--polling', action='store_true',
+                        help="Usa a leitura periódica do diretório em vez do inotify (ex: diretórios de rede).")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f"Intervalo da leitura periódica, em segundos (padrão: {DEFAULT_POLL_INTERVAL}).")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Diretório do cache de agregados por arquivo (padrão: output/cache_agregados).")
+    parser.add_argument('--no-cache', action='store_true', help="Desativa o cache de agregados.")
+    parser.add_argument('--cache-hash', action='store_true',
+                        help="Valida os caches também pelo hash do conteúdo quando o mtime do arquivo mudar.")
+    parser.add_argument('--chunk-size', type=int, default=None, nargs='?', const=DEFAULT_CHUNK_SIZE,
+                        help="Modo streaming do processamento (ver process_ciha_data.py).")
+    parser.add_argument('--proc-rea-prefixes', nargs='+', default=list(PROC_REA_PREFIXES),
+                        help="Prefixos do PROC_REA mantidos (padrão: 02).")
+    parser.add_argument('--classification-table', default=None,
+                        help="Tabela de referência do PROC_REA (ver process_ciha_data.py).")
+    parser.add_argument('--engine', choices=ENGINE_NAMES, default='pandas',
+                        help="Motor do enriquecimento e da agregação (ver process_ciha_data.py).")
+    parser.add_argument('--dbf-cache-dir', default=None, nargs='?', const='',
+                        help="Cache dos DBFs descompactados (padrão do diretório: output/cache_dbf).")
+    parser.add_argument('--dbf-cache-max-gb', type=float, default=DEFAULT_DBF_CACHE_MAX_BYTES / 1024 ** 3,
+                        help="Espaço máximo do cache de DBFs, em GB.")
+    parser.add_argument('--parquet-dir', default=None, nargs='?', const='',
+                        help="Grava também o dataset Parquet particionado (padrão: output/datasus_sumario_nacional_parquet).")
+    parser.add_argument('--excel-per-uf', default=None, nargs='?', const='',
+                        help="Grava um arquivo Excel por UF no lugar do consolidado (padrão do diretório: output/resumo_por_uf).")
+    parser.add_argument('--no-excel', action='store_true', help="Não grava o Excel.")
+    parser.add_argument('--rollups', nargs='+', default=list(DEFAULT_ROLLUPS), metavar='ROLLUP',
+                        help="Agregações pré-calculadas gravadas ao lado do CSV mestre (ver process_ciha_data.py).")
+    parser.add_argument('--no-rollups', action='store_true', help="Não grava os rollups.")
+    args = parser.parse_args()
+
+    rollups = None
+    if not args.no_rollups:
+        try:
+            rollups = parse_rollup_specs(args.rollups, FINAL_GROUPING_COLS)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"Diretório não encontrado: {args.input_dir}")
+
+    excel_path = per_uf_dir = None
+    if not args.no_excel:
+        if args.excel_per_uf is not None:
+            per_uf_dir = args.excel_per_uf or os.path.join(base_dir, 'output', 'resumo_por_uf')
+        else:
+            excel_path = os.path.join(base_dir, 'output', 'resumo_consolidado_por_uf.xlsx')
+
+    parquet_dir = None
+    if args.parquet_dir is not None:
+        parquet_dir = args.parquet_dir or os.path.join(base_dir, 'output', 'datasus_sumario_nacional_parquet')
+
+    dbf_cache = None
+    if args.dbf_cache_dir is not None:
+        dbf_cache = DbfCache(args.dbf_cache_dir or os.path.join(base_dir, 'output', 'cache_dbf'),
+                             max_bytes=int(args.dbf_cache_max_gb * 1024 ** 3), use_content_hash=args.cache_hash)
+
+    service = WatchService(args.input_dir, args.output_csv, excel_path=excel_path, per_uf_dir=per_uf_dir,
+                           workers=args.workers,
+                           cache_dir=None if args.no_cache else (args.cache_dir or os.path.join(base_dir, 'output', 'cache_agregados')),
+                           cache_content_hash=args.cache_hash, parquet_dir=parquet_dir, rollups=rollups,
+                           chunk_size=args.chunk_size, proc_rea_prefixes=tuple(args.proc_rea_prefixes),
+                           classification_table=args.classification_table, dbf_cache=dbf_cache, engine=args.engine,
+                           memory_budget=args.memory_budget_mb and int(args.memory_budget_mb * 1024 ** 2))
+    watcher = DirectoryWatcher(args.input_dir, poll_interval=args.poll_interval, use_inotify=not args.polling)
+    service.run(watcher, debounce=args.debounce, max_delay=args.max_delay)